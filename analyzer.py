@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+
+''' Static ROM analysis: disassembly, control-flow graph, loops and hot regions '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+import argparse
+import hashlib
+import json
+import os
+
+from cpu import INSTRUCTION_SET, decode_opcode
+from loader import PROGRAM_START, is_archive, list_roms, read_rom
+
+
+''' Bump when analysis output changes, older cache files are recomputed '''
+ANALYSIS_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.environ.get("C8PY_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "c8py"))
+
+''' Mnemonic of every handler, operands by name '''
+MNEMONICS = {
+    "op_00e0": "CLS",
+    "op_00ee": "RET",
+    "op_1nnn": "JP {nnn:#05x}",
+    "op_2nnn": "CALL {nnn:#05x}",
+    "op_3xnn": "SE V{x:X}, {nn:#04x}",
+    "op_4xnn": "SNE V{x:X}, {nn:#04x}",
+    "op_5xy0": "SE V{x:X}, V{y:X}",
+    "op_6xnn": "LD V{x:X}, {nn:#04x}",
+    "op_7xnn": "ADD V{x:X}, {nn:#04x}",
+    "op_8xy0": "LD V{x:X}, V{y:X}",
+    "op_8xy1": "OR V{x:X}, V{y:X}",
+    "op_8xy2": "AND V{x:X}, V{y:X}",
+    "op_8xy3": "XOR V{x:X}, V{y:X}",
+    "op_8xy4": "ADD V{x:X}, V{y:X}",
+    "op_8xy5": "SUB V{x:X}, V{y:X}",
+    "op_8xy6": "SHR V{x:X}, V{y:X}",
+    "op_8xy7": "SUBN V{x:X}, V{y:X}",
+    "op_8xye": "SHL V{x:X}, V{y:X}",
+    "op_9xy0": "SNE V{x:X}, V{y:X}",
+    "op_annn": "LD I, {nnn:#05x}",
+    "op_bnnn": "JP V0, {nnn:#05x}",
+    "op_cxnn": "RND V{x:X}, {nn:#04x}",
+    "op_dxyn": "DRW V{x:X}, V{y:X}, {n}",
+    "op_ex9e": "SKP V{x:X}",
+    "op_exa1": "SKNP V{x:X}",
+    "op_fx07": "LD V{x:X}, DT",
+    "op_fx0a": "LD V{x:X}, K",
+    "op_fx15": "LD DT, V{x:X}",
+    "op_fx18": "LD ST, V{x:X}",
+    "op_fx1e": "ADD I, V{x:X}",
+    "op_fx29": "LD F, V{x:X}",
+    "op_fx33": "LD B, V{x:X}",
+    "op_fx55": "LD [I], V{x:X}",
+    "op_fx65": "LD V{x:X}, [I]",
+}
+
+OPERAND_NAMES = {handler: operands for _, _, handler, operands in INSTRUCTION_SET}
+
+''' Instructions that may skip the next one '''
+SKIPS = {"op_3xnn", "op_4xnn", "op_5xy0", "op_9xy0", "op_ex9e", "op_exa1"}
+
+''' Instructions never falling through to the next one '''
+TERMINATORS = {"op_00ee", "op_1nnn", "op_bnnn"}
+
+''' Longest jump table followed behind Bnnn '''
+MAX_TABLE_ENTRIES = 128
+
+''' Estimated iterations of one loop level, for hot region weights '''
+LOOP_WEIGHT = 10
+
+HOT_REGIONS = 8
+
+
+def mnemonic(opcode):
+    ''' Assembly text of opcode, DW for words that are not instructions '''
+    decoded = decode_opcode(opcode)
+    if decoded is None:
+        return f"DW {opcode:#06x}"
+
+    name, values = decoded
+    return MNEMONICS[name].format(**dict(zip(OPERAND_NAMES[name], values)))
+
+
+def read_word(image, address):
+    ''' Opcode at address of ROM loaded at PROGRAM_START, None outside the image '''
+    offset = address - PROGRAM_START
+    if offset < 0 or offset + 2 > len(image):
+        return None
+    return (image[offset] << 8) | image[offset + 1]
+
+
+def disassemble(image, analysis=None):
+    '''
+    Listing lines (address, opcode, text). Code found by analysis is listed
+    as instructions, everything else as data bytes, every word if no analysis
+    '''
+    if analysis is None:
+        return [(address, read_word(image, address), mnemonic(read_word(image, address)))
+                for address in range(PROGRAM_START, PROGRAM_START + len(image) - 1, 2)]
+
+    code = set(analysis["code"])
+    lines = []
+    address = PROGRAM_START
+    end = PROGRAM_START + len(image)
+    while address < end:
+        opcode = read_word(image, address)
+        if address in code:
+            lines.append((address, opcode, mnemonic(opcode)))
+            address += 2
+        else:
+            byte = image[address - PROGRAM_START]
+            lines.append((address, byte, f"DB {byte:#04x}"))
+            address += 1
+
+    return lines
+
+
+def explore(image):
+    '''
+    Follow control flow from PROGRAM_START. Return instructions
+    (address -> (opcode, name, operands)), successors (address -> list),
+    call targets and jump tables
+    '''
+    instructions = {}
+    successors = {}
+    calls = {}
+    tables = []
+
+    work = [PROGRAM_START]
+    while work:
+        address = work.pop()
+        if address in instructions:
+            continue
+
+        opcode = read_word(image, address)
+        decoded = decode_opcode(opcode) if opcode is not None else None
+        if decoded is None:
+            continue
+
+        name, operands = decoded
+        instructions[address] = (opcode, name, operands)
+
+        targets = []
+        if name == "op_1nnn":
+            targets = [operands[0]]
+        elif name == "op_2nnn":
+            calls.setdefault(operands[0], []).append(address)
+            targets = [address + 2]
+            work.append(operands[0])
+        elif name == "op_bnnn":
+            base = operands[0]
+            entries = []
+            for entry in range(base, base + 2 * MAX_TABLE_ENTRIES, 2):
+                word = read_word(image, entry)
+                if word is None or word >> 12 not in (0x1, 0x2):
+                    break
+                entries.append(entry)
+            tables.append({"address": address, "base": base, "targets": entries})
+            targets = entries
+        elif name in SKIPS:
+            targets = [address + 2, address + 4]
+        elif name not in TERMINATORS:
+            targets = [address + 2]
+
+        successors[address] = targets
+        work.extend(targets)
+
+    return instructions, successors, calls, tables
+
+
+def split_blocks(instructions, successors, calls):
+    ''' Basic blocks as {start: [instruction addresses]} '''
+    leaders = {PROGRAM_START} | set(calls)
+    for address, targets in successors.items():
+        name = instructions[address][1]
+        if name in TERMINATORS or name in SKIPS or name == "op_2nnn":
+            leaders.update(targets)
+    leaders &= set(instructions)
+
+    blocks = {}
+    for start in sorted(leaders):
+        body = [start]
+        address = start
+        while True:
+            name = instructions[address][1]
+            if name in TERMINATORS or name in SKIPS or name == "op_2nnn":
+                break
+            following = address + 2
+            if following in leaders or following not in instructions:
+                break
+            body.append(following)
+            address = following
+        blocks[start] = body
+
+    return blocks
+
+
+def track_index(blocks, block_successors, instructions, image_end):
+    '''
+    Value of I through the program where it is known (set by Annn and
+    agreed on by every path). Return sprite, read and write ranges (start, length)
+    '''
+    predecessors = {start: [] for start in blocks}
+    for start, targets in block_successors.items():
+        for target in targets:
+            predecessors[target].append(start)
+
+    ''' None is unknown, missing is not computed yet '''
+    exit_index = {}
+    sprites, reads, writes = set(), set(), set()
+
+    def run(start, index, record):
+        for address in blocks[start]:
+            opcode, name, operands = instructions[address]
+            if name == "op_annn":
+                index = operands[0]
+            elif name in ("op_fx1e", "op_fx29"):
+                index = None
+            elif index is not None and record:
+                if name == "op_dxyn" and operands[2]:
+                    sprites.add((index, operands[2]))
+                elif name == "op_fx65":
+                    reads.add((index, operands[0] + 1))
+                elif name == "op_fx55":
+                    writes.add((index, operands[0] + 1))
+                elif name == "op_fx33":
+                    writes.add((index, 3))
+        return index
+
+    for _ in range(len(blocks) + 2):
+        changed = False
+        for start in sorted(blocks):
+            known = [exit_index[pred] for pred in predecessors[start] if pred in exit_index]
+            entry = known[0] if known and all(value == known[0] for value in known) else None
+            if start == PROGRAM_START and predecessors[start]:
+                entry = None
+            index = run(start, entry, record=False)
+            if exit_index.get(start, ...) != index:
+                exit_index[start] = index
+                changed = True
+        if not changed:
+            break
+
+    for start in blocks:
+        known = [exit_index[pred] for pred in predecessors[start] if pred in exit_index]
+        entry = known[0] if known and all(value == known[0] for value in known) else None
+        run(start, entry, record=True)
+
+    in_image = lambda span: PROGRAM_START <= span[0] < image_end
+    return (sorted(filter(in_image, sprites)), sorted(filter(in_image, reads)),
+            sorted(filter(in_image, writes)))
+
+
+def find_loops(blocks, block_successors):
+    '''
+    Natural loops from back edges of a depth first search,
+    as dicts with header, latch, blocks and nesting depth
+    '''
+    back_edges = []
+    state = {}
+    for root in sorted(blocks):
+        if root in state:
+            continue
+        stack = [(root, iter(block_successors[root]))]
+        state[root] = "open"
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if state.get(child) == "open":
+                    back_edges.append((node, child))
+                elif child not in state:
+                    state[child] = "open"
+                    stack.append((child, iter(block_successors[child])))
+                    break
+            else:
+                state[node] = "done"
+                stack.pop()
+
+    predecessors = {start: [] for start in blocks}
+    for start, targets in block_successors.items():
+        for target in targets:
+            predecessors[target].append(start)
+
+    loops = []
+    for latch, header in back_edges:
+        body = {header, latch}
+        work = [latch] if latch != header else []
+        while work:
+            node = work.pop()
+            for pred in predecessors[node]:
+                if pred not in body:
+                    body.add(pred)
+                    work.append(pred)
+        loops.append({"header": header, "latch": latch, "blocks": sorted(body)})
+
+    for loop in loops:
+        body = set(loop["blocks"])
+        loop["depth"] = sum(1 for other in loops if set(other["blocks"]) >= body)
+
+    return sorted(loops, key=lambda loop: (loop["header"], loop["latch"]))
+
+
+def hot_regions(blocks, loops, calls, subroutines):
+    '''
+    Estimated weight of every block: LOOP_WEIGHT per enclosing loop,
+    subroutines inherit the weight of their hottest call site
+    '''
+    depth = {start: 0 for start in blocks}
+    for loop in loops:
+        for start in loop["blocks"]:
+            depth[start] = max(depth[start], loop["depth"])
+
+    owner = {}
+    for entry, body in subroutines.items():
+        for start in body:
+            owner.setdefault(start, entry)
+
+    call_weight = {entry: 1 for entry in subroutines}
+    for _ in range(len(subroutines) + 1):
+        weight = {start: LOOP_WEIGHT ** depth[start] * call_weight.get(owner.get(start), 1) for start in blocks}
+        for entry, sites in calls.items():
+            site_blocks = [start for start, body in blocks.items() if any(site in body for site in sites)]
+            call_weight[entry] = max((weight[start] for start in site_blocks), default=1)
+
+    regions = [{"start": start, "end": blocks[start][-1] + 2, "weight": weight[start]} for start in blocks]
+    regions.sort(key=lambda region: (-region["weight"], region["start"]))
+    return regions[:HOT_REGIONS]
+
+
+def ranges(addresses):
+    ''' Sorted addresses as [start, end) ranges of consecutive values '''
+    spans = []
+    for address in sorted(addresses):
+        if spans and spans[-1][1] == address:
+            spans[-1][1] += 1
+        else:
+            spans.append([address, address + 1])
+    return spans
+
+
+def analyze(image):
+    ''' Whole analysis of ROM image as a JSON serializable dict '''
+    instructions, successors, calls, tables = explore(image)
+    blocks = split_blocks(instructions, successors, calls)
+
+    block_successors = {start: [target for target in successors[body[-1]] if target in blocks]
+                        for start, body in blocks.items()}
+
+    ''' Subroutine body: blocks reached from entry without following calls '''
+    subroutines = {}
+    for entry in calls:
+        if entry not in blocks:
+            continue
+        body, work = {entry}, [entry]
+        while work:
+            for target in block_successors[work.pop()]:
+                if target not in body:
+                    body.add(target)
+                    work.append(target)
+        subroutines[entry] = sorted(body)
+
+    image_end = PROGRAM_START + len(image)
+    sprites, reads, writes = track_index(blocks, block_successors, instructions, image_end)
+
+    code_bytes = {address + offset for address in instructions for offset in (0, 1)}
+    modified = {start + offset for start, length in writes for offset in range(length)} & code_bytes
+    data = set()
+    for start, length in sprites + reads:
+        data.update(range(start, min(start + length, image_end)))
+
+    loops = find_loops(blocks, block_successors)
+    return {
+        "version": ANALYSIS_VERSION,
+        "sha256": hashlib.sha256(image).hexdigest(),
+        "size": len(image),
+        "code": sorted(instructions),
+        "blocks": [{"start": start, "end": body[-1] + 2, "successors": block_successors[start]}
+                   for start, body in sorted(blocks.items())],
+        "subroutines": [{"entry": entry, "blocks": body, "callers": sorted(calls[entry])}
+                        for entry, body in sorted(subroutines.items())],
+        "jump_tables": tables,
+        "sprites": [list(span) for span in sprites],
+        "data": ranges(data - code_bytes),
+        "unreached": ranges(set(range(PROGRAM_START, image_end)) - code_bytes - data),
+        "writes": [list(span) for span in writes],
+        "self_modifying": ranges(modified),
+        "loops": loops,
+        "max_loop_depth": max((loop["depth"] for loop in loops), default=0),
+        "hot": hot_regions(blocks, loops, calls, subroutines),
+    }
+
+
+class AnalysisCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        ''' Analyses stored as JSON files named by ROM hash '''
+        self.directory = directory
+
+
+    def path(self, digest):
+        return os.path.join(self.directory, f"{digest}.json")
+
+
+    def load(self, image):
+        ''' Cached analysis of image, analyzed and stored on first use '''
+        path = self.path(hashlib.sha256(image).hexdigest())
+        try:
+            with open(path) as f:
+                analysis = json.load(f)
+            if analysis.get("version") == ANALYSIS_VERSION:
+                return analysis
+        except (OSError, ValueError):
+            pass
+
+        analysis = analyze(image)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(analysis, f)
+        os.replace(temporary, path)
+        return analysis
+
+
+def warm(cpu, analysis):
+    '''
+    Predecode every instruction found by analysis into the CPU caches.
+    Code rewritten at runtime is left to be decoded when it runs.
+    '''
+    modified = set()
+    for start, end in analysis["self_modifying"]:
+        modified.update(range(start - 1, end))
+
+    for address in analysis["code"]:
+        if address not in modified:
+            cpu.handler_at(address)
+
+
+def format_report(source, analysis):
+    lines = [
+        f"{source}: {analysis['size']} bytes, {len(analysis['code'])} instructions, "
+        f"{len(analysis['blocks'])} blocks, {len(analysis['subroutines'])} subroutines, "
+        f"{len(analysis['loops'])} loops (max depth {analysis['max_loop_depth']})"
+    ]
+    for loop in analysis["loops"]:
+        lines.append(f"  {'  ' * (loop['depth'] - 1)}loop {loop['header']:#05x}-{loop['latch']:#05x} "
+                     f"depth {loop['depth']}, {len(loop['blocks'])} blocks")
+    for table in analysis["jump_tables"]:
+        lines.append(f"  jump table at {table['address']:#05x}: {len(table['targets'])} entries from {table['base']:#05x}")
+    for start, end in analysis["self_modifying"]:
+        lines.append(f"  self-modifying code {start:#05x}-{end - 1:#05x}")
+    lines.append("  hot regions: " + ", ".join(
+        f"{region['start']:#05x}-{region['end'] - 1:#05x} (x{region['weight']})" for region in analysis["hot"]))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze CHIP-8 ROMs without running them")
+    parser.add_argument("roms", nargs="+", help="ROM files, directories or zip archives")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_DIR, help=f"analysis cache (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--listing", action="store_true", help="print disassembly")
+    parser.add_argument("--json", action="store_true", help="print analyses as JSON")
+    args = parser.parse_args()
+
+    sources = []
+    for path in args.roms:
+        sources += list_roms(path) if os.path.isdir(path) or is_archive(path) else [path]
+
+    cache = AnalysisCache(args.cache)
+    analyses = {}
+    for source in sources:
+        image = read_rom(source)
+        analysis = analyses[source] = cache.load(image)
+        if args.json:
+            continue
+
+        print(format_report(source, analysis))
+        if args.listing:
+            for address, value, text in disassemble(image, analysis):
+                print(f"{address:#05x}  {text}")
+
+    if args.json:
+        print(json.dumps(analyses, indent=2))
+
+
+if __name__ == '__main__':
+    main()
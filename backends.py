@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+''' Registry of display and input frontends, imported only when used '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+import importlib
+from types import SimpleNamespace
+
+
+'''
+Frontend name -> "module:attribute" of its screen class, keyboard class
+and poll_events(keyboard, on_key) function. Nothing is imported until load()
+'''
+BACKENDS = {
+    "pygame": {
+        "screen": "screen:Screen",
+        "keyboard": "keyboard:Keyboard",
+        "poll_events": "keyboard:poll_events",
+    },
+    "headless": {
+        "screen": "headless:HeadlessScreen",
+        "keyboard": "headless:HeadlessKeyboard",
+        "poll_events": "headless:poll_events",
+    },
+}
+
+
+def register(name, screen, keyboard, poll_events):
+    ''' Add a frontend, every part given as "module:attribute" '''
+    BACKENDS[name] = {"screen": screen, "keyboard": keyboard, "poll_events": poll_events}
+
+
+def resolve(target):
+    module, attribute = target.split(":")
+    return getattr(importlib.import_module(module), attribute)
+
+
+def load(name):
+    ''' Import frontend name, return namespace with screen, keyboard and poll_events '''
+    try:
+        parts = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown backend {name!r}, choose from {', '.join(BACKENDS)}") from None
+
+    return SimpleNamespace(name=name, **{part: resolve(target) for part, target in parts.items()})
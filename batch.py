@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+''' Run a directory of ROMs headless across a process pool and report metrics '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+from errors import EmulatorFault, InvalidOpcode
+from headless import HeadlessMachine
+from loader import list_roms, load_rom
+
+
+REPORT_FIELDS = (
+    "rom", "instructions", "wall_time", "ips",
+    "invalid_opcode_faults", "fault", "framebuffer_hash",
+)
+
+
+def framebuffer_hash(rows):
+    ''' Stable hash of packed framebuffer rows '''
+    return hashlib.sha1(b"".join(row.to_bytes(8, "big") for row in rows)).hexdigest()
+
+
+def run_rom(job):
+    '''
+    Run one ROM headless, job is (path, cycles, frames, ips, engine).
+    Faults end the run and are reported, not raised
+    '''
+    path, cycles, frames, ips, engine = job
+    machine = HeadlessMachine(ips=ips, engine=engine)
+
+    fault = None
+    invalid_opcode_faults = 0
+    start = time.perf_counter()
+    try:
+        load_rom(machine.ram, path)
+        machine.run(cycles=cycles, frames=frames)
+    except InvalidOpcode as exc:
+        invalid_opcode_faults = 1
+        fault = str(exc)
+    except EmulatorFault as exc:
+        fault = str(exc)
+    wall_time = time.perf_counter() - start
+
+    instructions = machine.cpu.cycles
+    return {
+        "rom": os.path.basename(path),
+        "instructions": instructions,
+        "wall_time": wall_time,
+        "ips": instructions / wall_time if wall_time else 0.0,
+        "invalid_opcode_faults": invalid_opcode_faults,
+        "fault": fault,
+        "framebuffer_hash": framebuffer_hash(machine.screen.rows),
+    }
+
+
+def run_batch(paths, cycles=None, frames=None, ips=700, engine="interpreter", workers=None):
+    ''' Run every ROM in its own pool task, return reports in the order of paths '''
+    import multiprocessing
+
+    jobs = [(path, cycles, frames, ips, engine) for path in paths]
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(run_rom, jobs, chunksize=1)
+
+
+def write_report(reports, output, report_format="json"):
+    if report_format == "csv":
+        import csv
+
+        writer = csv.DictWriter(output, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(reports)
+    else:
+        json.dump(reports, output, indent=2)
+        output.write("\n")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a directory of CHIP-8 ROMs headless")
+    parser.add_argument("directory", help="directory or zip archive of ROM files")
+    budget = parser.add_mutually_exclusive_group(required=True)
+    budget.add_argument("--cycles", type=int, help="instructions to execute per ROM")
+    budget.add_argument("--frames", type=int, help="60 Hz frames to emulate per ROM")
+    parser.add_argument("--ips", type=int, default=700)
+    parser.add_argument("--engine", choices=("interpreter", "block"), default="interpreter")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: CPU count)")
+    parser.add_argument("--format", choices=("json", "csv"), default="json")
+    parser.add_argument("--output", help="report file (default: stdout)")
+    args = parser.parse_args()
+
+    reports = run_batch(list_roms(args.directory), cycles=args.cycles, frames=args.frames,
+                        ips=args.ips, engine=args.engine, workers=args.workers)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            write_report(reports, f, args.format)
+    else:
+        write_report(reports, sys.stdout, args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+''' Emulator benchmarks: per-opcode microbenchmarks and whole ROM throughput '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from cpu import CPU
+from headless import HeadlessMachine, HeadlessKeyboard, HeadlessScreen
+from ram import RAM
+from vector import VectorCPU, np
+
+
+''' Lower is better for time units, higher is better for rates '''
+LOWER_IS_BETTER = ("ns/op", "ms")
+
+''' One representative instruction per op_x family, (family, arg) '''
+FAMILY_OPCODES = (
+    (0x0, 0x0e0),  # CLS
+    (0x1, 0x300),  # JP 0x300
+    (0x3, 0x1ff),  # SE V1, 0xff
+    (0x4, 0x1ff),  # SNE V1, 0xff
+    (0x5, 0x120),  # SE V1, V2
+    (0x6, 0x1ab),  # LD V1, 0xab
+    (0x7, 0x101),  # ADD V1, 0x01
+    (0x8, 0x124),  # ADD V1, V2
+    (0x9, 0x120),  # SNE V1, V2
+    (0xa, 0x300),  # LD I, 0x300
+    (0xb, 0x300),  # JP V0, 0x300
+    (0xc, 0x10f),  # RND V1, 0x0f
+    (0xe, 0x19e),  # SKP V1
+    (0xf, 0x11e),  # ADD I, V1
+)
+
+''' Synthetic ROMs for whole machine throughput '''
+SYNTHETIC_ROMS = {
+    "arithmetic": bytes([
+        0x60, 0x00,  # 0x200: LD V0, 0x00
+        0x61, 0x03,  # 0x202: LD V1, 0x03
+        0x80, 0x14,  # 0x204: ADD V0, V1
+        0x82, 0x06,  # 0x206: SHR V2, V0
+        0x83, 0x03,  # 0x208: XOR V3, V0
+        0x71, 0x01,  # 0x20a: ADD V1, 0x01
+        0x31, 0x40,  # 0x20c: SE V1, 0x40
+        0x12, 0x04,  # 0x20e: JP 0x204
+        0x12, 0x00,  # 0x210: JP 0x200
+    ]),
+    "sprites": bytes([
+        0x60, 0x00,  # 0x200: LD V0, 0x00
+        0x61, 0x00,  # 0x202: LD V1, 0x00
+        0xa0, 0x50,  # 0x204: LD I, 0x050
+        0xd0, 0x15,  # 0x206: DRW V0, V1, 5
+        0x70, 0x05,  # 0x208: ADD V0, 0x05
+        0x71, 0x03,  # 0x20a: ADD V1, 0x03
+        0x12, 0x06,  # 0x20c: JP 0x206
+    ]),
+    "subroutines": bytes([
+        0x22, 0x06,  # 0x200: CALL 0x206
+        0x72, 0x01,  # 0x202: ADD V2, 0x01
+        0x12, 0x00,  # 0x204: JP 0x200
+        0xa3, 0x00,  # 0x206: LD I, 0x300
+        0xf1, 0x55,  # 0x208: LD [I], V1
+        0xf1, 0x65,  # 0x20a: LD V1, [I]
+        0x00, 0xee,  # 0x20c: RET
+    ]),
+}
+
+
+'''
+Startup paths, (name, code run in a fresh interpreter with the ROM path as argv[1]).
+Each prints time.monotonic_ns() right after the first emulated instruction
+'''
+STARTUP_PATHS = (
+    ("headless", "import sys\n"
+                 "from headless import run_headless\n"
+                 "run_headless(sys.argv[1], 1)"),
+    ("headless [block]", "import sys\n"
+                         "from headless import run_headless\n"
+                         "run_headless(sys.argv[1], 1, engine='block')"),
+    ("batch", "import sys\n"
+              "from batch import run_rom\n"
+              "run_rom((sys.argv[1], 1, None, 700, 'interpreter'))"),
+    ("pygame backend", "import sys\n"
+                       "import backends\n"
+                       "backends.load('pygame')\n"
+                       "from headless import run_headless\n"
+                       "run_headless(sys.argv[1], 1)"),
+)
+
+
+def best_ns(func, number, repeat=5):
+    ''' Best time of one call in nanoseconds '''
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e9
+
+
+def make_cpu():
+    ram = RAM()
+    cpu = CPU(ram=ram, screen=HeadlessScreen(), keyboard=HeadlessKeyboard())
+    cpu.load_font()
+    cpu.font_loaded = True
+    return cpu
+
+
+def micro_benchmarks(number=20000):
+    results = {}
+    cpu = make_cpu()
+
+    def fetch():
+        cpu.pc = 0x200
+        cpu.fetch()
+
+    results["cpu.fetch"] = best_ns(fetch, number)
+
+    for family, arg in FAMILY_OPCODES:
+        op = getattr(cpu, f"op_{family:x}")
+        results[f"cpu.op_{family:x}"] = best_ns(lambda: op(arg), number)
+
+    def call_return():
+        cpu.op_2(0x300)
+        cpu.op_0(0x0ee)
+
+    results["cpu.op_2+op_0 (call, ret)"] = best_ns(call_return, number)
+
+    cpu.i = cpu.FONT_ADDR
+    for height in range(1, 16):
+        results[f"cpu.op_d height {height}"] = best_ns(lambda: cpu.op_d(0x120 | height), number // 4)
+
+    ram = cpu.ram
+    results["ram read"] = best_ns(lambda: ram[0x300], number)
+    results["ram write"] = best_ns(lambda: ram.__setitem__(0x300, 0xab), number)
+    results["ram bulk_write 16"] = best_ns(lambda: ram.bulk_write(0x300, cpu.v), number)
+
+    return {name: {"value": value, "unit": "ns/op"} for name, value in results.items()}
+
+
+def rom_benchmarks(frames=120, ips=100000):
+    '''
+    Run synthetic ROMs uncapped, report achieved instructions per second
+    and emulated frames per second of host time
+    '''
+    results = {}
+    for engine in ("interpreter", "block"):
+        for name, rom in SYNTHETIC_ROMS.items():
+            machine = HeadlessMachine(rom, ips=ips, engine=engine)
+            start = time.perf_counter()
+            machine.run(frames=frames)
+            elapsed = time.perf_counter() - start
+
+            results[f"rom {name} [{engine}] ips"] = {"value": machine.cpu.cycles / elapsed, "unit": "ips"}
+            results[f"rom {name} [{engine}] fps"] = {"value": frames / elapsed, "unit": "fps"}
+
+    if np is not None:
+        results.update(vector_benchmarks())
+
+    return results
+
+
+def vector_benchmarks(instances=1024, cycles=2000):
+    ''' Instructions per second summed over all instances of the lockstep engine '''
+    results = {}
+    for name, rom in SYNTHETIC_ROMS.items():
+        vector = VectorCPU(instances, rom)
+        start = time.perf_counter()
+        vector.run_for(cycles)
+        elapsed = time.perf_counter() - start
+
+        results[f"rom {name} [vector x{instances}] ips"] = {"value": int(vector.cycles.sum()) / elapsed, "unit": "ips"}
+
+    return results
+
+
+def startup_benchmarks(repeat=5):
+    '''
+    Milliseconds from spawning a new interpreter to the first executed
+    instruction, best of repeat runs. Paths that cannot start are left out
+    '''
+    results = {}
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        rom = os.path.join(directory, "startup.ch8")
+        with open(rom, 'wb') as f:
+            f.write(SYNTHETIC_ROMS["arithmetic"])
+
+        for name, code in STARTUP_PATHS:
+            code += "\nimport time\nprint(time.monotonic_ns())"
+            times = []
+            for _ in range(repeat):
+                start = time.monotonic_ns()
+                child = subprocess.run([sys.executable, "-c", code, rom],
+                                       capture_output=True, text=True, cwd=here)
+                if child.returncode:
+                    break
+                times.append(int(child.stdout.split()[-1]) - start)
+
+            if times:
+                results[f"startup {name}"] = {"value": min(times) / 1e6, "unit": "ms"}
+
+    return results
+
+
+def replay_benchmarks(rom, recording):
+    '''
+    Replay a recorded session on every engine, report instructions per second.
+    Engines ending with a framebuffer other than the interpreter's raise AssertionError
+    '''
+    from replay import replay
+
+    results = {}
+    expected = None
+    for engine in ("interpreter", "block"):
+        start = time.perf_counter()
+        machine = replay(rom, recording, engine=engine)
+        elapsed = time.perf_counter() - start
+
+        if expected is None:
+            expected = machine.screen.rows
+        elif machine.screen.rows != expected:
+            raise AssertionError(f"Replay on {engine} engine ends with a different framebuffer")
+
+        results[f"replay [{engine}] ips"] = {"value": machine.cpu.cycles / elapsed, "unit": "ips"}
+
+    return results
+
+
+def compare(results, baseline, threshold=0.10):
+    '''
+    Return list of (name, baseline value, new value) that regressed
+    by more than threshold (fraction) compared to baseline
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        old = baseline[name]["value"]
+        new = result["value"]
+        if result["unit"] in LOWER_IS_BETTER:
+            regressed = new > old * (1 + threshold)
+        else:
+            regressed = new < old * (1 - threshold)
+
+        if regressed:
+            regressions.append((name, old, new))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CHIP-8 emulator")
+    parser.add_argument("--save", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed slowdown against baseline (default: 0.10)")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--skip-rom", action="store_true")
+    parser.add_argument("--skip-startup", action="store_true")
+    parser.add_argument("--replay", nargs=2, metavar=("ROM", "RECORDING"),
+                        help="also replay input recorded by c8.py --record on every engine")
+    args = parser.parse_args()
+
+    results = {}
+    if not args.skip_micro:
+        results.update(micro_benchmarks())
+    if not args.skip_rom:
+        results.update(rom_benchmarks())
+    if not args.skip_startup:
+        results.update(startup_benchmarks())
+    if args.replay:
+        from loader import read_rom
+        from replay import load
+
+        rom, recording = args.replay
+        results.update(replay_benchmarks(read_rom(rom), load(recording)))
+
+    for name, result in results.items():
+        print(f"{name:40} {result['value']:>14.1f} {result['unit']}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old:.1f} -> {new:.1f}", file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
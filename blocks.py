@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+""" Execution engine translating CHIP-8 basic blocks into Python functions """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+import re
+
+from cpu import IdleLoop, decode_opcode
+
+
+""" Longest run of instructions translated into one function """
+MAX_BLOCK_SIZE = 32
+
+"""
+Instructions translated inline, registers live in locals (v0 .. vf).
+Statement order follows CPU handlers exactly, so results stay identical
+when Vx or Vy is Vf. Anything else ends the block and runs through CPU handler.
+None of these can fault, only the final instruction of a block can.
+"""
+INLINE_TEMPLATES = {
+    "op_00e0": ("cpu.screen.clear()",),
+    "op_6xnn": ("{vx} = {nn}",),
+    "op_7xnn": ("{vx} = ({nn} + {vx}) & 0xff",),
+    "op_8xy0": ("{vx} = {vy}",),
+    "op_8xy1": ("{vx} |= {vy}",),
+    "op_8xy2": ("{vx} &= {vy}",),
+    "op_8xy3": ("{vx} ^= {vy}",),
+    "op_8xy4": ("res = {vx} + {vy}", "vf = res >> 8", "{vx} = 0xff & res"),
+    "op_8xy5": ("vf = 1 if {vx} > {vy} else 0", "{vx} = ({vx} - {vy}) & 0xff"),
+    "op_8xy6": ("vf = 0x01 & {vx}", "{vx} >>= 1"),
+    "op_8xy7": ("vf = 1 if {vy} > {vx} else 0", "{vx} = ({vy} - {vx}) & 0xff"),
+    "op_8xye": ("vf = (0x80 & {vx}) >> 7", "{vx} = ({vx} << 1) & 0xff"),
+    "op_annn": ("i = {nnn}",),
+    "op_cxnn": ("{vx} = cpu.rng.getrandbits(8) & {nn}",),
+    "op_fx07": ("{vx} = cpu.delay_timer",),
+    "op_fx15": ("cpu.delay_timer = {vx}",),
+    "op_fx18": ("cpu.sound_timer = {vx}",),
+    "op_fx1e": ("i = (i + {vx}) & 0xfff",),
+    "op_fx29": ("i = {font_addr} + 5 * (0xf & {vx})",),
+}
+
+REGISTER_NAME = re.compile(r"\bv[0-9a-f]\b")
+
+
+def translate_instruction(name, opcode, font_addr):
+    """ Python statements of one inlined instruction """
+    fields = {
+        "vx": f"v{(0x0f00 & opcode) >> 8:x}",
+        "vy": f"v{(0x00f0 & opcode) >> 4:x}",
+        "nn": 0x00ff & opcode,
+        "nnn": 0x0fff & opcode,
+        "font_addr": font_addr,
+    }
+    return [line.format(**fields) for line in INLINE_TEMPLATES[name]]
+
+
+class BlockEngine:
+    def __init__(self, cpu):
+        """
+        Translation engine working on top of an existing CPU.
+        Blocks are cached by start address as (function, instruction count)
+        """
+        self.cpu = cpu
+        self.blocks = {}
+
+        """ Address -> start addresses of blocks covering it """
+        self.owners = {}
+
+        cpu.ram.write_hooks.append(self.invalidate)
+
+    def run(self):
+        """
+        Run one basic block, return number of instructions executed.
+        The first instruction goes through CPU.run() so font gets loaded.
+        """
+        cpu = self.cpu
+        if not cpu.font_loaded or cpu.instruments:
+            cpu.run()
+            return 1
+
+        block = self.blocks.get(cpu.pc) or self.translate(cpu.pc)
+        try:
+            executed = block[0](cpu)
+        except IdleLoop:
+            executed = block[1]
+        except Exception:
+            """ Final instruction faulted, the inlined ones before it are counted """
+            cpu.cycles += block[1] - 1
+            raise
+        cpu.cycles += executed
+        return executed
+
+    def run_for(self, cycles):
+        """
+        Run the given number of instructions, return number executed.
+        A block longer than the remaining budget is single stepped by CPU,
+        so budget is never overrun and timers tick at the same instruction.
+        """
+        cpu = self.cpu
+        if cpu.instruments:
+            """ Instruments see every instruction, only the interpreter can do that """
+            return cpu.run_for(cycles)
+
+        blocks = self.blocks
+        translate = self.translate
+
+        executed = 0
+        while executed < cycles:
+            if not cpu.font_loaded:
+                cpu.run()
+                executed += 1
+                continue
+
+            block = blocks.get(cpu.pc) or translate(cpu.pc)
+            if block[1] <= cycles - executed:
+                try:
+                    count = block[0](cpu)
+                except IdleLoop as idle:
+                    """
+                    Block ended by idle loop jump, interpreter fast-forwards it.
+                    Blocks holding a jump it found busy are retranslated with a plain jump
+                    """
+                    cpu.cycles += block[1]
+                    executed += block[1]
+                    executed += cpu.run_for(cycles - executed)
+                    if idle.args[0] in cpu.busy_loops:
+                        self.invalidate(idle.args[0], 2)
+                    return executed
+
+                except Exception:
+                    cpu.cycles += block[1] - 1
+                    raise
+
+                cpu.cycles += count
+                executed += count
+            else:
+                cpu.run()
+                executed += 1
+
+        return executed
+
+    def translate(self, start):
+        """
+        Translate straight-line code starting at start into a Python function.
+        The block ends after the first instruction that can not be inlined
+        (jump, call, return, skip, draw, key, memory access, or invalid opcode).
+        Code running off the end of memory ends the block before it, so
+        the fetch faults the same way as in the interpreter.
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+
+        body = []
+        addr = start
+        count = 0
+        final_addr = None
+
+        while count < MAX_BLOCK_SIZE:
+            count += 1
+            if addr > 0xffe and count > 1:
+                count -= 1
+                break
+
+            low = ram[addr + 1]
+            opcode = (ram.peek(addr) << 8) | low
+            decoded = decode_opcode(opcode)
+            if decoded is None or decoded[0] not in INLINE_TEMPLATES:
+                final_addr = addr
+                break
+
+            body.extend(translate_instruction(decoded[0], opcode, cpu.FONT_ADDR))
+            addr += 2
+
+        next_pc = addr + 2 if final_addr is not None else addr
+        source = "\n".join(body)
+        registers = sorted(set(REGISTER_NAME.findall(source)))
+        uses_i = re.search(r"\bi\b", source) is not None
+
+        lines = ["def block(cpu):", "    v = cpu.v"]
+        if uses_i:
+            lines.append("    i = cpu.i")
+        lines += [f"    {reg} = v[0x{reg[1]}]" for reg in registers]
+        lines += [f"    {line}" for line in body]
+        lines += [f"    v[0x{reg[1]}] = {reg}" for reg in registers]
+        if uses_i:
+            lines.append("    cpu.i = i")
+        lines.append(f"    cpu.pc = 0x{next_pc:03x}")
+        if final_addr is not None:
+            lines.append("    final()")
+        lines.append(f"    return {count}")
+
+        namespace = {}
+        if final_addr is not None:
+            namespace["final"] = cpu.handler_at(final_addr)
+
+        code = compile("\n".join(lines), f"<block 0x{start:03x}>", "exec")
+        exec(code, namespace)
+
+        block = (namespace["block"], count)
+        self.blocks[start] = block
+        for covered in range(start, min(next_pc, 0x1000)):
+            self.owners.setdefault(covered, set()).add(start)
+
+        return block
+
+    def invalidate(self, address, length):
+        """ RAM write hook. Evict every block covering the written range """
+        owners = self.owners
+        if length > len(owners):
+            written = [addr for addr in owners if address <= addr < address + length]
+        else:
+            written = range(address, address + length)
+
+        for addr in written:
+            starts = owners.pop(addr, None)
+            if starts:
+                for start in starts:
+                    self.blocks.pop(start, None)
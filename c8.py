@@ -6,56 +6,232 @@ __author__  = "Rosyid Haryadi"
 __license__ = "GPLv3"
 
 
+import argparse
+import contextlib
+import random
 import sys
-import pygame
+import time
 
+import backends
+from blocks import BlockEngine
 from cpu import CPU
+from errors import EmulatorFault
 from ram import RAM
-from keyboard import Keyboard
-from screen import Screen
+from loader import load_rom, read_rom
+from scheduler import FRAME_RATE, FrameClock, Scheduler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CHIP-8 emulator")
+    parser.add_argument("rom", help="CHIP-8 ROM file, or archive.zip:NAME")
+    parser.add_argument("--backend", choices=tuple(backends.BACKENDS), default="pygame",
+                        help="display and input frontend, headless runs without a window")
+    parser.add_argument("--engine", choices=("interpreter", "block"), default="interpreter",
+                        help="execute instruction by instruction, or translated basic blocks")
+    parser.add_argument("--ips", type=int, default=700,
+                        help="emulated instructions per second (default: 700)")
+    parser.add_argument("--turbo", action="store_true",
+                        help="run as fast as the host allows and report achieved speed")
+    parser.add_argument("--renderer", choices=("rect", "array"), default="rect",
+                        help="fill changed pixels, or convert whole frames with NumPy")
+    parser.add_argument("--scale", type=float, default=10,
+                        help="screen pixels per CHIP-8 pixel (default: 10)")
+    parser.add_argument("--decay", type=float, default=0.0,
+                        help="phosphor ghosting of array renderer, brightness kept per frame in [0, 1)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="profile execution, write JSON (or folded stacks if PATH ends with .folded)")
+    parser.add_argument("--warm", action="store_true",
+                        help="predecode instructions found by static analysis (cached per ROM)")
+    parser.add_argument("--runtime", choices=("loop", "async"), default="loop",
+                        help="one frame loop, or asyncio tasks clocking CPU, timers and render separately")
+    parser.add_argument("--core", choices=("inline", "thread", "process"), default="inline",
+                        help="run emulation in this loop, or in a worker thread or process")
+    parser.add_argument("--seed", type=int,
+                        help="seed of the random numbers of Cxnn, for reproducible runs")
+    parser.add_argument("--record", metavar="PATH",
+                        help="record key presses per frame, replay with headless.py --replay PATH")
+    parser.add_argument("--ram-view", action="store_true",
+                        help="show memory live next to the screen, written bytes highlighted (needs numpy)")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="keep the last executed instructions, saved as NumPy .npy to PATH on a fault")
+    args = parser.parse_args()
+    if args.turbo and args.runtime == "async":
+        parser.error("--turbo needs the loop runtime")
+    if args.core != "inline" and (args.turbo or args.profile or args.runtime != "loop"):
+        parser.error("--core thread/process runs at --ips without --turbo, --profile or --runtime")
+    if args.record and (args.core != "inline" or args.runtime != "loop"):
+        parser.error("--record needs the loop runtime and inline core")
+    if args.seed is not None and args.core != "inline":
+        parser.error("--seed needs the inline core")
+    if args.ram_view and args.core != "inline":
+        parser.error("--ram-view needs the inline core")
+    if args.trace and args.core != "inline":
+        parser.error("--trace needs the inline core")
+    return args
+
+
+def run_loop(backend, scheduler, screen, keyboard, turbo, timed, profiler):
+    clock = FrameClock()
+    last_render = 0.0
+
+    running = True
+    while running:
+        ''' Take global event '''
+        with timed("events"):
+            running = backend.poll_events(keyboard)
+
+        '''
+        CPU runs one frame worth of instructions, updates RAM state
+        check keyboard input, and sends command to screen
+        '''
+        with timed("cpu"):
+            scheduler.run_frame()
+
+        if not turbo:
+            with timed("render"):
+                screen.render()
+
+            ''' Limit to 60 FPS '''
+            clock.tick(FRAME_RATE)
+
+        elif time.perf_counter() - last_render >= 1 / FRAME_RATE:
+            ''' Turbo is uncapped, only present at most 60 frames of host time '''
+            with timed("render"):
+                screen.render()
+            last_render = time.perf_counter()
+
+        if profiler:
+            profiler.end_frame()
+
+    if turbo:
+        print(f"Achieved {scheduler.achieved_ips():.0f} instructions per second")
+
+
+def run_async(backend, cpu, engine, screen, keyboard, ips, timed, profiler):
+    ''' CPU keeps its speed, render frames are dropped when presenting falls behind '''
+    from runtime import Runtime
+
+    def poll():
+        with timed("events"):
+            return backend.poll_events(keyboard)
+
+    def render():
+        with timed("render"):
+            screen.render()
+        if profiler:
+            profiler.end_frame()
+
+    runtime = Runtime()
+    instance = runtime.add(cpu, engine=engine, ips=ips, poll=poll, render=render)
+    runtime.run()
+
+    if instance.fault:
+        raise instance.fault
+
+
+def run_core(backend, args, screen, keyboard):
+    ''' Present the latest frame of a worker core, a slow display never stalls emulation '''
+    from core import EmulatorCore
+
+    core = EmulatorCore(read_rom(args.rom), ips=args.ips, engine=args.engine, mode=args.core)
+    on_key = lambda value, down: core.press(value) if down else core.release(value)
+
+    clock = FrameClock()
+    shown = 0
+    try:
+        while backend.poll_events(keyboard, on_key):
+            sequence, rows = core.latest_frame()
+            if sequence != shown:
+                screen.rows = rows
+                screen.render()
+                shown = sequence
+
+            fault = core.fault()
+            if fault:
+                raise EmulatorFault(fault)
+
+            clock.tick(FRAME_RATE)
+    finally:
+        core.stop()
 
 
 def main():
+    args = parse_args()
+
+    ''' Frontend and optional features are imported only when used, for fast startup '''
+    backend = backends.load(args.backend)
     ram = RAM()
-    screen = Screen()
-    keyboard = Keyboard()
+    screen = backend.screen(px_scale=args.scale, renderer=args.renderer, decay=args.decay,
+                            ram=ram if args.ram_view else None)
+    keyboard = backend.keyboard()
 
-    cpu = CPU(ram=ram, screen=screen, keyboard=keyboard)
+    if args.core != "inline":
+        run_core(backend, args, screen, keyboard)
+        return
 
-    rom_file_name = sys.argv[1]
-    load_rom(rom_file_name, ram)
+    ''' A recording needs a known seed to be replayed, pick one if none given '''
+    seed = args.seed
+    if seed is None and args.record:
+        seed = random.getrandbits(64)
 
-    clock = pygame.time.Clock()
+    cpu = CPU(ram=ram, screen=screen, keyboard=keyboard, seed=seed)
 
-    running = True
-    while running:
-        ''' Take global event '''
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            elif (event.type == pygame.KEYDOWN) or (event.type == pygame.KEYUP):
-                keyboard.set_event(event)
+    image = load_rom(ram, args.rom)
 
-        '''
-        CPU runs instruction, updates RAM state
-        check keyboard input, and sends command to screen
-        '''
-        cpu.run()
-        screen.render()
+    engine = BlockEngine(cpu) if args.engine == "block" else cpu
+    scheduler = Scheduler(cpu, ips=args.ips, engine=engine)
+
+    recording = None
+    if args.record:
+        from replay import InputRecorder, Recording, rom_hash
+
+        recording = Recording(seed, args.ips, rom_hash(image))
+        InputRecorder(keyboard, recording).attach(scheduler)
+
+    profiler = None
+    timed = lambda name: contextlib.nullcontext()
+    if args.profile:
+        from profiler import Profiler
+
+        profiler = Profiler()
+        profiler.attach(cpu)
+        timed = profiler.section
+
+    if args.warm:
+        from analyzer import AnalysisCache, warm
+
+        warm(cpu, AnalysisCache().load(image))
+
+    tracing = contextlib.nullcontext()
+    if args.trace:
+        from tracer import Trace, dump_on_fault
 
-        ''' Limit to 60 FPS '''
-        clock.tick(60)
+        trace = Trace()
+        trace.attach(cpu)
+        tracing = dump_on_fault(trace, args.trace)
 
+    try:
+        with tracing:
+            if args.runtime == "async":
+                run_async(backend, cpu, engine, screen, keyboard, args.ips, timed, profiler)
+            else:
+                run_loop(backend, scheduler, screen, keyboard, args.turbo, timed, profiler)
+    finally:
+        ''' Also written when stopped by a fault or Ctrl-C '''
+        if recording:
+            recording.save(args.record)
 
-def load_rom(file_name, ram):
-    ''' TODO: will change later using pygame_gui '''
-    addr = 0x200
-    with open(file_name, 'rb') as f:
-        byte = f.read(1)
-        while byte:
-            ram[addr] = byte
-            addr += 0x1
+        if profiler:
+            with open(args.profile, 'w') as f:
+                if args.profile.endswith(".folded"):
+                    profiler.write_folded(f)
+                else:
+                    profiler.write_json(f)
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except EmulatorFault as fault:
+        print(fault, file=sys.stderr)
+        sys.exit(1)
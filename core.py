@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+""" Emulation core in a worker thread or process, talking through shared memory """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+from multiprocessing import shared_memory
+import multiprocessing
+import struct
+import threading
+import time
+
+from errors import EmulatorFault
+from headless import HeadlessMachine
+from savestate import ROWS
+from scheduler import FRAME_RATE
+
+
+""" Commands passed from display to core """
+KEY_DOWN = 1
+KEY_UP = 2
+PAUSE = 3
+RESUME = 4
+RESET = 5
+LOAD_ROM = 6
+STOP = 7
+
+
+class FrameExchange:
+    """
+    Header: sequence of the last complete frame, sequence being written.
+    Frame n is stored in buffer n % 2, fault message length and text follow.
+    """
+    HEADER = struct.Struct("<QQ")
+    FAULT = struct.Struct("<H")
+    FAULT_SIZE = 256
+
+    def __init__(self, name=None):
+        """
+        Double buffered framebuffer in shared memory, one writer (core)
+        and any number of readers that never wait for the writer.
+        Created when name is None, attached to otherwise.
+        """
+        size = self.HEADER.size + 2 * ROWS.size + self.FAULT.size + self.FAULT_SIZE
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.sequence = 0
+
+    def offset(self, sequence):
+        return self.HEADER.size + (sequence % 2) * ROWS.size
+
+    def publish(self, rows):
+        """ Write frame into the buffer readers are not using, then make it the latest """
+        sequence = self.sequence + 1
+        self.HEADER.pack_into(self.buf, 0, self.sequence, sequence)
+        ROWS.pack_into(self.buf, self.offset(sequence), *rows)
+        self.HEADER.pack_into(self.buf, 0, sequence, sequence)
+        self.sequence = sequence
+
+    def latest(self):
+        """
+        (sequence, rows) of the latest complete frame, (0, None) before the first one.
+        A frame overwritten while being copied is read again from the newer buffer.
+        """
+        while True:
+            published, _ = self.HEADER.unpack_from(self.buf)
+            if not published:
+                return 0, None
+
+            rows = ROWS.unpack_from(self.buf, self.offset(published))
+            _, writing = self.HEADER.unpack_from(self.buf)
+            if writing <= published + 1:
+                return published, list(rows)
+
+    def set_fault(self, message):
+        """ Empty message clears the fault """
+        data = message.encode()[:self.FAULT_SIZE]
+        start = self.HEADER.size + 2 * ROWS.size
+        self.buf[start + self.FAULT.size:start + self.FAULT.size + len(data)] = data
+        self.FAULT.pack_into(self.buf, start, len(data))
+
+    def fault(self):
+        """ Message of the fault that stopped the core, None while running fine """
+        start = self.HEADER.size + 2 * ROWS.size
+        length, = self.FAULT.unpack_from(self.buf, start)
+        if not length:
+            return None
+
+        start += self.FAULT.size
+        return bytes(self.buf[start:start + length]).decode()
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class CommandRing:
+    """ Write and read positions, each only ever written by one side, then capacity """
+    HEADER = struct.Struct("<QQQ")
+
+    """ Message: command, payload length, then payload """
+    MESSAGE = struct.Struct("<BH")
+
+    def __init__(self, capacity=8192, name=None):
+        """
+        Single producer, single consumer byte ring in shared memory.
+        Positions only grow, so no lock is needed: the producer publishes
+        a message by moving the write position after the message is written.
+        """
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None,
+                                              size=self.HEADER.size + capacity)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        if name is None:
+            self.HEADER.pack_into(self.buf, 0, 0, 0, capacity)
+        self.capacity = self.HEADER.unpack_from(self.buf)[2]
+
+    def put(self, command, payload=b""):
+        """ Append a message, return False if the ring is full """
+        message = self.MESSAGE.pack(command, len(payload)) + bytes(payload)
+        head, tail, _ = self.HEADER.unpack_from(self.buf)
+        if len(message) > self.capacity - (head - tail):
+            return False
+
+        self.copy_in(head, message)
+        struct.pack_into("<Q", self.buf, 0, head + len(message))
+        return True
+
+    def get(self):
+        """ Oldest message as (command, payload), None if the ring is empty """
+        head, tail, _ = self.HEADER.unpack_from(self.buf)
+        if head == tail:
+            return None
+
+        command, length = self.MESSAGE.unpack(self.copy_out(tail, self.MESSAGE.size))
+        payload = self.copy_out(tail + self.MESSAGE.size, length)
+        struct.pack_into("<Q", self.buf, 8, tail + self.MESSAGE.size + length)
+        return command, payload
+
+    def copy_in(self, position, data):
+        start = self.HEADER.size + position % self.capacity
+        first = min(len(data), self.HEADER.size + self.capacity - start)
+        self.buf[start:start + first] = data[:first]
+        self.buf[self.HEADER.size:self.HEADER.size + len(data) - first] = data[first:]
+
+    def copy_out(self, position, length):
+        start = self.HEADER.size + position % self.capacity
+        first = min(length, self.HEADER.size + self.capacity - start)
+        return (bytes(self.buf[start:start + first])
+                + bytes(self.buf[self.HEADER.size:self.HEADER.size + length - first]))
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class Core:
+    def __init__(self, frames, commands, rom=b"", ips=700, engine="interpreter"):
+        """ Headless machine publishing a frame every 60 Hz tick, commands applied between frames """
+        self.frames = frames
+        self.commands = commands
+        self.rom = rom
+        self.ips = ips
+        self.engine = engine
+
+        self.running = True
+        self.reset()
+
+    def reset(self):
+        """ Fresh machine running the current ROM, also resumes a core stopped by a fault """
+        self.machine = HeadlessMachine(self.rom, ips=self.ips, engine=self.engine)
+        self.frames.set_fault("")
+        self.paused = False
+
+    def apply(self, command, payload):
+        keyboard = self.machine.keyboard
+        if command == KEY_DOWN:
+            keyboard.press(payload[0])
+        elif command == KEY_UP:
+            keyboard.release(payload[0])
+        elif command == PAUSE:
+            self.paused = True
+        elif command == RESUME:
+            self.paused = False
+        elif command == RESET:
+            self.reset()
+        elif command == LOAD_ROM:
+            self.rom = bytes(payload)
+            self.reset()
+        elif command == STOP:
+            self.running = False
+
+    def run(self):
+        """ Steady 60 Hz of host time, falls behind only if emulation itself is too slow """
+        period = 1 / FRAME_RATE
+        deadline = time.perf_counter()
+        while self.running:
+            message = self.commands.get()
+            while message is not None:
+                self.apply(*message)
+                message = self.commands.get()
+
+            if not self.paused:
+                try:
+                    self.machine.scheduler.run_frame()
+                except EmulatorFault as fault:
+                    self.frames.set_fault(str(fault))
+                    self.paused = True
+
+                self.frames.publish(self.machine.screen.rows)
+
+            deadline = max(deadline + period, time.perf_counter() - period)
+            time.sleep(max(deadline - time.perf_counter(), 0))
+
+
+def serve_core(frame_name, command_name, rom, ips, engine):
+    """ Worker entry point, attaches to shared memory created by EmulatorCore """
+    frames = FrameExchange(frame_name)
+    commands = CommandRing(name=command_name)
+    try:
+        Core(frames, commands, rom, ips, engine).run()
+    finally:
+        frames.close()
+        commands.close()
+
+
+class EmulatorCore:
+    def __init__(self, rom=b"", ips=700, engine="interpreter", mode="thread"):
+        """
+        Display side handle of a core running in a worker thread or process.
+        Nothing here waits for the core: commands are queued in the ring,
+        latest_frame() returns the last complete frame.
+        """
+        self.frames = FrameExchange()
+        self.commands = CommandRing()
+
+        worker = multiprocessing.Process if mode == "process" else threading.Thread
+        self.worker = worker(target=serve_core, daemon=True,
+                             args=(self.frames.name, self.commands.name, bytes(rom), ips, engine))
+        self.worker.start()
+
+    def send(self, command, payload=b""):
+        if not self.commands.put(command, payload):
+            raise BufferError("Command ring is full")
+
+    def press(self, value):
+        self.send(KEY_DOWN, bytes([value]))
+
+    def release(self, value):
+        self.send(KEY_UP, bytes([value]))
+
+    def pause(self):
+        self.send(PAUSE)
+
+    def resume(self):
+        self.send(RESUME)
+
+    def reset(self):
+        self.send(RESET)
+
+    def load_rom(self, rom):
+        self.send(LOAD_ROM, rom)
+
+    def latest_frame(self):
+        return self.frames.latest()
+
+    def fault(self):
+        return self.frames.fault()
+
+    def stop(self):
+        """ Stop the worker and free shared memory """
+        self.send(STOP)
+        self.worker.join()
+        self.frames.close()
+        self.commands.close()
+        self.frames.unlink()
+        self.commands.unlink()
@@ -5,16 +5,159 @@
 __author__ = "Rosyid Haryadi"
 __license__ = "GPLv3"
 
-from random import randint
-import sys
+from array import array
+from functools import partial
+import random
+
+from errors import InvalidOpcode, StackFault
+from scheduler import FRAME_RATE
+
+
+"""
+CHIP-8 instruction set as (mask, pattern, handler name, operand names).
+An opcode belongs to an instruction when (opcode & mask) == pattern.
+"""
+INSTRUCTION_SET = (
+    (0xffff, 0x00e0, "op_00e0", ()),
+    (0xffff, 0x00ee, "op_00ee", ()),
+    (0xf000, 0x1000, "op_1nnn", ("nnn",)),
+    (0xf000, 0x2000, "op_2nnn", ("nnn",)),
+    (0xf000, 0x3000, "op_3xnn", ("x", "nn")),
+    (0xf000, 0x4000, "op_4xnn", ("x", "nn")),
+    (0xf00f, 0x5000, "op_5xy0", ("x", "y")),
+    (0xf000, 0x6000, "op_6xnn", ("x", "nn")),
+    (0xf000, 0x7000, "op_7xnn", ("x", "nn")),
+    (0xf00f, 0x8000, "op_8xy0", ("x", "y")),
+    (0xf00f, 0x8001, "op_8xy1", ("x", "y")),
+    (0xf00f, 0x8002, "op_8xy2", ("x", "y")),
+    (0xf00f, 0x8003, "op_8xy3", ("x", "y")),
+    (0xf00f, 0x8004, "op_8xy4", ("x", "y")),
+    (0xf00f, 0x8005, "op_8xy5", ("x", "y")),
+    (0xf00f, 0x8006, "op_8xy6", ("x", "y")),
+    (0xf00f, 0x8007, "op_8xy7", ("x", "y")),
+    (0xf00f, 0x800e, "op_8xye", ("x", "y")),
+    (0xf00f, 0x9000, "op_9xy0", ("x", "y")),
+    (0xf000, 0xa000, "op_annn", ("nnn",)),
+    (0xf000, 0xb000, "op_bnnn", ("nnn",)),
+    (0xf000, 0xc000, "op_cxnn", ("x", "nn")),
+    (0xf000, 0xd000, "op_dxyn", ("x", "y", "n")),
+    (0xf0ff, 0xe09e, "op_ex9e", ("x",)),
+    (0xf0ff, 0xe0a1, "op_exa1", ("x",)),
+    (0xf0ff, 0xf007, "op_fx07", ("x",)),
+    (0xf0ff, 0xf00a, "op_fx0a", ("x",)),
+    (0xf0ff, 0xf015, "op_fx15", ("x",)),
+    (0xf0ff, 0xf018, "op_fx18", ("x",)),
+    (0xf0ff, 0xf01e, "op_fx1e", ("x",)),
+    (0xf0ff, 0xf029, "op_fx29", ("x",)),
+    (0xf0ff, 0xf033, "op_fx33", ("x",)),
+    (0xf0ff, 0xf055, "op_fx55", ("x",)),
+    (0xf0ff, 0xf065, "op_fx65", ("x",)),
+)
+
+""" Operand extraction from 16-bit opcode """
+OPERAND_FIELDS = {
+    "x": lambda opcode: (0x0f00 & opcode) >> 8,
+    "y": lambda opcode: (0x00f0 & opcode) >> 4,
+    "n": lambda opcode: 0x000f & opcode,
+    "nn": lambda opcode: 0x00ff & opcode,
+    "nnn": lambda opcode: 0x0fff & opcode,
+}
+
+
+"""
+Instructions that only read memory, timers or keys and only write registers.
+A loop made of these can not change anything until timers or keys change.
+"""
+IDLE_SAFE = {
+    "op_3xnn", "op_4xnn", "op_5xy0", "op_6xnn", "op_7xnn",
+    "op_8xy0", "op_8xy1", "op_8xy2", "op_8xy3", "op_8xy4",
+    "op_8xy5", "op_8xy6", "op_8xy7", "op_8xye", "op_9xy0",
+    "op_annn", "op_ex9e", "op_exa1", "op_fx07", "op_fx1e",
+    "op_fx29", "op_fx65",
+}
+
+""" Longest loop body (in instructions) checked for idling """
+MAX_IDLE_LOOP = 8
+
+""" Skips, the only way out of an idle loop is a skip right before its closing jump """
+SKIPS = {"op_3xnn", "op_4xnn", "op_5xy0", "op_9xy0", "op_ex9e", "op_exa1"}
+
+""" Iterations changing registers before a candidate loop is treated as busy """
+MAX_IDLE_MISSES = 2
+
+""" Instructions that can change V registers or memory, the only ones watchpoints check """
+REGISTER_WRITES = {
+    "op_6xnn", "op_7xnn", "op_8xy0", "op_8xy1", "op_8xy2",
+    "op_8xy3", "op_8xy4", "op_8xy5", "op_8xy6", "op_8xy7",
+    "op_8xye", "op_cxnn", "op_dxyn", "op_fx07", "op_fx0a",
+    "op_fx65",
+}
+MEMORY_WRITES = {"op_fx33", "op_fx55"}
+
+""" Instructions per run_for call of run_until when timers do not tick """
+RUN_UNTIL_CHUNK = 4096
+
+
+class IdleLoop(Exception):
+    """
+    Raised by a backward jump closing a possibly idle loop, caught by run loops.
+    Argument is address of the jump.
+    """
+    pass
+
+
+class KeyWait(IdleLoop):
+    """
+    Raised by Fx0A while no key was pressed. Keys only change between
+    run_for calls, so the run loop spends the rest of its budget waiting.
+    """
+    pass
+
+
+class Break(Exception):
+    """
+    Raised by debugger checks to end run_for early, caught by run loops.
+    Arguments are reason, detail (address or register) and whether the
+    instruction was executed: breakpoints stop before, watchpoints after it.
+    """
+    pass
+
+
+def decode_opcode(opcode):
+    """
+    Decode opcode into (handler name, operand values).
+    Return None if opcode is invalid
+    """
+    for mask, pattern, handler, operands in INSTRUCTION_SET:
+        if (opcode & mask) == pattern:
+            return handler, tuple(OPERAND_FIELDS[name](opcode) for name in operands)
+
+    return None
 
 
 class CPU:
-    def __init__(self, ram=None, screen=None, keyboard=None):
+    """ Font sprites location in RAM """
+    FONT_ADDR = 0x050
+
+    """ Return addresses the stack holds """
+    STACK_DEPTH = 16
+
+    """ Fixed attribute layout: faster attribute access, smaller instances """
+    __slots__ = (
+        "ram", "screen", "keyboard", "pc", "i", "stack", "sp",
+        "delay_timer", "sound_timer", "v", "font_loaded", "rng", "cycles",
+        "decode_cache", "code_cache", "instruments",
+        "idle_detection", "idle_loops", "busy_loops", "idle_exits", "waiting_key",
+        "breakpoints", "memory_watches", "register_watches", "watch_hits",
+        "run_target", "run_predicate", "resume_at", "break_reason",
+    )
+
+    def __init__(self, ram=None, screen=None, keyboard=None, seed=None):
         """
         CPU initialization of devices instance that will be used
         program counter, index register, stack memory,
-        timers, and general purpose registers
+        timers, and general purpose registers.
+        Same seed gives the same random numbers, for reproducible runs
         """
 
         """ Connect to RAM """
@@ -37,18 +180,77 @@ class CPU:
         """ Index register """
         self.i = 0x0
 
-        """ Stack """
-        self.stack = list()
+        """ Stack of return addresses, sp is the number of entries in use """
+        self.stack = array('H', bytes(2 * self.STACK_DEPTH))
+        self.sp = 0
 
         """ Timers """
         self.delay_timer = 0
         self.sound_timer = 0
 
-        """ 16 of 8-bit General purpose registers """
+        """
+        16 of 8-bit General purpose registers, always ints 0 - 255 (VF too).
+        A list, not a bytearray: CPython indexes lists faster in the hot loop
+        """
         self.v = [0x0] * 16
 
         self.font_loaded = False
 
+        """ Random numbers of Cxnn, one generator per machine """
+        self.rng = random.Random(seed)
+
+        """ Number of instructions executed so far """
+        self.cycles = 0
+
+        """
+        Decode caches. decode_cache maps an opcode value to its handler
+        with operands already bound, code_cache maps a memory address to
+        the handler of the instruction stored there. code_cache goes stale
+        when a program overwrites itself, so RAM tells us about every write.
+        """
+        self.decode_cache = {}
+        self.code_cache = {}
+
+        """
+        Instruments wrap handlers when they enter code_cache,
+        called as wrap(address, opcode, handler) -> handler.
+        Without instruments the dispatch loop runs plain handlers.
+        """
+        self.instruments = []
+
+        """
+        Spin loops (jump to self, polling delay timer or keys) are fast-forwarded.
+        idle_loops maps address of the closing jump to [loop start, misses],
+        busy_loops holds candidates that kept changing registers (jump -> loop start).
+        idle_exits counts skips leaving a loop, iterations are only compared
+        when no code outside the loop ran between them.
+        """
+        self.idle_detection = True
+        self.idle_loops = {}
+        self.busy_loops = {}
+        self.idle_exits = 0
+
+        """ True while Fx0A waits for a key press """
+        self.waiting_key = False
+
+        """
+        Debugger, see run_until(). breakpoints maps address to condition(cpu)
+        or None, watched memory ranges are [start, end). Checks are wrapped
+        only around handlers that can trigger them, nothing while none is set.
+        break_reason is (reason, detail) of the last Break caught by run_for.
+        """
+        self.breakpoints = {}
+        self.memory_watches = []
+        self.register_watches = set()
+        self.watch_hits = []
+        self.run_target = None
+        self.run_predicate = None
+        self.resume_at = None
+        self.break_reason = None
+
+        if ram is not None:
+            ram.write_hooks.append(self.invalidate_code)
+
     def run(self):
         """
         Run CPU at one tick clock. Loop is managed by main file (c8.py)
@@ -58,8 +260,82 @@ class CPU:
             self.load_font()
             self.font_loaded = True
 
-        opcode = self.fetch()
-        self.execute(opcode)
+        pc = self.pc
+        handler = self.code_cache.get(pc) or self.handler_at(pc)
+        self.pc = pc + 2
+        try:
+            handler()
+        except IdleLoop:
+            pass
+        self.cycles += 1
+
+    def run_for(self, cycles):
+        """
+        Run the given number of instructions in one go,
+        return number of instructions executed
+        """
+        if not self.font_loaded:
+            self.load_font()
+            self.font_loaded = True
+
+        code_cache = self.code_cache
+        handler_at = self.handler_at
+
+        done = 0
+        idle_mark = None
+        try:
+            while True:
+                try:
+                    for done in range(done, cycles):
+                        pc = self.pc
+                        handler = code_cache.get(pc) or handler_at(pc)
+                        self.pc = pc + 2
+                        handler()
+
+                    done = cycles
+                    break
+
+                except KeyWait:
+                    """ Waiting instruction is executed again for every cycle left """
+                    done = cycles
+                    break
+
+                except Break as stop:
+                    reason, detail, executed = stop.args
+                    done += executed
+                    self.break_reason = (reason, detail)
+                    break
+
+                except IdleLoop as idle:
+                    """
+                    Loop start reached again. If one iteration brought registers
+                    back to the same values, every further iteration would too
+                    (timers and keys only change between run_for calls),
+                    so whole iterations left in the budget are skipped.
+                    """
+                    done += 1
+                    mark = (idle.args[0], self.idle_exits, self.i, tuple(self.v))
+                    if idle_mark is not None and idle_mark[0][:2] == mark[:2]:
+                        if idle_mark[0] == mark:
+                            period = done - idle_mark[1]
+                            done += (cycles - done) // period * period
+                        else:
+                            self.idle_miss(mark[0])
+
+                    idle_mark = (mark, done)
+        finally:
+            """ Faulting instruction is not counted """
+            self.cycles += done
+
+        return done
+
+    def tick_timers(self):
+        """ Decrement delay and sound timers, must be called at 60 Hz """
+        if self.delay_timer > 0:
+            self.delay_timer -= 1
+
+        if self.sound_timer > 0:
+            self.sound_timer -= 1
 
     def load_font(self):
         """
@@ -86,239 +362,547 @@ class CPU:
             0xF0, 0x80, 0xF0, 0x80, 0x80,  # F
         ]
 
-        start_font_addr = 0x050
-        self.ram.bulk_write(start_font_addr, FONT)
+        self.ram.bulk_write(self.FONT_ADDR, FONT)
 
     def fetch(self):
         """
         Read the instruction that PC is currently pointing at from memory.
         An instruction is two bytes.
         """
-        opcode = (self.ram[self.pc] << 8) | self.ram[self.pc + 1]
+        ram = self.ram
+        low = ram[self.pc + 1]
+        opcode = (ram.peek(self.pc) << 8) | low
         self.pc += 2
         return opcode
 
-    def execute(self, opcode):
+    def decode(self, opcode):
+        """
+        Turn opcode into a ready-to-call handler with its operands bound.
+        Built once per opcode value, None if the opcode is invalid.
+        """
+        try:
+            return self.decode_cache[opcode]
+        except KeyError:
+            pass
+
+        decoded = decode_opcode(opcode)
+        if decoded is None:
+            handler = None
+        else:
+            name, operands = decoded
+            method = getattr(self, name)
+            handler = partial(method, *operands) if operands else method
+
+        self.decode_cache[opcode] = handler
+        return handler
+
+    def handler_at(self, address):
+        """ Handler of the instruction at address, predecoded once per address """
+        handler = self.code_cache.get(address)
+        if handler is None:
+            """ Checking the second byte is enough, addresses are never negative """
+            ram = self.ram
+            low = ram[address + 1]
+            opcode = (ram.peek(address) << 8) | low
+            handler = self.decode(opcode) or partial(self.invalid_opcode, opcode)
+            if (0xf000 & opcode) == 0x1000 and self.is_idle_loop(address, 0x0fff & opcode):
+                handler = partial(self.op_1nnn_idle, address, 0x0fff & opcode)
+                self.idle_loops[address] = [0x0fff & opcode, 0]
+                if self.is_skip(address - 2):
+                    """ Skip before the jump is rebuilt to count loop exits """
+                    self.code_cache.pop(address - 2, None)
+            elif address + 2 in self.idle_loops and self.is_skip(address):
+                handler = partial(self.op_skip_idle_exit, handler, address + 4)
+            for wrap in self.instruments:
+                handler = wrap(address, opcode, handler)
+            self.code_cache[address] = handler
+
+        return handler
+
+    def is_idle_loop(self, address, target):
+        """
+        True if jump at address closes a short loop from target
+        made only of IDLE_SAFE instructions
         """
-        Choosing function to execute opcode based on its class (first two bits)
-        """
-        opcode_type = 0xf000 & opcode
-        OPCODE_TYPE_MAP = {
-            0x0000: self.op_0,
-            0x1000: self.op_1,
-            0x2000: self.op_2,
-            0X3000: self.op_3,
-            0x4000: self.op_4,
-            0x5000: self.op_5,
-            0x6000: self.op_6,
-            0x7000: self.op_7,
-            0x8000: self.op_8,
-            0x9000: self.op_9,
-            0xa000: self.op_a,
-            0xb000: self.op_b,
-            0xc000: self.op_c,
-            0xd000: self.op_d,
-            0xe000: self.op_e,
-            0xf000: self.op_f
-        }
-
-        """
-        Execute opcode with argument of the last 12 bits of the opcode
-        because we don't need the first 4 bits anyway.
-        op_x will return false if the code is invalid, true otherwise.
-        so, check the validity, and raise exception if it's not.
-        """
-        exe_status = OPCODE_TYPE_MAP[opcode_type](0x0fff & opcode)
-
-        if not exe_status:
-            print(f"Invalid opcode: {opcode} at {self.pc - 2}")
-            sys.exit(1)
+        if not self.idle_detection or address in self.busy_loops:
+            return False
 
-    def op_0(self, arg):
-        if arg == 0x0e0:
-            """ 0x00e0: CLS: Clear screen """
-            self.screen.clear()
+        if not 0 <= address - target <= 2 * MAX_IDLE_LOOP:
+            return False
 
-        elif arg == 0x0ee:
-            """ 0x00ee: RET: Return from subroutine """
-            self.pc = self.stack.pop()
+        """ Loop body lies below the jump, which was read already """
+        peek = self.ram.peek
+        for addr in range(target, address, 2):
+            decoded = decode_opcode((peek(addr) << 8) | peek(addr + 1))
+            if decoded is None or decoded[0] not in IDLE_SAFE:
+                return False
+
+        return True
 
+    def is_skip(self, address):
+        """ True if instruction at address, right before one already read, is a conditional skip """
+        if address < 0:
+            return False
+
+        peek = self.ram.peek
+        decoded = decode_opcode((peek(address) << 8) | peek(address + 1))
+        return decoded is not None and decoded[0] in SKIPS
+
+    def idle_miss(self, address):
+        """ Loop closed by jump at address changed registers, demote it once it keeps doing so """
+        loop = self.idle_loops.get(address)
+        if loop is None:
+            return
+
+        loop[1] += 1
+        if loop[1] >= MAX_IDLE_MISSES:
+            del self.idle_loops[address]
+            self.busy_loops[address] = loop[0]
+            self.code_cache.pop(address, None)
+            if self.is_skip(address - 2):
+                self.code_cache.pop(address - 2, None)
+
+    def add_instrument(self, wrap):
+        """ Start wrapping handlers with wrap, cached handlers are rebuilt """
+        self.instruments.append(wrap)
+        self.code_cache.clear()
+
+    def remove_instrument(self, wrap):
+        """ Stop wrapping handlers with wrap, back to plain handlers """
+        self.instruments.remove(wrap)
+        self.code_cache.clear()
+
+    def invalidate_code(self, address, length):
+        """
+        RAM write hook. Drop predecoded instructions overlapping the written range,
+        an instruction starting one byte before the range is affected too.
+        """
+        code_cache = self.code_cache
+        if length > len(code_cache):
+            """ Large writes (ROM load, state restore) scan the cache instead """
+            stale = [addr for addr in code_cache if address - 1 <= addr < address + length]
         else:
+            stale = range(address - 1, address + length)
+
+        for addr in stale:
+            code_cache.pop(addr, None)
+
+        """ Loop body rewritten, the closing jump must be checked again """
+        if self.idle_loops or self.busy_loops:
+            end = address + length
+            for jump, loop in list(self.idle_loops.items()):
+                if loop[0] < end and address <= jump + 1:
+                    code_cache.pop(jump, None)
+                    del self.idle_loops[jump]
+
+            for jump, target in list(self.busy_loops.items()):
+                if target < end and address <= jump + 1:
+                    code_cache.pop(jump, None)
+                    del self.busy_loops[jump]
+
+    def set_breakpoint(self, address, condition=None):
+        """ Stop before the instruction at address, only when condition(cpu) is true if given """
+        self.breakpoints[address] = condition
+        self.update_debugger()
+
+    def clear_breakpoint(self, address):
+        self.breakpoints.pop(address, None)
+        self.update_debugger()
+
+    def watch_memory(self, address, length=1):
+        """ Stop after an instruction writing into address ... address + length - 1 """
+        self.memory_watches.append([address, address + length])
+        self.update_debugger()
+
+    def unwatch_memory(self, address, length=1):
+        self.memory_watches.remove([address, address + length])
+        self.update_debugger()
+
+    def watch_register(self, x):
+        """ Stop after an instruction changing the value of Vx """
+        self.register_watches.add(x)
+        self.update_debugger()
+
+    def unwatch_register(self, x):
+        self.register_watches.discard(x)
+        self.update_debugger()
+
+    def update_debugger(self):
+        """ Install debug checks while anything is set, remove them when nothing is """
+        active = bool(self.breakpoints or self.memory_watches or self.register_watches
+                      or self.run_target is not None or self.run_predicate)
+        if active and self.debug_wrap not in self.instruments:
+            self.add_instrument(self.debug_wrap)
+        elif not active and self.debug_wrap in self.instruments:
+            self.remove_instrument(self.debug_wrap)
+        elif active:
+            self.code_cache.clear()
+
+        hooks = self.ram.write_hooks if self.ram is not None else []
+        if self.memory_watches and self.memory_written not in hooks:
+            hooks.append(self.memory_written)
+        elif not self.memory_watches and self.memory_written in hooks:
+            hooks.remove(self.memory_written)
+
+    def memory_written(self, address, length):
+        """ RAM write hook while memory is watched, hits are reported after the instruction """
+        for start, end in self.memory_watches:
+            if start < address + length and address < end:
+                self.watch_hits.append(max(start, address))
+
+    def debug_wrap(self, address, opcode, handler):
+        """ Instrument adding only the checks this instruction can trigger """
+        decoded = decode_opcode(opcode)
+        name = decoded[0] if decoded else None
+
+        if self.register_watches and name in REGISTER_WRITES:
+            handler = self.watch_registers_of(handler)
+        if self.memory_watches and name in MEMORY_WRITES:
+            handler = self.watch_memory_of(handler)
+        if self.run_predicate:
+            handler = self.check_predicate_of(address, handler)
+
+        if address == self.run_target:
+            handler = self.break_before(address, handler, "pc", None)
+        elif address in self.breakpoints:
+            handler = self.break_before(address, handler, "breakpoint", self.breakpoints[address])
+
+        return handler
+
+    def break_before(self, address, handler, reason, condition):
+        def checked():
+            if self.resume_at == address:
+                self.resume_at = None
+            elif condition is None or condition(self):
+                self.pc = address
+                raise Break(reason, address, False)
+
+            handler()
+
+        return checked
+
+    def watch_registers_of(self, handler):
+        registers = sorted(self.register_watches)
+
+        def watched():
+            v = self.v
+            before = [v[x] for x in registers]
+            handler()
+            for x, value in zip(registers, before):
+                if v[x] != value:
+                    raise Break("register", x, True)
+
+        return watched
+
+    def watch_memory_of(self, handler):
+        hits = self.watch_hits
+
+        def watched():
+            handler()
+            if hits:
+                address = hits[0]
+                hits.clear()
+                raise Break("memory", address, True)
+
+        return watched
+
+    def check_predicate_of(self, address, handler):
+        predicate = self.run_predicate
+
+        def checked():
+            handler()
+            if predicate(self):
+                raise Break("predicate", address, True)
+
+        return checked
+
+    def step(self, n=1):
+        """ Execute n instructions, fewer if a breakpoint or watchpoint stops first """
+        return self.run_until(cycles=n)
+
+    def run_until(self, cycles=None, pc=None, predicate=None, ips=None):
+        """
+        Debugger run. Stop after cycles instructions, before the instruction
+        at pc, after the first instruction making predicate(cpu) true,
+        at a breakpoint, or after an instruction changing a watched address
+        or register. A breakpoint at the current pc does not stop again.
+        Timers tick every ips / 60 instructions if ips is given.
+        Predicates are checked after every instruction and turn off idle loop
+        fast-forward, everything else costs nothing where it can not trigger.
+        Return (reason, detail): ("cycles", None), ("pc", address),
+        ("breakpoint", address), ("memory", address), ("register", x),
+        ("predicate", address), or ("key", address) if Fx0A waits for a key.
+        """
+        idle_detection = self.idle_detection
+        if predicate is not None:
+            self.idle_detection = False
+
+        self.run_target = pc
+        self.run_predicate = predicate
+        self.update_debugger()
+
+        self.break_reason = None
+        self.watch_hits.clear()
+        if self.pc in self.breakpoints or self.pc == pc:
+            self.resume_at = self.pc
+
+        left = cycles
+        tick_in = carry = 0
+        try:
+            while left is None or left > 0:
+                if ips and not tick_in:
+                    tick_in, carry = divmod(ips + carry, FRAME_RATE)
+
+                budget = tick_in if ips else RUN_UNTIL_CHUNK
+                if left is not None:
+                    budget = min(budget, left)
+
+                executed = self.run_for(budget)
+                if left is not None:
+                    left -= executed
+                if ips:
+                    tick_in -= executed
+                    if not tick_in:
+                        self.tick_timers()
+
+                if self.break_reason is not None:
+                    return self.break_reason
+                if self.waiting_key:
+                    return ("key", self.pc)
+
+            return ("cycles", None)
+        finally:
+            self.run_target = None
+            self.run_predicate = None
+            self.resume_at = None
+            self.idle_detection = idle_detection
+            self.update_debugger()
+
+    def execute(self, opcode):
+        """ Execute a fetched opcode, raise InvalidOpcode if it is invalid """
+        handler = self.decode(opcode)
+        if handler is None:
+            self.invalid_opcode(opcode)
+
+        handler()
+
+    def invalid_opcode(self, opcode):
+        raise InvalidOpcode(f"Invalid opcode: {opcode:#06x} at {self.pc - 2:#05x}")
+
+    def dispatch(self, opcode):
+        """
+        Execute opcode through the decode cache.
+        Return false if the code is invalid, true otherwise.
+        """
+        handler = self.decode(opcode)
+        if handler is None:
             return False
 
+        handler()
         return True
 
+    """
+    Opcode class entry points, argument is the last 12 bits of the opcode
+    because we don't need the first 4 bits anyway.
+    """
+
+    def op_0(self, arg):
+        return self.dispatch(0x0000 | arg)
+
     def op_1(self, arg):
+        return self.dispatch(0x1000 | arg)
+
+    def op_2(self, arg):
+        return self.dispatch(0x2000 | arg)
+
+    def op_3(self, arg):
+        return self.dispatch(0x3000 | arg)
+
+    def op_4(self, arg):
+        return self.dispatch(0x4000 | arg)
+
+    def op_5(self, arg):
+        return self.dispatch(0x5000 | arg)
+
+    def op_6(self, arg):
+        return self.dispatch(0x6000 | arg)
+
+    def op_7(self, arg):
+        return self.dispatch(0x7000 | arg)
+
+    def op_8(self, arg):
+        return self.dispatch(0x8000 | arg)
+
+    def op_9(self, arg):
+        return self.dispatch(0x9000 | arg)
+
+    def op_a(self, arg):
+        return self.dispatch(0xa000 | arg)
+
+    def op_b(self, arg):
+        return self.dispatch(0xb000 | arg)
+
+    def op_c(self, arg):
+        return self.dispatch(0xc000 | arg)
+
+    def op_d(self, arg):
+        return self.dispatch(0xd000 | arg)
+
+    def op_e(self, arg):
+        return self.dispatch(0xe000 | arg)
+
+    def op_f(self, arg):
+        return self.dispatch(0xf000 | arg)
+
+    """ Instruction handlers, operands are decoded by decode() """
+
+    def op_00e0(self):
+        """ 0x00e0: CLS: Clear screen """
+        self.screen.clear()
+
+    def op_00ee(self):
+        """ 0x00ee: RET: Return from subroutine """
+        if not self.sp:
+            raise StackFault(f"Stack underflow at {self.pc - 2:#05x}")
+
+        self.sp -= 1
+        self.pc = self.stack[self.sp]
+
+    def op_1nnn(self, nnn):
         """ 0x1nnn: JP nnn: Jump to address 0xnnn """
-        self.pc = arg
+        self.pc = nnn
 
-        return True
+    def op_1nnn_idle(self, address, nnn):
+        """ 0x1nnn closing a possible idle loop, run loop decides whether to skip """
+        self.pc = nnn
+        raise IdleLoop(address)
 
-    def op_2(self, arg):
+    def op_skip_idle_exit(self, handler, exit):
+        """ Skip right before an idle loop jump, counts skipping the jump as leaving the loop """
+        handler()
+        if self.pc == exit:
+            self.idle_exits += 1
+
+    def op_2nnn(self, nnn):
         """ 0x2nnn: CALL nnn: Call subroutine at 0xnnn """
-        self.stack.append(self.pc)
-        self.pc = arg
+        sp = self.sp
+        if sp == self.STACK_DEPTH:
+            raise StackFault(f"Stack overflow at {self.pc - 2:#05x}")
 
-        return True
+        self.stack[sp] = self.pc
+        self.sp = sp + 1
+        self.pc = nnn
 
-    def op_3(self, arg):
+    def op_3xnn(self, x, nn):
         """ 0x3xnn: SE Vx, nn: Skip if Vx = nn """
-        idx = (0xf00 & arg) >> 8
-        val = 0xff & arg
-
-        if self.v[idx] == val:
+        if self.v[x] == nn:
             self.pc += 2
 
-        return True
-
-    def op_4(self, arg):
+    def op_4xnn(self, x, nn):
         """ 0x4xnn: SNE Vx, nn: Skip if Vx != nn """
-        idx = (0xf00 & arg) >> 8
-        val = 0xff & arg
-
-        if self.v[idx] != val:
+        if self.v[x] != nn:
             self.pc += 2
 
-        return True
-
-    def op_5(self, arg):
-        if (0x00f & arg) != 0:
-            return False
-
+    def op_5xy0(self, x, y):
         """ 0x5xy0: SE Vx, Vy: Skip if Vx = Vy """
-        x_idx = (0xf00 & arg) >> 8
-        y_idx = (0x0f0 & arg) >> 4
-
-        if self.v[x_idx] == self.v[y_idx]:
+        if self.v[x] == self.v[y]:
             self.pc += 2
 
-        return True
+    def op_6xnn(self, x, nn):
+        """ 0x6xnn: LD Vx, nn: Set register Vx to 0xnn """
+        self.v[x] = nn
 
-    def op_6(self, arg):
-        """ 0x6xnn: LD Vx, nn: Set register Vx to 0xnnn """
-        idx = (0xf00 & arg) >> 8
-        val = 0x0ff & arg
+    def op_7xnn(self, x, nn):
+        """ 0x7xnn: ADD Vx, nn: Add 0xnn to register Vx """
+        v = self.v
+        v[x] = (nn + v[x]) & 0xff
 
-        self.v[idx] = val
+    def op_8xy0(self, x, y):
+        """ 0x8xy0: LD Vx, Vy: Vx is set to the value of Vy """
+        self.v[x] = self.v[y]
 
-        return True
+    def op_8xy1(self, x, y):
+        """ 0x8xy1: OR Vx, Vy: Vx is set to bitwise OR of Vx and Vy """
+        self.v[x] |= self.v[y]
 
-    def op_7(self, arg):
-        """ 0x7xnn: ADD Vx, nn: Add 0xnn to register Vx """
-        idx = (0xf00 & arg) >> 8
-        val = 0x0ff & arg
+    def op_8xy2(self, x, y):
+        """ 0x8xy2: AND Vx, Vy: Vx is set to bitwise AND of Vx and Vy """
+        self.v[x] &= self.v[y]
 
-        self.v[idx] = (val + self.v[idx]) & 0xff
+    def op_8xy3(self, x, y):
+        """ 0x8xy3: XOR Vx, Vy: Vx is set to bitwise XOR of Vx and Vy """
+        self.v[x] ^= self.v[y]
 
-        return True
+    def op_8xy4(self, x, y):
+        """
+        0x8xy4: ADD Vx, Vy: Vx is set to the value of Vx + Vy
+        if the result overflows, Vf (carry flag) is set to 1,
+        otherwise Vf is set to 0
+        """
+        v = self.v
+        res = v[x] + v[y]
+        v[0xf] = res >> 8
+        v[x] = 0xff & res  # Clipping if overflow happens
 
-    def op_8(self, arg):
-        op_subclass = 0x00f & arg
-        idx = (0xf00 & arg) >> 8
-        idy = (0x0f0 & arg) >> 4
-
-        if op_subclass == 0x0:
-            """ 0x8xy0: LD Vx, Vy: Vx is set to the value of Vy """
-            self.v[idx] = self.v[idy]
-
-        elif op_subclass == 0x1:
-            """ 0x8xy1: OR Vx, Vy: Vx is set to bitwise OR of Vx and Vy """
-            self.v[idx] |= self.v[idy]
-
-        elif op_subclass == 0x2:
-            """ 0x8xy2: AND Vx, Vy: Vx is set to bitwise AND of Vx and Vy """
-            self.v[idx] &= self.v[idy]
-
-        elif op_subclass == 0x3:
-            """ 0x8xy3: XOR Vx, Vy: Vx is set to bitwise XOR of Vx and Vy """
-            self.v[idx] ^= self.v[idy]
-
-        elif op_subclass == 0x4:
-            """
-            0x8xy4: ADD Vx, Vy: Vx is set to the value of Vx + Vy
-            if the result overflows, Vf (carry flag) is set to 1,
-            otherwise Vf is set to 0
-            """
-            res = self.v[idx] + self.v[idy]
-            self.v[0xf] = res > 0xff
-            self.v[idx] = 0xff & res  # Clipping if overflow happens
-
-        elif op_subclass == 0x5:
-            """ 
-            0x8xy5: SUB Vx, Vy: Vx is set to Vx - Vy.
-            If Vx is larger than Vy, Vf is set to 1, otherwise (underflow) Vf is 0
-            """
-            self.v[0xf] = self.v[idx] > self.v[idy]
-            self.v[idx] = (self.v[idx] - self.v[idy]) & 0xff  # Wrapping if underflow happens
-
-        elif op_subclass == 0x6:
-            """ 
-            0x8xy6: SHR Vx {, Vy}
-            Vx is set to Vy (optional), then if least significant bit of Vx
-            is 1 then Vf is set to 1, otherwise 0. Then Vx is shifted right 1 bit
-            """
-            self.v[0xf] = 0x01 & self.v[idx]
-            self.v[idx] >>= 1
-
-        elif op_subclass == 0x7:
-            """ 
-            0x8xy7: SUBN Vx, Vy: Vx is set to Vy - Vx.
-            If Vy is larger than Vx, Vf is set to 1, otherwise (underflow) Vf is 0
-            """
-            self.v[0xf] = self.v[idy] > self.v[idx]
-            self.v[idx] = (self.v[idy] - self.v[idx]) & 0xff
-
-        elif op_subclass == 0xe:
-            """
-            0x8xy2: SHL Vx, Vy
-            Vx is set to Vy (optional), then if most significant bit of Vx
-            is 1 then Vf is set to 1, otherwise 0. Then Vx is shifted left 1 bit
-            """
-            self.v[0xf] = 0x80 & self.v[idx]
-            self.v[idx] <<= 1
+    def op_8xy5(self, x, y):
+        """
+        0x8xy5: SUB Vx, Vy: Vx is set to Vx - Vy.
+        If Vx is larger than Vy, Vf is set to 1, otherwise (underflow) Vf is 0
+        """
+        v = self.v
+        v[0xf] = 1 if v[x] > v[y] else 0
+        v[x] = (v[x] - v[y]) & 0xff  # Wrapping if underflow happens
 
-        else:
-            return False
+    def op_8xy6(self, x, y):
+        """
+        0x8xy6: SHR Vx {, Vy}
+        Vx is set to Vy (optional), then if least significant bit of Vx
+        is 1 then Vf is set to 1, otherwise 0. Then Vx is shifted right 1 bit
+        """
+        v = self.v
+        v[0xf] = 0x01 & v[x]
+        v[x] >>= 1
 
-        return True
+    def op_8xy7(self, x, y):
+        """
+        0x8xy7: SUBN Vx, Vy: Vx is set to Vy - Vx.
+        If Vy is larger than Vx, Vf is set to 1, otherwise (underflow) Vf is 0
+        """
+        v = self.v
+        v[0xf] = 1 if v[y] > v[x] else 0
+        v[x] = (v[y] - v[x]) & 0xff
 
-    def op_9(self, arg):
-        if (0x00f & arg) != 0:
-            return False
+    def op_8xye(self, x, y):
+        """
+        0x8xye: SHL Vx {, Vy}
+        Vx is set to Vy (optional), then if most significant bit of Vx
+        is 1 then Vf is set to 1, otherwise 0. Then Vx is shifted left 1 bit
+        """
+        v = self.v
+        v[0xf] = (0x80 & v[x]) >> 7
+        v[x] = (v[x] << 1) & 0xff
 
+    def op_9xy0(self, x, y):
         """ 0x9xy0: SNE Vx, Vy: Skip if Vx != Vy """
-        idx = (0xf00 & arg) >> 8
-        idy = (0x0f0 & arg) >> 4
-
-        if self.v[idx] != self.v[idy]:
+        if self.v[x] != self.v[y]:
             self.pc += 2
 
-        return True
-
-    def op_a(self, arg):
+    def op_annn(self, nnn):
         """ 0xannn: LD I, nnn: Set register I to 0xnnn """
-        self.i = arg
+        self.i = nnn
 
-        return True
-
-    def op_b(self, arg):
+    def op_bnnn(self, nnn):
         """ 0xbnnn: JP V0, nnn: Jump to location nnn + V0 """
-        self.pc = arg + self.v[0]
-
-        return True
+        self.pc = nnn + self.v[0]
 
-    def op_c(self, arg):
+    def op_cxnn(self, x, nn):
         """
-        0xcxkk: RND Vx, kk
+        0xcxnn: RND Vx, nn
         Generate random number and binary AND it with nn and put the result to Vx
         """
-        idx = 0xf00 & arg
-        kk = 0x0ff & arg
-        self.v[idx] = randint(0x00, 0xff) & kk
-
-        return True
+        self.v[x] = self.rng.getrandbits(8) & nn
 
-    def op_d(self, arg):
+    def op_dxyn(self, x, y, n):
         """
         0xdxyn: DRW Vx, Vy, n
         Take (x, y) coordinate from Vx, Vy
@@ -326,60 +910,73 @@ class CPU:
         I is not incremented.
         Coordinate will wrap if it's outside the screen,
         but actual n pixel drawing does not (but is clipped)
-        Then set register Vf to 0
-        if there's a pixel that is already "on", toggle it to "off"
-        and set register Vf to 1. Ribet amat kampret.
+        Sprite pixels are XORed onto the screen, register Vf is set to 1
+        if any pixel that is already "on" is toggled "off", 0 otherwise.
+        Ribet amat kampret.
         """
-        x = self.v[(0xf00 & arg) >> 8]
-        y = self.v[(0x0f0 & arg) >> 4]
-        n = 0x00f & arg
-
-        x, y = x % 63, y % 31  # Wrapping
+        collision = self.screen.draw_sprite(self.v[x], self.v[y], self.ram.view(self.i, n))
+        self.v[0xf] = 1 if collision else 0
 
-        self.v[0xf] = 0
-
-        screen_state = self.screen.get_state()
+    def op_ex9e(self, x):
+        """ 0xex9e: SKP Vx: Skip if key in value Vx is pressed """
+        if self.keyboard.is_down(0xf & self.v[x]):
+            self.pc += 2
 
-        for row in range(0, n):
-            sprite_byte = self.ram[self.i + row]
+    def op_exa1(self, x):
+        """ 0xexa1: SKNP Vx: Skip if key in value Vx is not pressed """
+        if not self.keyboard.is_down(0xf & self.v[x]):
+            self.pc += 2
 
-            for col in range(0, 0x8):
-                """ Extract col-th bit from sprite_byte """
-                sprite_bit = (sprite_byte >> 0x7 - col) & 0x1
+    def op_fx07(self, x):
+        """ 0xfx07: LD Vx, DT: Vx is set to the value of delay timer """
+        self.v[x] = self.delay_timer
 
-                self.v[0xf] = screen_state[row + y][col + x] and sprite_bit
+    def op_fx0a(self, x):
+        """
+        0xfx0a: LD Vx, K: Wait for a key press and store its value in Vx.
+        Only a key going down after waiting began counts. Waiting is done
+        by executing this instruction again, run loops block on KeyWait.
+        """
+        if not self.waiting_key:
+            self.waiting_key = True
+            self.keyboard.wait_press()
 
-                if sprite_bit:
-                    """ there is clipping here, but I will handle it to screen """
-                    self.screen.toggle_pixel(col + x, row + y)
+        key = self.keyboard.take_press()
+        if key is None:
+            self.pc -= 2
+            raise KeyWait(self.pc)
 
-        return True
+        self.waiting_key = False
+        self.v[x] = key
 
-    def op_e(self, arg):
-        idx = 0xf00 & arg
-        op_subclass = 0x0ff & arg
-        if op_subclass == 0x9e:
-            """ 0xex9e: SKP Vx: Skip if key in value Vx is pressed """
-            if self.keyboard.is_down(0xf & self.v[idx]):
-                self.pc += 2
-
-        elif op_subclass == 0xa1:
-            """ 0xexa1: SKPN Vx: Skip if key in value Vx is not pressed """
-            if not self.keyboard.is_down(0xf & self.v[idx]):
-                self.pc += 2
+    def op_fx15(self, x):
+        """ 0xfx15: LD DT, Vx: Delay timer is set to Vx """
+        self.delay_timer = self.v[x]
 
-        else:
-            return False
+    def op_fx18(self, x):
+        """ 0xfx18: LD ST, Vx: Sound timer is set to Vx """
+        self.sound_timer = self.v[x]
 
-        return True
+    def op_fx1e(self, x):
+        """ 0xfx1e: ADD I, Vx: Add Vx to I """
+        self.i = (self.i + self.v[x]) & 0xfff
 
-    def op_f(self, arg):
-        pass
+    def op_fx29(self, x):
+        """ 0xfx29: LD F, Vx: I is set to font sprite of hex digit in Vx """
+        self.i = self.FONT_ADDR + 5 * (0xf & self.v[x])
 
+    def op_fx33(self, x):
+        """
+        0xfx33: LD B, Vx: Store BCD representation of Vx
+        hundreds at I, tens at I + 1 and ones at I + 2
+        """
+        val = self.v[x]
+        self.ram.bulk_write(self.i, (val // 100, (val // 10) % 10, val % 10))
 
-if __name__ == '__main__':
-    import unittest
-    from tests import TestCPU
+    def op_fx55(self, x):
+        """ 0xfx55: LD [I], Vx: Store V0 to Vx in memory starting at I """
+        self.ram.bulk_write(self.i, self.v[0:x + 1])
 
-    cpu_test_runner = unittest.TestLoader().loadTestsFromTestCase(TestCPU)
-    unittest.TextTestRunner(verbosity=2).run(cpu_test_runner)
+    def op_fx65(self, x):
+        """ 0xfx65: LD Vx, [I]: Read V0 to Vx from memory starting at I """
+        self.v[0:x + 1] = self.ram.view(self.i, x + 1)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+''' Faults raised by the emulated machine '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+class EmulatorFault(Exception):
+    ''' Base of every fault of the emulated machine, catchable by the host '''
+    pass
+
+
+class MemoryFault(EmulatorFault, IndexError):
+    ''' Access outside of the 4 kB address space '''
+    pass
+
+
+class StackFault(EmulatorFault):
+    ''' Call with all 16 stack levels in use, or return with none '''
+    pass
+
+
+class InvalidOpcode(EmulatorFault):
+    ''' Instruction that does not decode to any CHIP-8 instruction '''
+    pass
+
+
+class RomError(EmulatorFault):
+    ''' ROM image that can not be loaded into program memory '''
+    pass
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+""" Display state of CHIP-8, independent of any display backend """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+class FrameBuffer:
+    WIDTH = 64
+    HEIGHT = 32
+
+    """ Bits of one row, pixel x is bit (63 - x) so a row reads left to right """
+    ROW_MASK = (1 << WIDTH) - 1
+
+    """ More dirty rectangles than this are merged into their bounding box """
+    MAX_DIRTY_RECTS = 8
+
+    """ Subclasses add their own slots, headless screens stay dict free """
+    __slots__ = ("rows", "presented")
+
+    def __init__(self):
+        """ One 64-bit integer per row """
+        self.rows = None
+        self.clear()
+
+        """ Rows as they were last presented, to find what changed since """
+        self.presented = [0] * self.HEIGHT
+
+    def get_pixel(self, x, y):
+        return (self.rows[y] >> (self.WIDTH - 1 - x)) & 0x1
+
+    def draw_pixel(self, x, y, px_value):
+        bit = 1 << (self.WIDTH - 1 - x)
+        if px_value:
+            self.rows[y] |= bit
+        else:
+            self.rows[y] &= ~bit
+
+    def toggle_pixel(self, x, y):
+        """ Pixels outside the screen are clipped """
+        if 0 <= x < self.WIDTH and 0 <= y < self.HEIGHT:
+            self.draw_pixel(x, y, not self.get_pixel(x, y))
+
+    def draw_sprite(self, x, y, sprite):
+        """
+        XOR sprite rows (8 pixels wide each) at (x, y), one shift-and-XOR per row.
+        Start coordinate wraps, pixels going over the edges are clipped.
+        Return True if any pixel was turned off (collision)
+        """
+        x %= self.WIDTH
+        y %= self.HEIGHT
+        shift = self.WIDTH - 8 - x
+
+        rows = self.rows
+        collision = 0
+        for row_y, sprite_byte in zip(range(y, self.HEIGHT), sprite):
+            bits = sprite_byte << shift if shift >= 0 else sprite_byte >> -shift
+            row = rows[row_y]
+            collision |= row & bits
+            rows[row_y] = row ^ bits
+
+        return collision != 0
+
+    def get_state(self):
+        """ Boolean view of the framebuffer, list of rows of pixels """
+        return [[bool((row >> (self.WIDTH - 1 - x)) & 0x1) for x in range(self.WIDTH)]
+                for row in self.rows]
+
+    def clear(self):
+        self.rows = [0] * self.HEIGHT
+
+    def take_dirty_rects(self):
+        """
+        Rectangles (x, y, w, h) in pixels covering every pixel changed
+        since previous call, empty list if nothing changed.
+        Rows changed in overlapping spans are merged into one rectangle.
+        """
+        rects = []
+        for y, (row, presented) in enumerate(zip(self.rows, self.presented)):
+            diff = row ^ presented
+            if not diff:
+                continue
+
+            x0 = self.WIDTH - diff.bit_length()
+            x1 = self.WIDTH - (diff & -diff).bit_length()
+
+            if rects:
+                rx, ry, rw, rh = rects[-1]
+                if ry + rh == y and x0 <= rx + rw - 1 and rx <= x1:
+                    nx = min(rx, x0)
+                    rects[-1] = (nx, ry, max(rx + rw - 1, x1) - nx + 1, rh + 1)
+                    continue
+
+            rects.append((x0, y, x1 - x0 + 1, 1))
+
+        if len(rects) > self.MAX_DIRTY_RECTS:
+            left = min(rect[0] for rect in rects)
+            right = max(rect[0] + rect[2] for rect in rects)
+            top = rects[0][1]
+            bottom = rects[-1][1] + rects[-1][3]
+            rects = [(left, top, right - left, bottom - top)]
+
+        self.presented = list(self.rows)
+        return rects
+
+    def render(self):
+        """ Nothing to present without a display backend """
+        pass
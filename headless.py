@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+''' Headless backend: run CHIP-8 without pygame or SDL '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+from blocks import BlockEngine
+from cpu import CPU
+from framebuffer import FrameBuffer
+from keypad import Keypad
+from loader import PROGRAM_START, read_rom
+from ram import RAM
+from scheduler import FRAME_RATE, Scheduler
+
+
+''' Event types accepted by HeadlessKeyboard.set_event() '''
+KEYDOWN = Keypad.KEYDOWN
+KEYUP = Keypad.KEYUP
+
+
+class HeadlessScreen(FrameBuffer):
+    __slots__ = ()
+
+    def __init__(self, **display_options):
+        '''
+        Screen keeping only the framebuffer, rendering costs nothing.
+        Display options of windowed screens (px_scale, renderer...) are ignored
+        '''
+        super().__init__()
+
+
+class HeadlessKeyboard(Keypad):
+    def __init__(self):
+        '''
+        Keyboard fed by code instead of pygame events.
+        Default keymap maps host keys 0x0 - 0xf to the same CHIP-8 key
+        '''
+        super().__init__({key: key for key in range(0x10)})
+
+
+class HeadlessMachine:
+    def __init__(self, rom=b"", ips=700, engine="interpreter", seed=None):
+        '''
+        Complete CHIP-8 machine wired with headless devices, seed makes Cxnn reproducible.
+        ips below the frame rate is rejected, every frame must run at least one instruction
+        '''
+        if ips < FRAME_RATE:
+            raise ValueError(f"ips must be at least {FRAME_RATE}, got {ips}")
+
+        self.ram = RAM()
+        self.screen = HeadlessScreen()
+        self.keyboard = HeadlessKeyboard()
+        self.cpu = CPU(ram=self.ram, screen=self.screen, keyboard=self.keyboard, seed=seed)
+
+        self.engine = BlockEngine(self.cpu) if engine == "block" else self.cpu
+        self.scheduler = Scheduler(self.cpu, ips=ips, engine=self.engine)
+
+        if rom:
+            self.ram.bulk_write(PROGRAM_START, rom)
+
+
+    def run(self, cycles=None, frames=None):
+        '''
+        Run given number of frames, or cycles (instructions) at full speed.
+        Timers tick for every complete frame within cycles.
+        A frame that runs nothing (e.g. stopped at a breakpoint) ends the run early.
+        Return final framebuffer
+        '''
+        if frames is not None:
+            self.scheduler.fast_forward(frames)
+
+        if cycles is not None:
+            remaining = cycles
+            while remaining >= self.scheduler.ips // FRAME_RATE + 1:
+                executed = self.scheduler.run_frame()
+                if not executed:
+                    return self.screen.get_state()
+                remaining -= executed
+
+            self.engine.run_for(remaining)
+
+        return self.screen.get_state()
+
+
+def run_headless(file_name, cycles, **kwargs):
+    ''' Execute ROM file for cycles instructions, return final framebuffer '''
+    return HeadlessMachine(read_rom(file_name), **kwargs).run(cycles=cycles)
+
+
+def format_state(screen_state):
+    ''' Framebuffer as text, one line per row '''
+    return "\n".join("".join("#" if px else "." for px in row) for row in screen_state)
+
+
+def poll_events(keyboard, on_key=None):
+    ''' No host events without a window, keys come from code '''
+    return True
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run CHIP-8 ROM without display")
+    parser.add_argument("rom", help="CHIP-8 ROM file")
+    parser.add_argument("--cycles", type=int, default=100000, help="instructions to execute")
+    parser.add_argument("--ips", type=int, default=700)
+    parser.add_argument("--engine", choices=("interpreter", "block"), default="interpreter")
+    parser.add_argument("--seed", type=int, help="seed of the random numbers of Cxnn")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="play input recorded by c8.py --record instead of running --cycles")
+    args = parser.parse_args()
+
+    if args.replay:
+        from replay import load, replay
+
+        machine = replay(read_rom(args.rom), load(args.replay), engine=args.engine)
+    else:
+        machine = HeadlessMachine(read_rom(args.rom), ips=args.ips, engine=args.engine, seed=args.seed)
+        machine.run(cycles=args.cycles)
+
+    print(format_state(machine.screen.get_state()))
+    print(f"Achieved {machine.scheduler.achieved_ips():.0f} instructions per second")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,12 @@ __license__ = "GPLv3"
 
 import pygame
 
-class Keyboard:
+from keypad import Keypad
+
+class Keyboard(Keypad):
+    KEYDOWN = pygame.KEYDOWN
+    KEYUP = pygame.KEYUP
+
     def __init__(self):
         '''
         Mapping pygame keycode into CHIP-8 keyboard layout
@@ -23,12 +28,12 @@ class Keyboard:
         a s d f
         z x c v
         '''
-        self.KEYBOARD_MAP = {
+        super().__init__({
                 pygame.K_1: 0x1,
                 pygame.K_2: 0x2,
                 pygame.K_3: 0x3,
-                pygame.K_4: 0x4,
-                pygame.K_q: 0xc,
+                pygame.K_4: 0xc,
+                pygame.K_q: 0x4,
                 pygame.K_w: 0x5,
                 pygame.K_e: 0x6,
                 pygame.K_r: 0xd,
@@ -38,23 +43,23 @@ class Keyboard:
                 pygame.K_f: 0xe,
                 pygame.K_z: 0xa,
                 pygame.K_x: 0x0,
-                pygame.K_c: 0xc,
+                pygame.K_c: 0xb,
                 pygame.K_v: 0xf
-                }
-
-        ''' Current keyboard status (event_type, key) '''
-        self.kb_status = (None, None)
-
-
-    def set_keymap(self, keymap):
-        ''' For custom keymap '''
-        pass
+                })
 
 
-    def set_event(self, event):
-        self.kb_status(event.type, event.key)
+def poll_events(keyboard, on_key=None):
+    '''
+    Feed pygame key events to keyboard, on_key(value, down) is called for mapped keys.
+    Return False when window is closed
+    '''
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT:
+            return False
+        elif (event.type == pygame.KEYDOWN) or (event.type == pygame.KEYUP):
+            keyboard.set_event(event)
+            value = keyboard.get_key_value()
+            if on_key and value is not None:
+                on_key(value, event.type == pygame.KEYDOWN)
 
-    
-    def get_key_value(self):
-        ''' Return None when keyboard event has no value in dict '''
-        return KEYBOARD_MAP.get(self.kb_status[1])
+    return True
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+""" Hexadecimal keypad state of CHIP-8, independent of any input backend """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+class Keypad:
+    """ Event types accepted by set_event(), backends use their own values """
+    KEYDOWN = "keydown"
+    KEYUP = "keyup"
+
+    def __init__(self, keymap=None):
+        """ Host key -> CHIP-8 key value """
+        self.KEYBOARD_MAP = dict(keymap or {})
+
+        """ Last keyboard event (event_type, key) """
+        self.kb_status = (None, None)
+
+        """ Bit n is set while CHIP-8 key n is down """
+        self.mask = 0
+
+        """ Key pressed since waiting began (Fx0A), None if none yet """
+        self.pending = None
+
+        """ Presses so far, shows a release and press that left mask and pending as they were """
+        self.presses = 0
+
+    def set_keymap(self, keymap):
+        """ For custom keymap """
+        self.KEYBOARD_MAP = dict(keymap)
+
+    def set_event(self, event):
+        """ event needs type (KEYDOWN or KEYUP) and key attributes, unmapped keys are ignored """
+        self.kb_status = (event.type, event.key)
+
+        value = self.get_key_value()
+        if value is None:
+            return
+
+        if event.type == self.KEYDOWN:
+            self.press(value)
+        elif event.type == self.KEYUP:
+            self.release(value)
+
+    def get_key_value(self):
+        """ Return None when keyboard event has no value in dict """
+        return self.KEYBOARD_MAP.get(self.kb_status[1])
+
+    def press(self, value):
+        """ Key going down is a press event, auto repeat of a held key is not """
+        bit = 1 << value
+        if not self.mask & bit:
+            self.mask |= bit
+            self.pending = value
+            self.presses += 1
+
+    def release(self, value):
+        self.mask &= ~(1 << value)
+
+    def is_down(self, value):
+        return self.mask >> value & 0x1
+
+    def wait_press(self):
+        """ Start waiting for a key, presses before this do not count """
+        self.pending = None
+
+    def take_press(self):
+        """ Key pressed since wait_press(), None if none yet """
+        value = self.pending
+        self.pending = None
+        return value
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+''' ROM loading from files, zip archives and directories, with in-memory cache '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+import hashlib
+import os
+
+from errors import RomError
+
+
+''' Programs are loaded from 0x200 up to the end of memory '''
+PROGRAM_START = 0x200
+MAX_ROM_SIZE = 0x1000 - PROGRAM_START
+
+ROM_EXTENSIONS = (".ch8", ".c8")
+
+''' Separates archive path and member name, e.g. games.zip:PONG.ch8 '''
+ARCHIVE_SEPARATOR = ":"
+
+''' Leading bytes of zip archives, zipfile is only imported for files starting with them '''
+ZIP_SIGNATURES = (b"PK\x03\x04", b"PK\x05\x06")
+
+
+def is_rom_name(name):
+    return name.lower().endswith(ROM_EXTENSIONS)
+
+
+def is_archive(path):
+    if not os.path.isfile(path):
+        return False
+
+    with open(path, 'rb') as f:
+        return f.read(4) in ZIP_SIGNATURES
+
+
+def split_member(source):
+    '''
+    (archive path, member name) if source names a member of a zip archive,
+    whatever the archive file is called, else None
+    '''
+    path, separator, member = source.rpartition(ARCHIVE_SEPARATOR)
+    if separator and is_archive(path):
+        return path, member
+
+    return None
+
+
+def list_roms(path):
+    '''
+    ROM sources in a directory or zip archive, sorted by name.
+    Archive members are named archive:member
+    '''
+    if is_archive(path):
+        import zipfile
+
+        with zipfile.ZipFile(path) as archive:
+            names = [name for name in archive.namelist() if is_rom_name(name)]
+        return [f"{path}:{name}" for name in sorted(names)]
+
+    return sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if is_rom_name(name) and os.path.isfile(os.path.join(path, name))
+    )
+
+
+def validate(image, source="ROM"):
+    if not image:
+        raise RomError(f"{source} is empty")
+
+    if len(image) > MAX_ROM_SIZE:
+        raise RomError(f"{source} is {len(image)} bytes, only {MAX_ROM_SIZE} fit in 0x200-0xfff")
+
+    return image
+
+
+def read_rom(source):
+    '''
+    Read whole ROM image in one go. source is a file, archive:member,
+    or a zip archive holding exactly one ROM
+    '''
+    archive_member = split_member(source)
+    if archive_member is not None:
+        import zipfile
+
+        path, member = archive_member
+        with zipfile.ZipFile(path) as archive:
+            if member not in archive.namelist():
+                raise RomError(f"{path} has no member {member}")
+            return validate(archive.read(member), source)
+
+    with open(source, 'rb') as f:
+        image = f.read()
+
+    if image[:4] in ZIP_SIGNATURES:
+        members = list_roms(source)
+        if len(members) != 1:
+            raise RomError(f"{source} holds {len(members)} ROMs, pick one with {source}:NAME")
+        return read_rom(members[0])
+
+    return validate(image, source)
+
+
+class RomCache:
+    def __init__(self):
+        ''' Parsed ROM images keyed by SHA-256, and sources already read '''
+        self.images = {}
+        self.sources = {}
+
+
+    def add(self, image):
+        ''' Store image, return its hash key '''
+        digest = hashlib.sha256(image).hexdigest()
+        self.images.setdefault(digest, bytes(image))
+        return digest
+
+
+    def read(self, source):
+        ''' ROM image of source, read from disk only the first time '''
+        digest = self.sources.get(source)
+        if digest is None:
+            digest = self.sources[source] = self.add(read_rom(source))
+
+        return self.images[digest]
+
+
+    def clear(self):
+        self.images.clear()
+        self.sources.clear()
+
+
+''' Process wide cache used by load_rom() '''
+ROM_CACHE = RomCache()
+
+
+def load_rom(ram, source, cache=ROM_CACHE):
+    ''' Copy ROM into program memory with one slice write, return the image '''
+    image = cache.read(source) if cache is not None else read_rom(source)
+    ram.bulk_write(PROGRAM_START, image)
+    return image
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+''' Execution profiler: opcode histograms, hot PCs, handler and frame timing '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import json
+import time
+
+from cpu import decode_opcode
+
+
+def handler_name(opcode):
+    '''
+    Name of CPU handler of opcode. Taken from the opcode, not the handler,
+    which can be a wrapper (e.g. the idle loop jump installed by CPU.handler_at)
+    '''
+    decoded = decode_opcode(opcode)
+    return decoded[0] if decoded is not None else "invalid_opcode"
+
+
+class Profiler:
+    def __init__(self, sample_every=64):
+        '''
+        Instrument attached to CPU with attach(). Every instruction site
+        (address, opcode) gets its own counter, wall time of a handler is
+        sampled once every sample_every executions of the site.
+        '''
+        self.sample_every = sample_every
+
+        ''' (address, opcode, handler name) -> [executions, sampled ns, samples] '''
+        self.sites = {}
+
+        ''' Wall time of main loop sections in seconds, e.g. cpu, render, events '''
+        self.sections = defaultdict(float)
+        self.frames = 0
+
+
+    def attach(self, cpu):
+        cpu.add_instrument(self.wrap)
+
+
+    def detach(self, cpu):
+        cpu.remove_instrument(self.wrap)
+
+
+    def wrap(self, address, opcode, handler):
+        key = (address, opcode, handler_name(opcode))
+        site = self.sites.setdefault(key, [0, 0, 0])
+        sample_every = self.sample_every
+        perf_counter_ns = time.perf_counter_ns
+
+        def profiled():
+            site[0] += 1
+            if site[0] % sample_every:
+                handler()
+                return
+
+            start = perf_counter_ns()
+            try:
+                handler()
+            finally:
+                site[1] += perf_counter_ns() - start
+                site[2] += 1
+
+        return profiled
+
+
+    @contextmanager
+    def section(self, name):
+        ''' Time a section of the main loop, e.g. with profiler.section("render") '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.sections[name] += time.perf_counter() - start
+
+
+    def end_frame(self):
+        self.frames += 1
+
+
+    def opcode_counts(self):
+        counts = Counter()
+        for (address, opcode, name), site in self.sites.items():
+            counts[opcode] += site[0]
+        return counts
+
+
+    def family_counts(self):
+        counts = Counter()
+        for opcode, count in self.opcode_counts().items():
+            counts[opcode >> 12] += count
+        return counts
+
+
+    def pc_counts(self):
+        counts = Counter()
+        for (address, opcode, name), site in self.sites.items():
+            counts[address] += site[0]
+        return counts
+
+
+    def call_targets(self):
+        ''' Subroutine address -> number of calls (2nnn) '''
+        counts = Counter()
+        for (address, opcode, name), site in self.sites.items():
+            if name == "op_2nnn":
+                counts[0x0fff & opcode] += site[0]
+        return counts
+
+
+    def handler_stats(self):
+        ''' Handler name -> executions and estimated total wall time '''
+        stats = defaultdict(lambda: {"calls": 0, "sampled_ns": 0, "samples": 0})
+        for (address, opcode, name), (calls, sampled_ns, samples) in self.sites.items():
+            stat = stats[name]
+            stat["calls"] += calls
+            stat["sampled_ns"] += sampled_ns
+            stat["samples"] += samples
+
+        for stat in stats.values():
+            mean_ns = stat["sampled_ns"] / stat["samples"] if stat["samples"] else 0.0
+            stat["mean_ns"] = mean_ns
+            stat["estimated_ns"] = mean_ns * stat["calls"]
+
+        return dict(stats)
+
+
+    def to_dict(self):
+        return {
+            "frames": self.frames,
+            "sections": dict(self.sections),
+            "families": {f"{family:x}": count for family, count in sorted(self.family_counts().items())},
+            "opcodes": {f"{opcode:04x}": count for opcode, count in self.opcode_counts().most_common()},
+            "pcs": {f"{address:03x}": count for address, count in self.pc_counts().most_common()},
+            "call_targets": {f"{address:03x}": count for address, count in self.call_targets().most_common()},
+            "handlers": self.handler_stats(),
+        }
+
+
+    def write_json(self, f):
+        json.dump(self.to_dict(), f, indent=2)
+
+
+    def write_folded(self, f):
+        '''
+        Folded stacks for flame graph tools, weights in microseconds.
+        Instruction sites are estimated from sampled handler time
+        '''
+        handlers = self.handler_stats()
+        for (address, opcode, name), site in sorted(self.sites.items()):
+            weight = handlers[name]["mean_ns"] * site[0] / 1000
+            if weight >= 1:
+                f.write(f"frame;cpu;{name};{address:03x} {weight:.0f}\n")
+
+        for name, seconds in sorted(self.sections.items()):
+            if name != "cpu":
+                f.write(f"frame;{name} {seconds * 1e6:.0f}\n")
@@ -6,52 +6,163 @@ __author__  = "Rosyid Haryadi"
 __license__ = "GPLv3"
 
 
-import sys
+from array import array
+from collections import Counter
+
+from errors import MemoryFault
+
+
+''' Writes logged before they are folded into dirty pages and heat anyway '''
+WRITE_LOG_LIMIT = 4096
 
 
 class RAM:
+    SIZE = 4096
+
+    ''' Fixed attribute layout, many machines can be hosted side by side '''
+    __slots__ = ("data", "write_hooks", "write_log", "written", "dirty", "heat")
+
     def __init__(self):
         '''
         RAM Initialization, set all to zeros
         The memory should be 4 kB (4 kilobytes, ie. 4096 bytes) large
         '''
-        self.data = [0x00] * 4096
-
+        self.data = bytearray(self.SIZE)
 
-    def address_exception(func):
         '''
-        Exception handler for out of range memory
-        address must be the first argument
+        Callables notified with (address, length) after every write,
+        used by caches that depend on memory content (e.g. decoded code)
         '''
-        def wrapper(*args, **kwargs):
-            address = args[1]
-            try:
-                if 0x000 <= address <= 0xFFF:
-                    return func(*args, **kwargs)
-                else:
-                    raise IndexError()
-            except IndexError:
-                print(f"Invalid memory address: {hex(address)}", file=sys.stderr)
-                sys.exit(1)
+        self.write_hooks = []
 
-        return wrapper
+        '''
+        Write tracking, cheap enough to stay on: a write only appends
+        address << 13 | length to write_log. The log is folded into
+        dirty page bitmasks (bit n set when 64 byte page n was written) and
+        the per address write heat when those are asked for, or when it gets long.
+        written has every page written so far, dirty maps each consumer of
+        take_dirty_pages() to the pages written since it last took them.
+        heat (8 bytes per address) is allocated by the first fold
+        '''
+        self.write_log = []
+        self.written = 0
+        self.dirty = {}
+        self.heat = None
 
 
-    @address_exception
     def __getitem__(self, address):
-        return self.data[address]
+        if 0x000 <= address <= 0xFFF:
+            return self.data[address]
+
+        raise MemoryFault(f"Invalid memory address: {hex(address)}")
 
 
-    @address_exception
     def __setitem__(self, address, value):
         ''' Limit only 8-bit per address slot '''
+        if not 0x000 <= address <= 0xFFF:
+            raise MemoryFault(f"Invalid memory address: {hex(address)}")
+
         self.data[address] = 0xFF & value
+        log = self.write_log
+        log.append(address << 13 | 1)
+        if len(log) > WRITE_LOG_LIMIT:
+            self.fold_writes()
+        for hook in self.write_hooks:
+            hook(address, 1)
+
+
+    def check_range(self, start_addr, length):
+        ''' Raise MemoryFault unless the whole range is inside memory '''
+        if start_addr < 0x000 or start_addr + length > self.SIZE:
+            raise MemoryFault(f"Invalid memory range: {hex(start_addr)} + {length}")
+
+
+    def peek(self, address):
+        ''' Unchecked read, for callers that already checked the address '''
+        return self.data[address]
+
+
+    def view(self, start_addr=0x000, length=None):
+        ''' Zero-copy memoryview of contiguous memory space '''
+        if length is None:
+            length = self.SIZE - start_addr
+
+        self.check_range(start_addr, length)
+        return memoryview(self.data)[start_addr:start_addr + length]
 
 
     def bulk_write(self, start_addr, data):
-        ''' Write many bytes at once in contiguous memory space '''
-        for idx, data_byte in enumerate(data):
-            self.__setitem__(start_addr + idx, data_byte)
+        '''
+        Write many bytes at once in contiguous memory space.
+        data is bytes-like or a sequence of 8-bit values
+        '''
+        length = len(data)
+        self.check_range(start_addr, length)
+
+        self.data[start_addr:start_addr + length] = data
+        if length:
+            log = self.write_log
+            log.append(start_addr << 13 | length)
+            if len(log) > WRITE_LOG_LIMIT:
+                self.fold_writes()
+        for hook in self.write_hooks:
+            hook(start_addr, length)
+
+
+    def fold_writes(self):
+        ''' Add logged writes to dirty pages and heat, repeated writes are counted together '''
+        log = self.write_log
+        pages = 0
+        heat = self.heat
+        if heat is None:
+            heat = self.heat = array('Q', bytes(8 * self.SIZE))
+
+        for key, count in Counter(log).items():
+            start = key >> 13
+            end = start + (key & 0x1fff)
+            pages |= ((2 << ((end - 1) >> 6)) - 1) ^ ((1 << (start >> 6)) - 1)
+            for address in range(start, end):
+                heat[address] += count
+
+        self.written |= pages
+        dirty = self.dirty
+        for consumer in dirty:
+            dirty[consumer] |= pages
+        log.clear()
+
+
+    def take_dirty_pages(self, consumer=None):
+        '''
+        Bitmask of 64 byte pages written since consumer last called, to redraw
+        or copy only what changed. Every consumer (any hashable, e.g. the
+        viewer itself) has its own mask, the first call returns all pages written so far
+        '''
+        self.fold_writes()
+        pages = self.dirty.get(consumer, self.written)
+        self.dirty[consumer] = 0
+        return pages
+
+
+    def dirty_ranges(self, mask):
+        ''' (start address, length) of every run of set pages in mask '''
+        ranges = []
+        page = 0
+        while mask:
+            skip = (mask & -mask).bit_length() - 1
+            mask >>= skip
+            page += skip
+            run = (~mask & (mask + 1)).bit_length() - 1
+            ranges.append((page << 6, run << 6))
+            mask >>= run
+            page += run
+
+        return ranges
+
+
+    def write_heat(self):
+        ''' Number of writes to every address so far, as array of 4096 counts '''
+        self.fold_writes()
+        return self.heat
 
 
     def __len__(self):
@@ -63,11 +174,3 @@ class RAM:
         for address, value in enumerate(self.data):
             printed_str += f"0x{address:03x}: 0x{value:02x}\n"
         return printed_str
-
-
-if __name__ == '__main__':
-    import unittest
-    from tests import TestRAM
-
-    ram_test_runner = unittest.TestLoader().loadTestsFromTestCase(TestRAM)
-    unittest.TextTestRunner(verbosity=2).run(ram_test_runner)
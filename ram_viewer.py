@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+""" Live RAM view: 4096 bytes as a colour mapped 64 x 64 image, redrawn page by page """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class RamViewer:
+    """ One row per 64 byte page, one column per byte in the page """
+    PAGES = 64
+
+    """ Cells written since the previous update """
+    WRITE_COLOR = (0xff, 0x40, 0x20)
+
+    def __init__(self, ram, cell=4):
+        """
+        cell is the size in screen pixels of one byte. Bytes are coloured
+        by value, bytes written since the last update are highlighted.
+        Only pages RAM reports as dirty are converted and redrawn.
+        """
+        if np is None:
+            raise ImportError("RamViewer requires numpy")
+
+        self.ram = ram
+        self.cell = cell
+        self.size = (self.PAGES * cell, self.PAGES * cell)
+
+        """ Live views of RAM content and write heat, nothing is copied """
+        self.data = np.frombuffer(ram.data, dtype=np.uint8).reshape(self.PAGES, -1)
+        self.heat = np.frombuffer(ram.write_heat(), dtype=np.uint64).reshape(self.PAGES, -1)
+        self.seen = self.heat.copy()
+
+        value = np.arange(256)
+        self.palette = np.stack([value // 4, value, 0x40 + value * 3 // 4], axis=1).astype(np.uint8)
+
+        """ Pages drawn with highlights, redrawn next update to clear them """
+        self.highlighted = 0
+
+        """ First update draws everything """
+        self.pending = (1 << self.PAGES) - 1
+
+    def update(self):
+        """
+        Convert pages changed since last update in one array pass.
+        Return (pages, strips): strip n is page pages[n] as a
+        (64 * cell, cell, 3) x major image, ready for pygame.surfarray
+        """
+        mask = self.ram.take_dirty_pages(self) | self.highlighted | self.pending
+        self.pending = 0
+        if not mask:
+            return [], None
+
+        pages = [page for page in range(self.PAGES) if mask >> page & 1]
+        self.ram.write_heat()
+        heat = self.heat[pages]
+        written = heat != self.seen[pages]
+        self.seen[pages] = heat
+
+        image = self.palette[self.data[pages]]
+        image[written] = self.WRITE_COLOR
+        self.highlighted = sum(1 << page for page, row in zip(pages, written.any(axis=1)) if row)
+
+        cell = self.cell
+        return pages, image.repeat(cell, axis=1)[:, :, None, :].repeat(cell, axis=2)
+
+    def image(self):
+        """ Whole memory as (64 * cell, 64 * cell, 3) x major image, without taking dirty pages """
+        image = self.palette[self.data]
+        return image.repeat(self.cell, axis=0).repeat(self.cell, axis=1).transpose(1, 0, 2)
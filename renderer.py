@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+""" Bulk framebuffer to image conversion with NumPy, for pygame.surfarray """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class ArrayRenderer:
+    def __init__(self, width=64, height=32, px_scale=10,
+                 on_color=(0x00, 0x00, 0x00), off_color=(0xff, 0xff, 0xff), decay=0.0):
+        """
+        Convert whole framebuffer into a scaled RGB image in one array pass.
+        px_scale can be any positive number, pixels are picked by nearest neighbour.
+        decay in [0, 1) is the fraction of brightness a pixel keeps per frame
+        after it's turned off (phosphor ghosting), 0 disables it.
+        """
+        if np is None:
+            raise ImportError("ArrayRenderer requires numpy")
+
+        self.width = width
+        self.height = height
+        self.decay = decay
+
+        self.on_color = np.array(on_color, dtype=np.float32)
+        self.off_color = np.array(off_color, dtype=np.float32)
+        self.palette = np.array([off_color, on_color], dtype=np.uint8)
+
+        """ Source pixel of every output column and row """
+        self.size = (round(width * px_scale), round(height * px_scale))
+        self.src_x = (np.arange(self.size[0]) / px_scale).astype(np.intp)
+        self.src_y = (np.arange(self.size[1]) / px_scale).astype(np.intp)
+
+        self.intensity = np.zeros((height, width), dtype=np.float32)
+
+    def unpack(self, rows):
+        """ Packed 64-bit rows into (height, width) array of 0 and 1 """
+        packed = np.array(rows, dtype=">u8").view(np.uint8).reshape(self.height, self.width // 8)
+        return np.unpackbits(packed, axis=1)
+
+    def compose(self, rows):
+        """
+        Return (width, height, 3) uint8 image, x major like pygame.surfarray.
+        With decay, brightness of turned off pixels fades across frames.
+        """
+        pixels = self.unpack(rows)
+
+        if self.decay:
+            intensity = np.maximum(pixels, self.intensity * self.decay)
+            intensity[intensity < 1 / 255] = 0
+            self.intensity = intensity
+            image = self.off_color + (self.on_color - self.off_color) * intensity[..., None]
+            image = image.astype(np.uint8)
+        else:
+            image = self.palette[pixels]
+
+        return image[np.ix_(self.src_y, self.src_x)].transpose(1, 0, 2)
+
+    def is_fading(self):
+        """ True while some pixel is still between on and off """
+        return bool(self.decay) and bool(((self.intensity > 0) & (self.intensity < 1)).any())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+''' Input recording and deterministic replay of a CHIP-8 session '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+import hashlib
+import struct
+
+from headless import HeadlessMachine
+
+
+MAGIC = b"C8IN"
+VERSION = 1
+
+'''
+Layout, little endian: magic, version, RNG seed, instructions per second,
+frames recorded, event count, SHA-1 of the ROM, then the events
+'''
+HEADER = struct.Struct("<4sBQIII20s")
+
+''' Event: frame number, key mask and pending Fx0A press from that frame on '''
+EVENT = struct.Struct("<IHB")
+
+''' Pending value stored when no press is pending '''
+NO_PRESS = 0xff
+
+
+class ReplayError(ValueError):
+    pass
+
+
+def rom_hash(rom):
+    return hashlib.sha1(bytes(rom)).digest()
+
+
+class Recording:
+    def __init__(self, seed, ips, rom_hash=bytes(20), frames=0, events=None):
+        '''
+        Keypad state of a session at the start of every frame where it changed,
+        events are (frame, mask, pending) with pending None when no press is pending.
+        Together with seed and ips it reproduces the session exactly
+        '''
+        self.seed = seed
+        self.ips = ips
+        self.rom_hash = rom_hash
+        self.frames = frames
+        self.events = list(events or [])
+
+
+    def to_bytes(self):
+        header = HEADER.pack(MAGIC, VERSION, self.seed, self.ips, self.frames,
+                             len(self.events), self.rom_hash)
+        events = (EVENT.pack(frame, mask, NO_PRESS if pending is None else pending)
+                  for frame, mask, pending in self.events)
+        return header + b"".join(events)
+
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+
+def parse(data):
+    ''' Recording from bytes produced by Recording.to_bytes() '''
+    if len(data) < HEADER.size:
+        raise ReplayError("Input recording is truncated")
+
+    magic, version, seed, ips, frames, count, digest = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ReplayError(f"Unsupported input recording {magic!r} version {version}")
+
+    if len(data) != HEADER.size + count * EVENT.size:
+        raise ReplayError(f"Input recording must hold {count} events")
+
+    events = [(frame, mask, None if pending == NO_PRESS else pending)
+              for frame, mask, pending in EVENT.iter_unpack(data[HEADER.size:])]
+    return Recording(seed, ips, digest, frames, events)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return parse(f.read())
+
+
+class InputRecorder:
+    def __init__(self, keypad, recording):
+        '''
+        Append keypad changes to recording, record() is a Scheduler frame hook.
+        Fx0A clears pending during a frame, so a press between frames is
+        recorded even when it brings back the last recorded state
+        '''
+        self.keypad = keypad
+        self.recording = recording
+        self.last = (0, None)
+        self.presses = keypad.presses
+
+
+    def attach(self, scheduler):
+        scheduler.frame_hooks.append(self.record)
+
+
+    def record(self, frame):
+        keypad = self.keypad
+        state = (keypad.mask, keypad.pending)
+        if state != self.last or keypad.presses != self.presses:
+            self.recording.events.append((frame, *state))
+            self.last = state
+            self.presses = keypad.presses
+
+        self.recording.frames = frame + 1
+
+
+class InputPlayer:
+    def __init__(self, keypad, recording):
+        ''' Feed recorded keypad state back, play() is a Scheduler frame hook '''
+        self.keypad = keypad
+        self.events = recording.events
+        self.position = 0
+
+
+    def attach(self, scheduler):
+        scheduler.frame_hooks.append(self.play)
+
+
+    def play(self, frame):
+        events = self.events
+        while self.position < len(events) and events[self.position][0] <= frame:
+            _, self.keypad.mask, self.keypad.pending = events[self.position]
+            self.position += 1
+
+
+def replay(rom, recording, engine="interpreter"):
+    '''
+    Run recording headless at full speed, return the machine after its last frame.
+    Any engine must end with the same framebuffer as the recorded session
+    '''
+    if rom_hash(rom) != recording.rom_hash:
+        raise ReplayError("Input recording was made with a different ROM")
+
+    machine = HeadlessMachine(rom, ips=recording.ips, engine=engine, seed=recording.seed)
+    InputPlayer(machine.keyboard, recording).attach(machine.scheduler)
+    machine.scheduler.fast_forward(recording.frames)
+    return machine
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+""" Asyncio runtime: input, CPU, timers, render and sound clocked as separate tasks """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+import asyncio
+import inspect
+
+from errors import EmulatorFault
+from scheduler import FRAME_RATE
+
+
+class Instance:
+    def __init__(self, cpu, engine=None, ips=700, poll=None, render=None, sound=None,
+                 poll_rate=FRAME_RATE, render_rate=FRAME_RATE):
+        """
+        One emulated machine hosted by Runtime.
+        poll() handles host input, returning False stops the instance.
+        render() presents the screen, it may be a coroutine function.
+        sound(on) is called whenever the sound timer starts or stops.
+        """
+        self.cpu = cpu
+        self.engine = engine or cpu
+        self.ips = ips
+
+        self.poll = poll
+        self.render = render
+        self.sound = sound
+        self.poll_rate = poll_rate
+        self.render_rate = render_rate
+
+        self.running = True
+
+        """ Fault that stopped the instance, None while healthy """
+        self.fault = None
+
+        self.instructions = 0
+        self.ticks = 0
+        self.frames_rendered = 0
+        self.frames_dropped = 0
+
+    def stop(self):
+        self.running = False
+
+
+class Runtime:
+    """ CPU task wakes up this many times per second and runs the instructions due """
+    CPU_RATE = 240
+
+    """ Longest host stall (seconds) the CPU catches up on, the rest is lost """
+    MAX_CATCH_UP = 0.25
+
+    def __init__(self):
+        """ Host for any number of instances in one event loop """
+        self.instances = []
+        self.tasks = None
+
+    def add(self, cpu, **kwargs):
+        """ Host a machine, see Instance for arguments. Starts at once if serving """
+        instance = Instance(cpu, **kwargs)
+        self.instances.append(instance)
+        if self.tasks is not None:
+            self.start(instance)
+
+        return instance
+
+    def stop(self):
+        for instance in self.instances:
+            instance.stop()
+
+    def run(self, duration=None):
+        """ Serve all instances until they stop, or for duration seconds """
+        asyncio.run(self.serve(duration))
+
+    async def serve(self, duration=None):
+        """ Coroutine version of run(), for hosts that own the event loop """
+        loop = asyncio.get_running_loop()
+        end = None if duration is None else loop.time() + duration
+
+        self.tasks = []
+        for instance in self.instances:
+            self.start(instance)
+
+        try:
+            while True:
+                """ Instances added meanwhile are waited for in the next round """
+                pending = [task for task in self.tasks if not task.done()]
+                timeout = None if end is None else end - loop.time()
+                if not pending or (timeout is not None and timeout <= 0):
+                    break
+
+                await asyncio.wait(pending, timeout=timeout)
+        finally:
+            tasks, self.tasks = self.tasks, None
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def start(self, instance):
+        coroutines = [self.clock_cpu(instance), self.clock_timers(instance)]
+        if instance.poll:
+            coroutines.append(self.every(instance, instance.poll_rate, self.poll_input))
+        if instance.render:
+            coroutines.append(self.every(instance, instance.render_rate, self.render_frame, drop=True))
+        if instance.sound:
+            coroutines.append(self.clock_sound(instance))
+
+        self.tasks += [asyncio.create_task(self.guard(instance, coroutine)) for coroutine in coroutines]
+
+    async def guard(self, instance, coroutine):
+        """ Fault of one instance stops that instance only """
+        try:
+            await coroutine
+        except EmulatorFault as fault:
+            instance.fault = fault
+            instance.stop()
+
+    async def every(self, instance, rate, func, drop=False):
+        """
+        Call func(instance) rate times per second of host time.
+        Ticks missed while the host was busy are made up for,
+        or skipped and counted as dropped when drop is set.
+        """
+        loop = asyncio.get_running_loop()
+        period = 1 / rate
+        deadline = loop.time()
+        while instance.running:
+            result = func(instance)
+            if inspect.isawaitable(result):
+                await result
+
+            deadline += period
+            late = loop.time() - deadline
+            if drop and late > 0:
+                missed = int(late / period) + 1
+                deadline += missed * period
+                instance.frames_dropped += missed
+
+            await asyncio.sleep(max(deadline - loop.time(), 0))
+
+    async def clock_cpu(self, instance):
+        """ Run the instructions due since last wake up, CPU speed does not depend on render speed """
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        carry = 0.0
+        while instance.running:
+            await asyncio.sleep(1 / self.CPU_RATE)
+            now = loop.time()
+            budget, carry = divmod(instance.ips * min(now - last, self.MAX_CATCH_UP) + carry, 1)
+            last = now
+            instance.instructions += instance.engine.run_for(int(budget))
+
+    async def clock_timers(self, instance):
+        await self.every(instance, FRAME_RATE, self.tick_timers)
+
+    async def clock_sound(self, instance):
+        playing = False
+        while instance.running:
+            on = instance.cpu.sound_timer > 0
+            if on != playing:
+                playing = on
+                instance.sound(on)
+            await asyncio.sleep(1 / FRAME_RATE)
+
+        if playing:
+            instance.sound(False)
+
+    def tick_timers(self, instance):
+        instance.cpu.tick_timers()
+        instance.ticks += 1
+
+    def poll_input(self, instance):
+        if instance.poll() is False:
+            instance.stop()
+
+    def render_frame(self, instance):
+        instance.frames_rendered += 1
+        return instance.render()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+''' Compact binary save-states and rewind buffer of a CHIP-8 machine '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+from array import array
+from collections import deque
+import re
+import struct
+
+
+MAGIC = b"C8ST"
+VERSION = 2
+
+'''
+Layout, little endian unless noted:
+magic, version, pc, i, delay timer, sound timer, stack depth, font loaded,
+waiting for key (Fx0A), V0 - VF, 16 stack slots, then 4096 bytes of RAM,
+32 framebuffer rows as big endian 64-bit integers and the RNG state
+'''
+HEADER = struct.Struct("<4sBHHBBB??16s16H")
+ROWS = struct.Struct(">32Q")
+STACK_DEPTH = 16
+
+''' Mersenne Twister state of random.Random: 624 words and position '''
+RNG = struct.Struct("<625I")
+RNG_VERSION = 3
+
+STATE_SIZE = HEADER.size + 4096 + ROWS.size + RNG.size
+
+''' Delta token: zero bytes to skip, literal bytes that follow '''
+TOKEN = struct.Struct("<HH")
+NON_ZERO_RUN = re.compile(rb"[^\x00]+")
+
+
+class SaveStateError(ValueError):
+    pass
+
+
+def snapshot(cpu):
+    ''' Whole machine state (CPU, RAM and screen of cpu) as bytes '''
+    header = HEADER.pack(MAGIC, VERSION, cpu.pc, cpu.i, cpu.delay_timer, cpu.sound_timer,
+                         cpu.sp, cpu.font_loaded, cpu.waiting_key, bytes(cpu.v), *cpu.stack)
+    rng = RNG.pack(*cpu.rng.getstate()[1])
+
+    return b"".join((header, cpu.ram.data, ROWS.pack(*cpu.screen.rows), rng))
+
+
+def restore(cpu, state):
+    ''' Load state produced by snapshot() back into cpu and its devices '''
+    if len(state) != STATE_SIZE:
+        raise SaveStateError(f"Save-state must be {STATE_SIZE} bytes, got {len(state)}")
+
+    fields = HEADER.unpack_from(state)
+    magic, version, pc, i, delay_timer, sound_timer, depth, font_loaded, waiting_key, v = fields[:10]
+    if magic != MAGIC or version != VERSION:
+        raise SaveStateError(f"Unsupported save-state {magic!r} version {version}")
+
+    if depth > STACK_DEPTH:
+        raise SaveStateError(f"Stack deeper than {STACK_DEPTH} levels")
+
+    rng = RNG.unpack_from(state, STATE_SIZE - RNG.size)
+    if rng[-1] > 624:
+        raise SaveStateError("RNG position out of range")
+
+    cpu.pc = pc
+    cpu.i = i
+    cpu.delay_timer = delay_timer
+    cpu.sound_timer = sound_timer
+    cpu.font_loaded = font_loaded
+    cpu.v[:] = v
+    cpu.stack[:] = array('H', fields[10:10 + STACK_DEPTH])
+    cpu.sp = depth
+    cpu.rng.setstate((RNG_VERSION, rng, None))
+
+    ''' A wait in progress starts over, presses made before the restore do not count '''
+    cpu.waiting_key = waiting_key
+    if waiting_key:
+        cpu.keyboard.wait_press()
+
+    view = memoryview(state)
+    cpu.ram.bulk_write(0x000, view[HEADER.size:HEADER.size + 4096])
+    cpu.screen.rows = list(ROWS.unpack_from(state, HEADER.size + 4096))
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+
+def encode_delta(state, keyframe):
+    ''' XOR of state against keyframe, zero runs removed '''
+    delta = xor_bytes(state, keyframe)
+    tokens = []
+    pos = 0
+    for match in NON_ZERO_RUN.finditer(delta):
+        literal = match.group()
+        tokens.append(TOKEN.pack(match.start() - pos, len(literal)))
+        tokens.append(literal)
+        pos = match.end()
+
+    return b"".join(tokens)
+
+
+def decode_delta(encoded, keyframe):
+    delta = bytearray(len(keyframe))
+    pos = 0
+    offset = 0
+    while offset < len(encoded):
+        gap, length = TOKEN.unpack_from(encoded, offset)
+        offset += TOKEN.size
+        pos += gap
+        delta[pos:pos + length] = encoded[offset:offset + length]
+        pos += length
+        offset += length
+
+    return xor_bytes(keyframe, delta)
+
+
+class RewindBuffer:
+    def __init__(self, keyframe_interval=60, max_bytes=8 * 1024 * 1024):
+        '''
+        Ring of per-frame states. Every keyframe_interval states a full keyframe
+        is stored, states in between are stored as deltas against it.
+        Oldest keyframe with its deltas is evicted when over max_bytes.
+        '''
+        self.keyframe_interval = keyframe_interval
+        self.max_bytes = max_bytes
+
+        ''' Groups of [keyframe, list of encoded deltas] '''
+        self.groups = deque()
+        self.size = 0
+
+
+    def push(self, state):
+        group = self.groups[-1] if self.groups else None
+        if group is None or len(group[1]) + 1 >= self.keyframe_interval:
+            self.groups.append([bytes(state), []])
+            self.size += len(state)
+        else:
+            delta = encode_delta(state, group[0])
+            group[1].append(delta)
+            self.size += len(delta)
+
+        while self.size > self.max_bytes and len(self.groups) > 1:
+            keyframe, deltas = self.groups.popleft()
+            self.size -= len(keyframe) + sum(map(len, deltas))
+
+
+    def pop(self):
+        ''' Remove and return the most recent state, None if empty '''
+        if not self.groups:
+            return None
+
+        keyframe, deltas = self.groups[-1]
+        if deltas:
+            delta = deltas.pop()
+            self.size -= len(delta)
+            return decode_delta(delta, keyframe)
+
+        self.groups.pop()
+        self.size -= len(keyframe)
+        return keyframe
+
+
+    def __len__(self):
+        return sum(1 + len(deltas) for _, deltas in self.groups)
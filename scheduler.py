@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+""" Instruction scheduler: CPU speed decoupled from 60 Hz timers and frames """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+import time
+
+
+""" Timers and frames run at 60 Hz of emulated time """
+FRAME_RATE = 60
+
+
+class Scheduler:
+    def __init__(self, cpu, ips=700, engine=None):
+        """
+        ips is the emulated instructions per second. Every frame runs
+        ips / 60 instructions, fraction is carried over to next frame.
+        engine is anything with run_for(cycles), CPU itself by default.
+        """
+        self.cpu = cpu
+        self.engine = engine or cpu
+        self.ips = ips
+
+        self.carry = 0
+        self.frames = 0
+        self.instructions = 0
+
+        """ Host time spent in run_frame(), to report achieved speed """
+        self.elapsed = 0.0
+
+        """ Called as hook(frame) before each frame runs, e.g. to record or replay input """
+        self.frame_hooks = []
+
+    def run_frame(self):
+        """
+        Emulate one frame: run its share of instructions,
+        then decrement timers exactly once. Return instructions executed.
+        """
+        start = time.perf_counter()
+        for hook in self.frame_hooks:
+            hook(self.frames)
+
+        budget, self.carry = divmod(self.ips + self.carry, FRAME_RATE)
+        executed = self.engine.run_for(budget)
+        self.cpu.tick_timers()
+
+        self.frames += 1
+        self.instructions += executed
+        self.elapsed += time.perf_counter() - start
+        return executed
+
+    def fast_forward(self, frames):
+        """ Run frames back to back without rendering, for batch jobs """
+        executed = 0
+        for _ in range(frames):
+            executed += self.run_frame()
+
+        return executed
+
+    def achieved_ips(self):
+        """ Instructions per second of host time actually achieved """
+        if not self.elapsed:
+            return 0.0
+
+        return self.instructions / self.elapsed
+
+
+class FrameClock:
+    def __init__(self):
+        """ Keeps a loop at a steady rate of host time, like pygame.time.Clock """
+        self.deadline = None
+
+    def tick(self, rate=FRAME_RATE):
+        """ Sleep until the next of rate ticks per second, a late loop does not try to catch up """
+        period = 1 / rate
+        now = time.perf_counter()
+        if self.deadline is None or now - self.deadline > period:
+            self.deadline = now
+        self.deadline += period
+        time.sleep(max(self.deadline - now, 0))
@@ -7,40 +7,109 @@ __license__ = "GPLv3"
 
 import pygame
 
+from framebuffer import FrameBuffer
 
-class Screen:
-    def __init__(self):
-        self.screen_state = None
+
+class Screen(FrameBuffer):
+    ON_COLOR = (0x00, 0x00, 0x00)
+    OFF_COLOR = (0xff, 0xff, 0xff)
+
+    __slots__ = ("padding", "px_scale", "array_renderer", "ram_viewer", "ram_origin", "surface")
+
+    def __init__(self, px_scale=10, renderer="rect", decay=0.0, ram=None):
+        """
+        renderer "rect" fills changed pixel runs one by one,
+        "array" converts the whole framebuffer with NumPy (any px_scale, optional decay).
+        With ram, a live view of memory is shown right of the screen (needs NumPy)
+        """
         self.padding = 20
-        self.px_scale = 10
+        self.px_scale = px_scale if renderer == "array" else int(px_scale)
 
-        self.surface = pygame.display.set_mode((
-            (64 * self.px_scale) + (2 * self.padding),
-            (32 * self.px_scale) + (2 * self.padding)
-        ))
+        self.array_renderer = None
+        if renderer == "array":
+            from renderer import ArrayRenderer
+            self.array_renderer = ArrayRenderer(self.WIDTH, self.HEIGHT, px_scale,
+                                                self.ON_COLOR, self.OFF_COLOR, decay)
 
-        self.clear()
+        width = round(self.WIDTH * self.px_scale) + (2 * self.padding)
+        height = round(self.HEIGHT * self.px_scale) + (2 * self.padding)
 
-    def draw_pixel(self, x, y, px_value):
-        rgb = tuple([0x00 if px_value else 0xff for _ in range(3)])
-        self.surface.fill(rgb,
-                          (self.px_scale * x, self.px_scale * y, self.padding, self.padding)
-                          )
+        self.ram_viewer = None
+        if ram is not None:
+            from ram_viewer import RamViewer
+            self.ram_viewer = RamViewer(ram)
+            self.ram_origin = (width, self.padding)
+            width += self.ram_viewer.size[0] + self.padding
+            height = max(height, self.ram_viewer.size[1] + 2 * self.padding)
 
-        self.screen_state[y][x] = px_value
+        self.surface = pygame.display.set_mode((width, height))
 
-    def toggle_pixel(self, x, y):
-        px_val = self.screen_state[y][x]
-        self.draw_pixel(x, y, not px_val)
-        self.screen_state[y][x] = not px_val
+        super().__init__()
 
-    def get_state(self):
-        return self.screen_state
+        self.surface.fill(self.OFF_COLOR)
+        pygame.display.flip()
 
-    def clear(self):
-        self.surface.fill((0xff, 0xff, 0xff))
-        self.screen_state = [[False] * 64] * 32
+    def paint_rect(self, x, y, w, h):
+        """
+        Paint framebuffer pixels inside rectangle onto the surface,
+        one fill per run of same colored pixels in a row
+        """
+        scale = self.px_scale
+        for row_y in range(y, y + h):
+            run_start = x
+            run_value = self.get_pixel(x, row_y)
+            for col in range(x + 1, x + w + 1):
+                value = self.get_pixel(col, row_y) if col < x + w else None
+                if value != run_value:
+                    self.surface.fill(self.ON_COLOR if run_value else self.OFF_COLOR,
+                                      (self.padding + scale * run_start, self.padding + scale * row_y,
+                                       scale * (col - run_start), scale))
+                    run_start, run_value = col, value
 
     def render(self):
-        """ Actual rendering after pixels set. Called in main file c8.py """
-        pygame.display.flip()
+        """
+        Actual rendering after pixels set. Called in main file c8.py
+        Only rectangles changed since last frame are painted and presented,
+        nothing is presented at all if the framebuffer did not change.
+        """
+        if self.ram_viewer is not None:
+            self.render_ram()
+
+        if self.array_renderer is not None:
+            self.render_array()
+            return
+
+        dirty_rects = self.take_dirty_rects()
+        if not dirty_rects:
+            return
+
+        scale = self.px_scale
+        update_rects = []
+        for x, y, w, h in dirty_rects:
+            self.paint_rect(x, y, w, h)
+            update_rects.append((self.padding + scale * x, self.padding + scale * y, scale * w, scale * h))
+
+        pygame.display.update(update_rects)
+
+    def render_ram(self):
+        """ Memory pages written since last frame, one blit per page row """
+        pages, strips = self.ram_viewer.update()
+        if not pages:
+            return
+
+        x, y = self.ram_origin
+        width, cell = strips.shape[1:3]
+        areas = [pygame.Rect(x, y + page * cell, width, cell) for page in pages]
+        for area, strip in zip(areas, strips):
+            pygame.surfarray.blit_array(self.surface.subsurface(area), strip)
+        pygame.display.update(areas)
+
+    def render_array(self):
+        """ Whole framebuffer pushed to the surface with one blit_array call """
+        renderer = self.array_renderer
+        if not self.take_dirty_rects() and not renderer.is_fading():
+            return
+
+        area = pygame.Rect((self.padding, self.padding), renderer.size)
+        pygame.surfarray.blit_array(self.surface.subsurface(area), renderer.compose(self.rows))
+        pygame.display.update(area)
@@ -5,18 +5,43 @@
 __author__ = "Rosyid Haryadi"
 __license__ = "GPLv3"
 
+from array import array
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import zipfile
 from unittest.mock import Mock
 
+import backends
+from analyzer import AnalysisCache, analyze, disassemble, mnemonic, warm
+from batch import run_batch, write_report
+from benchmarks import compare
+from blocks import BlockEngine
+from core import CommandRing, EmulatorCore, FrameExchange
 from cpu import CPU
+from errors import InvalidOpcode, MemoryFault, RomError, StackFault
+from framebuffer import FrameBuffer
+from headless import HeadlessKeyboard, HeadlessMachine, HeadlessScreen, KEYDOWN, KEYUP
+from loader import RomCache, list_roms, load_rom, read_rom
+from profiler import Profiler
 from ram import RAM
-
+from runtime import Runtime
+from renderer import np as numpy
+from replay import InputRecorder, Recording, ReplayError, parse, replay, rom_hash
+from savestate import RewindBuffer, SaveStateError, restore, snapshot
+from scheduler import Scheduler
+from tracer import Trace, dump_on_fault
 
 class TestRAM(unittest.TestCase):
     def test_ram_initialization(self):
         ram = RAM()
         self.assertEqual(len(ram), 4096, "Memory size must be 4096")
-        self.assertEqual(ram.data, [0x0] * 4096, "All initialized zero")
+        self.assertEqual(ram.data, bytearray(4096), "All initialized zero")
 
     def test_ram_write_normal(self):
         ram = RAM()
@@ -34,9 +59,8 @@ class TestRAM(unittest.TestCase):
 
     def test_ram_write_out_of_range(self):
         ram = RAM()
-        with self.assertRaises(SystemExit, msg="Writing out of range must exit"):
+        with self.assertRaises(MemoryFault, msg="Writing out of range must raise fault"):
             ram[0xfff + 1] = 0x01
-            self.assertRaises(IndexError, msg="Writing out of range must raise exception")
 
     def test_ram_read_normal(self):
         ram = RAM()
@@ -45,23 +69,74 @@ class TestRAM(unittest.TestCase):
 
     def test_ram_read_out_of_range(self):
         ram = RAM()
-        with self.assertRaises(SystemExit, msg="Reading out of range must exit"):
+        with self.assertRaises(MemoryFault, msg="Reading out of range must raise fault"):
             data_at_0x1000 = ram[0xfff + 1]
-            self.assertRaises(IndexError, msg="Reading out of range must raise exception")
+        with self.assertRaises(MemoryFault, msg="Negative address must raise fault"):
+            data_at_minus_1 = ram[-1]
 
     def test_ram_bulk_write(self):
         ram = RAM()
         ram.bulk_write(0x000, [0x01, 0x01])
-        self.assertEqual(ram.data[0x000:0x003], [0x01, 0x01, 0x00],
+        self.assertEqual(ram.data[0x000:0x003], bytes([0x01, 0x01, 0x00]),
                          "Two bytes data must be written in 0x000 to 0x001 and nowhere else")
 
+    def test_ram_bulk_write_out_of_range(self):
+        ram = RAM()
+        with self.assertRaises(MemoryFault, msg="Writing past the end must raise fault"):
+            ram.bulk_write(0xfff, [0x01, 0x01])
+        self.assertEqual(ram.data[0xfff], 0x00, "Nothing must be written on fault")
+
+    def test_ram_view_zero_copy(self):
+        ram = RAM()
+        view = ram.view(0x200, 2)
+        ram[0x201] = 0xab
+        self.assertEqual(view[1], 0xab, "View must reflect memory without copying")
+        with self.assertRaises(MemoryFault, msg="View past the end must raise fault"):
+            ram.view(0xffe, 4)
+
+    def test_ram_peek_unchecked(self):
+        ram = RAM()
+        ram.data[0xfff] = 0xab
+        self.assertEqual(ram.peek(0xfff), 0xab, "Peek must read memory directly")
+        cpu = CPU(ram=ram)
+        for address in (0xfff, 0x1000):
+            cpu.pc = address
+            with self.assertRaises(MemoryFault, msg="Fetching past the end must still fault"):
+                cpu.fetch()
+            with self.assertRaises(MemoryFault, msg="Decoding past the end must still fault"):
+                cpu.handler_at(address)
+
+    def test_ram_bulk_write_hook(self):
+        ram = RAM()
+        hook = Mock()
+        ram.write_hooks.append(hook)
+        ram.bulk_write(0x300, b"\x01\x02\x03")
+        hook.assert_called_once_with(0x300, 3)
+
+    def test_ram_dirty_pages_and_heat(self):
+        ram = RAM()
+        ram.bulk_write(0x3f0, bytes(0x20))
+        ram[0xfff] = 0x01
+        ram[0x3f0] = 0x02
+        dirty = ram.take_dirty_pages()
+        self.assertEqual(dirty, 1 << 15 | 1 << 16 | 1 << 63, "Every written 64 byte page must be dirty")
+        self.assertEqual(ram.dirty_ranges(dirty), [(0x3c0, 0x80), (0xfc0, 0x40)], "Adjacent pages must merge")
+        self.assertEqual(ram.take_dirty_pages(), 0, "Dirty pages must be cleared once taken")
+        self.assertEqual(ram.take_dirty_pages("viewer"), dirty, "New consumer must get every page written so far")
+        ram[0x000] = 0x03
+        self.assertEqual(ram.take_dirty_pages(), 1, "Each consumer must see the write")
+        self.assertEqual(ram.take_dirty_pages("viewer"), 1, "Consumers must not take each other's pages")
+        heat = ram.write_heat()
+        self.assertEqual([heat[0x3ef], heat[0x3f0], heat[0x40f], heat[0x410]], [0, 2, 1, 0],
+                         "Heat must count writes per address")
+
 
 class TestCPU(unittest.TestCase):
     def test_cpu_init(self):
         cpu = CPU()
         self.assertEqual(cpu.pc, 0x200, "Program counter must initialized 0x200")
         self.assertEqual(cpu.i, 0x0, "Index register is set to 0x0")
-        self.assertEqual(len(cpu.stack), 0, "Stack memory must be empty")
+        self.assertEqual((len(cpu.stack), cpu.sp), (16, 0), "Stack must have 16 levels, none in use")
         self.assertEqual((cpu.delay_timer, cpu.sound_timer), (0, 0), "Timers are set to 0")
 
     def test_cpu_load_font(self):
@@ -86,7 +161,7 @@ class TestCPU(unittest.TestCase):
             0xF0, 0x80, 0xF0, 0x80, 0x80,  # F
         ]
         cpu.load_font()
-        self.assertEqual(ram.data[0x050:0x050 + len(FONT)], FONT, "Font must be loaded to RAM")
+        self.assertEqual(list(ram.data[0x050:0x050 + len(FONT)]), FONT, "Font must be loaded to RAM")
 
     def test_cpu_fetch(self):
         ram = RAM()
@@ -105,13 +180,1051 @@ class TestCPU(unittest.TestCase):
 
     def test_cpu_op_0x00ee(self):
         cpu = CPU()
-        cpu.stack = [addr for addr in range(0x200, 0x200 + 5)]
-        stack_top = cpu.stack[-1]
-        orig_stack_size = len(cpu.stack)
+        cpu.stack[:5] = array('H', range(0x200, 0x200 + 5))
+        cpu.sp = 5
+        stack_top = cpu.stack[4]
         exe_status = cpu.op_0(0x0ee)
         self.assertTrue(exe_status, "0x00ee must execute successfully")
         self.assertEqual(cpu.pc, stack_top, f"{stack_top} must be popped from stack to pc")
-        self.assertEqual(len(cpu.stack), orig_stack_size - 1, "Stack size must shrink")
+        self.assertEqual(cpu.sp, 4, "Stack pointer must go down")
+
+    def test_cpu_stack_faults(self):
+        cpu = CPU()
+        with self.assertRaises(StackFault, msg="Return with empty stack must fault"):
+            cpu.execute(0x00ee)
+        for _ in range(16):
+            cpu.execute(0x2300)
+        with self.assertRaises(StackFault, msg="Seventeenth call must fault"):
+            cpu.execute(0x2300)
+        self.assertEqual(cpu.sp, 16, "Faulting call must not change the stack")
+
+    def test_cpu_registers_are_8bit_ints(self):
+        cpu = CPU()
+        cpu.v[0x1], cpu.v[0x2] = 0xff, 0x01
+        cpu.execute(0x8124)
+        self.assertEqual((cpu.v[0x1], cpu.v[0xf]), (0x00, 1), "Sum must wrap, carry must be set")
+        self.assertIs(type(cpu.v[0xf]), int, "VF must read back as int, not bool")
+        cpu.v[0xf] = 0x03
+        cpu.execute(0x8f16)
+        self.assertEqual(cpu.v[0xf], 0x00, "SHR VF must shift the flag it just stored")
+        with self.assertRaises(AttributeError, msg="CPU state layout must be fixed"):
+            cpu.extra = 1
+
+        engine = BlockEngine(HeadlessMachine(bytes([0x60, 0x01, 0x61, 0x02, 0x80, 0x15, 0x12, 0x06])).cpu)
+        engine.run_for(1)
+        engine.run_for(3)
+        self.assertEqual((engine.cpu.v[0x0], engine.cpu.v[0xf]), (0xff, 0), "Block must borrow like SUB")
+        self.assertIs(type(engine.cpu.v[0xf]), int, "Translated blocks must store VF as int too")
+
+    def test_cpu_op_0x8xye(self):
+        cpu = CPU()
+        cpu.v[0x1] = 0x81
+        exe_status = cpu.op_8(0x11e)
+        self.assertTrue(exe_status, "0x811e must execute successfully")
+        self.assertEqual(cpu.v[0x1], 0x02, "V1 must be shifted left and clipped to 8-bit")
+        self.assertEqual(cpu.v[0xf], 0x1, "Vf must hold the shifted out bit")
+
+    def test_cpu_op_0xfx33(self):
+        ram = RAM()
+        cpu = CPU(ram=ram)
+        cpu.i = 0x300
+        cpu.v[0x2] = 254
+        cpu.execute(0xf233)
+        self.assertEqual(ram.data[0x300:0x303], bytes([2, 5, 4]), "BCD of V2 must be stored at I")
+
+    def test_cpu_invalid_opcode(self):
+        cpu = CPU()
+        self.assertFalse(cpu.op_8(0x00f), "0x800f is not a valid opcode")
+        self.assertIsNone(cpu.decode(0x800f), "Invalid opcode must decode to None")
+        with self.assertRaises(InvalidOpcode, msg="Executing invalid opcode must raise fault"):
+            cpu.execute(0x800f)
+
+    def test_cpu_decode_cache(self):
+        cpu = CPU()
+        handler = cpu.decode(0x6105)
+        self.assertIs(cpu.decode(0x6105), handler, "Same opcode must reuse its decoded handler")
+        handler()
+        self.assertEqual(cpu.v[0x1], 0x05, "Decoded handler must have operands bound")
+
+    def test_cpu_run_self_modifying_code(self):
+        ram = RAM()
+        cpu = CPU(ram=ram)
+        ram.bulk_write(0x200, [0x61, 0x01, 0x12, 0x00])  # LD V1, 0x01; JP 0x200
+        for _ in range(2):
+            cpu.run()
+        self.assertIn(0x200, cpu.code_cache, "Executed instruction must be cached by address")
+
+        ram[0x201] = 0x02  # LD V1, 0x02
+        self.assertNotIn(0x200, cpu.code_cache, "Writing to code must invalidate its cache entry")
+        cpu.run()
+        self.assertEqual(cpu.v[0x1], 0x02, "CPU must execute the rewritten instruction")
+
+
+class TestFrameBuffer(unittest.TestCase):
+    def test_framebuffer_draw_sprite_collision(self):
+        fb = FrameBuffer()
+        self.assertFalse(fb.draw_sprite(0, 0, [0xf0]), "Drawing on empty screen must not collide")
+        self.assertEqual(fb.rows[0] >> 56, 0xf0, "Sprite row must be XORed into the row")
+        self.assertTrue(fb.draw_sprite(2, 0, [0x80]), "Turning a pixel off must collide")
+        self.assertEqual(fb.rows[0] >> 56, 0xd0, "Colliding pixel must be toggled off")
+        self.assertFalse(fb.draw_sprite(4, 0, [0x80]), "Turning a pixel on must not collide")
+
+    def test_framebuffer_draw_sprite_wrap_and_clip(self):
+        fb = FrameBuffer()
+        fb.draw_sprite(64 + 60, 32 + 30, [0xff, 0xff, 0xff])
+        state = fb.get_state()
+        self.assertEqual(state[30][56:], [False] * 4 + [True] * 4, "Start coordinate must wrap, right edge is clipped")
+        self.assertTrue(state[31][63], "Second sprite row must be drawn")
+        self.assertFalse(any(state[0]) or any(row[0] for row in state), "Nothing must wrap around the edges")
+
+    def test_framebuffer_dirty_rects(self):
+        fb = FrameBuffer()
+        self.assertEqual(fb.take_dirty_rects(), [], "Nothing changed on a fresh framebuffer")
+        fb.draw_sprite(10, 4, [0x80, 0xc0, 0x40])
+        fb.draw_sprite(40, 20, [0x01])
+        self.assertEqual(fb.take_dirty_rects(), [(10, 4, 2, 3), (47, 20, 1, 1)],
+                         "Overlapping rows must merge, separate changes stay apart")
+        self.assertEqual(fb.take_dirty_rects(), [], "Presented changes must not be reported again")
+
+    def test_framebuffer_dirty_rects_cancelled_change(self):
+        fb = FrameBuffer()
+        fb.draw_sprite(0, 0, [0xff])
+        fb.draw_sprite(0, 0, [0xff])
+        self.assertEqual(fb.take_dirty_rects(), [], "Sprite erased within the frame changes nothing")
+
+    def test_framebuffer_dirty_rects_merged_when_many(self):
+        fb = FrameBuffer()
+        for y in range(0, 32, 2):
+            fb.draw_pixel(y, y, True)
+        self.assertEqual(fb.take_dirty_rects(), [(0, 0, 31, 31)], "Too many rects must merge into bounding box")
+
+    def test_cpu_op_dxyn_sets_vf(self):
+        ram = RAM()
+        cpu = CPU(ram=ram, screen=HeadlessScreen())
+        ram.bulk_write(0x300, [0x3c])
+        cpu.i = 0x300
+        cpu.execute(0xd011)
+        self.assertEqual(cpu.v[0xf], 0, "First draw must not collide")
+        cpu.execute(0xd011)
+        self.assertEqual(cpu.v[0xf], 1, "Redrawing the same sprite must collide")
+        self.assertEqual(cpu.screen.rows[0], 0, "Redrawing the same sprite must erase it")
+
+
+@unittest.skipUnless(numpy, "RamViewer requires numpy")
+class TestRamViewer(unittest.TestCase):
+    def test_ram_viewer_redraws_written_pages(self):
+        from ram_viewer import RamViewer
+        ram = RAM()
+        viewer = RamViewer(ram, cell=2)
+        pages, strips = viewer.update()
+        self.assertEqual((len(pages), strips.shape), (64, (64, 128, 2, 3)), "First update must draw every page")
+        self.assertEqual(viewer.update(), ([], None), "Nothing written, nothing to redraw")
+
+        ram[0x345] = 0x80
+        pages, strips = viewer.update()
+        self.assertEqual(pages, [0xd], "Only the written page must be redrawn")
+        self.assertEqual(strips[0, 0x5 * 2, 0].tolist(), list(RamViewer.WRITE_COLOR), "Written byte must be highlighted")
+        pages, strips = viewer.update()
+        self.assertEqual(strips[0, 0x5 * 2, 0].tolist(), viewer.palette[0x80].tolist(),
+                         "Highlight must be cleared on the next update")
+        self.assertEqual(viewer.update(), ([], None), "Page must not be redrawn again")
+
+
+@unittest.skipUnless(numpy, "ArrayRenderer requires numpy")
+class TestArrayRenderer(unittest.TestCase):
+    def test_array_renderer_compose_scaled(self):
+        from renderer import ArrayRenderer
+        fb = FrameBuffer()
+        fb.draw_pixel(1, 0, True)
+        renderer = ArrayRenderer(px_scale=2, on_color=(255, 0, 0), off_color=(0, 0, 0))
+        image = renderer.compose(fb.rows)
+        self.assertEqual(image.shape, (128, 64, 3), "Image must be x major and scaled")
+        self.assertEqual(image[2:4, 0:2].tolist(), [[[255, 0, 0]] * 2] * 2, "Pixel must cover scale x scale")
+        self.assertEqual(image[0, 0].tolist(), [0, 0, 0], "Off pixel must use off color")
+
+    def test_array_renderer_decay(self):
+        from renderer import ArrayRenderer
+        fb = FrameBuffer()
+        fb.draw_pixel(0, 0, True)
+        renderer = ArrayRenderer(px_scale=1, on_color=(200, 200, 200), off_color=(0, 0, 0), decay=0.5)
+        renderer.compose(fb.rows)
+        fb.draw_pixel(0, 0, False)
+        image = renderer.compose(fb.rows)
+        self.assertEqual(image[0, 0].tolist(), [100, 100, 100], "Turned off pixel must keep half brightness")
+        self.assertTrue(renderer.is_fading(), "Renderer must keep presenting while pixels fade")
+
+
+@unittest.skipUnless(numpy, "VectorCPU requires numpy")
+class TestVectorCPU(unittest.TestCase):
+    PROGRAM = bytes([
+        0x60, 0x00,  # 0x200: LD V0, 0x00
+        0x61, 0x00,  # 0x202: LD V1, 0x00
+        0x65, 0x03,  # 0x204: LD V5, 0x03
+        0xe5, 0x9e,  # 0x206: SKP V5
+        0x71, 0x01,  # 0x208: ADD V1, 0x01
+        0xf0, 0x29,  # 0x20a: LD F, V0
+        0xd0, 0x15,  # 0x20c: DRW V0, V1, 5
+        0x22, 0x20,  # 0x20e: CALL 0x220
+        0x70, 0x07,  # 0x210: ADD V0, 0x07
+        0xf2, 0x07,  # 0x212: LD V2, DT
+        0x32, 0x00,  # 0x214: SE V2, 0x00
+        0x12, 0x12,  # 0x216: JP 0x212
+        0x12, 0x06,  # 0x218: JP 0x206
+        0x00, 0x00,
+        0x00, 0x00,
+        0x00, 0x00,
+        0x84, 0x04,  # 0x220: ADD V4, V0
+        0x83, 0x45,  # 0x222: SUB V3, V4
+        0x86, 0x3e,  # 0x224: SHL V6, V3
+        0x87, 0x36,  # 0x226: SHR V7, V3
+        0xa3, 0x00,  # 0x228: LD I, 0x300
+        0xf7, 0x33,  # 0x22a: LD B, V7
+        0xf7, 0x55,  # 0x22c: LD [I], V7
+        0xf3, 0x65,  # 0x22e: LD V3, [I]
+        0x66, 0x02,  # 0x230: LD V6, 0x02
+        0xf6, 0x15,  # 0x232: LD DT, V6
+        0x00, 0xee,  # 0x234: RET
+    ])
+
+    def test_vector_matches_scalar_cpu(self):
+        from vector import VectorCPU
+        vector = VectorCPU(4, self.PROGRAM)
+        vector_scheduler = Scheduler(vector, ips=700)
+        machines = [HeadlessMachine(self.PROGRAM) for _ in range(4)]
+        for k in (1, 3):
+            vector.press(k, 0x3)
+            machines[k].keyboard.press(0x3)
+
+        for frame in range(40):
+            if frame == 20:
+                vector.release(3, 0x3)
+                machines[3].keyboard.release(0x3)
+
+            vector_scheduler.run_frame()
+            for k, machine in enumerate(machines):
+                machine.run(frames=1)
+                cpu = machine.cpu
+                self.assertEqual((int(vector.pc[k]), int(vector.i[k]), vector.v[k].tolist()),
+                                 (cpu.pc, cpu.i, list(cpu.v)), "Registers must match scalar CPU")
+                self.assertEqual(vector.stack[k, :vector.sp[k]].tolist(), cpu.stack[:cpu.sp].tolist(), "Stack must match scalar CPU")
+                self.assertEqual((int(vector.delay_timer[k]), int(vector.cycles[k])),
+                                 (cpu.delay_timer, cpu.cycles), "Timers and cycles must match scalar CPU")
+                self.assertEqual(vector.ram[k].tobytes(), bytes(cpu.ram.data), "Memory must match scalar CPU")
+                self.assertEqual(vector.rows[k].tolist(), cpu.screen.rows, "Framebuffer must match scalar CPU")
+
+        self.assertNotEqual(vector.v[0].tolist(), vector.v[1].tolist(), "Inputs must make instances diverge")
+
+    def test_vector_fault_stops_instance(self):
+        from vector import VectorCPU
+        vector = VectorCPU(3, bytes([
+            0xe0, 0x9e,  # 0x200: SKP V0
+            0xff, 0xff,  # 0x202: invalid
+            0x70, 0x01,  # 0x204: ADD V0, 0x01
+            0x12, 0x04,  # 0x206: JP 0x204
+        ]))
+        vector.press(2, 0x0)
+        vector.run_for(10)
+        self.assertEqual(list(vector.faults), [0, 1], "Instances reaching the invalid opcode must fault")
+        self.assertEqual(vector.faults[0], "Invalid opcode: 0xffff at 0x202", "Fault must name opcode and address")
+        self.assertEqual(vector.pc[:2].tolist(), [0x202, 0x202], "Faulted instances must stop at the fault")
+        self.assertEqual(int(vector.v[2, 0]), 5, "Other instances must keep running")
+
+
+class TestBlockEngine(unittest.TestCase):
+    PROGRAM = [
+        0x63, 0x00,  # 0x200: LD V3, 0x00
+        0x62, 0x01,  # 0x202: LD V2, 0x01 <- rewritten to LD V2, 0x07
+        0x84, 0x24,  # 0x204: ADD V4, V2
+        0x73, 0x01,  # 0x206: ADD V3, 0x01
+        0x60, 0x62,  # 0x208: LD V0, 0x62
+        0x61, 0x07,  # 0x20a: LD V1, 0x07
+        0xa2, 0x02,  # 0x20c: LD I, 0x202
+        0xf1, 0x55,  # 0x20e: LD [I], V1
+        0x33, 0x03,  # 0x210: SE V3, 0x03
+        0x12, 0x02,  # 0x212: JP 0x202
+        0x22, 0x18,  # 0x214: CALL 0x218
+        0x12, 0x16,  # 0x216: JP 0x216
+        0xf3, 0x65,  # 0x218: LD V3, [I]
+        0x8e, 0x46,  # 0x21a: SHR VE, V4
+        0x00, 0xee,  # 0x21c: RET
+    ]
+
+    def make_cpu(self):
+        ram = RAM()
+        cpu = CPU(ram=ram)
+        ram.bulk_write(0x200, self.PROGRAM)
+        return cpu
+
+    def test_block_engine_matches_interpreter(self):
+        interpreted = self.make_cpu()
+        while interpreted.pc != 0x216:
+            interpreted.run()
+
+        translated = self.make_cpu()
+        engine = BlockEngine(translated)
+        while translated.pc != 0x216:
+            engine.run()
+
+        self.assertEqual(translated.v, interpreted.v, "Registers must match interpreter")
+        self.assertEqual((translated.pc, translated.i, translated.sp, translated.stack),
+                         (interpreted.pc, interpreted.i, interpreted.sp, interpreted.stack),
+                         "PC, I and stack must match interpreter")
+        self.assertEqual(translated.ram.data, interpreted.ram.data, "Memory must match interpreter")
+        self.assertEqual(translated.v[0x4], 1 + 7 + 7, "Rewritten instruction must be executed")
+
+    def test_block_engine_fault_matches_interpreter(self):
+        programs = [
+            [0x60, 0x05, 0xaf, 0xff, 0xf1, 0x65],  # LD V0, 0x05; LD I, 0xfff; LD V1, [I] past the end
+            [0x60, 0x05, 0x61, 0x06, 0xff, 0xff],  # LD V0, 0x05; LD V1, 0x06; invalid opcode
+            [0x1f, 0xfa] + [0x00] * 0xdf8 + [0x60, 0x05, 0x61, 0x06, 0x62, 0x07],  # JP 0xffa, runs off the end
+        ]
+        for program in programs:
+            states = []
+            for engine in ("interpreter", "block"):
+                machine = HeadlessMachine(bytes(program), engine=engine)
+                with self.assertRaises((InvalidOpcode, MemoryFault)):
+                    machine.run(cycles=100)
+                cpu = machine.cpu
+                states.append((cpu.pc, cpu.i, list(cpu.v), cpu.cycles))
+            self.assertEqual(states[1], states[0], "Faulting block must leave the same state as the interpreter")
+
+    def test_block_engine_evicts_written_block(self):
+        cpu = self.make_cpu()
+        engine = BlockEngine(cpu)
+        engine.run()  # Font loading step
+        self.assertEqual(engine.run(), 7, "Block must end after the memory store")
+        self.assertNotIn(0x202, engine.blocks, "Block overwriting itself must be evicted")
+
+
+class TestScheduler(unittest.TestCase):
+    def make_cpu(self):
+        ram = RAM()
+        cpu = CPU(ram=ram)
+        ram.bulk_write(0x200, [0x70, 0x01, 0x12, 0x00])  # ADD V0, 0x01; JP 0x200
+        return cpu
+
+    def test_scheduler_fractional_ips(self):
+        cpu = self.make_cpu()
+        scheduler = Scheduler(cpu, ips=90)
+        executed = [scheduler.run_frame() for _ in range(4)]
+        self.assertEqual(executed, [1, 2, 1, 2], "90 IPS must run 1.5 instructions per frame")
+        self.assertEqual(cpu.cycles, 6, "CPU must count executed instructions")
+
+    def test_scheduler_timers_at_frame_rate(self):
+        cpu = self.make_cpu()
+        cpu.delay_timer = 10
+        cpu.sound_timer = 2
+        scheduler = Scheduler(cpu, ips=6000)
+        scheduler.fast_forward(5)
+        self.assertEqual(cpu.delay_timer, 5, "Delay timer must decrease once per frame")
+        self.assertEqual(cpu.sound_timer, 0, "Timers must stop at zero")
+        self.assertEqual(scheduler.instructions, 500, "Each frame must run ips / 60 instructions")
+
+    def test_scheduler_block_engine_budget(self):
+        cpu = self.make_cpu()
+        scheduler = Scheduler(cpu, ips=60 * 3, engine=BlockEngine(cpu))
+        scheduler.fast_forward(3)
+        self.assertEqual(cpu.cycles, 9, "Block engine must not overrun the frame budget")
+        self.assertEqual(cpu.v[0x0], 5, "Only instructions within budget are executed")
+
+
+class TestRuntime(unittest.TestCase):
+    COUNT = bytes([0x70, 0x01, 0x12, 0x00])  # ADD V0, 0x01; JP 0x200
+
+    def test_runtime_clocks_instances_independently(self):
+        runtime = Runtime()
+        slow = HeadlessMachine(self.COUNT)
+        fast = HeadlessMachine(self.COUNT, engine="block")
+        slow.cpu.delay_timer = 0xff
+        sounds = []
+        fast.cpu.sound_timer = 3
+        slow_instance = runtime.add(slow.cpu, ips=600)
+        fast_instance = runtime.add(fast.cpu, engine=fast.engine, ips=3000, sound=sounds.append)
+        runtime.run(duration=0.3)
+
+        self.assertTrue(100 <= slow_instance.instructions <= 200, "CPU must run at its own rate")
+        self.assertGreater(fast_instance.instructions, 3 * slow_instance.instructions, "Instances must not share a clock")
+        self.assertTrue(10 <= 0xff - slow.cpu.delay_timer <= 19, "Timers must tick at 60 Hz of host time")
+        self.assertEqual(sounds, [True, False], "Sound must start and stop with the sound timer")
+
+    def test_runtime_drops_render_frames(self):
+        runtime = Runtime()
+        machine = HeadlessMachine(self.COUNT)
+        instance = runtime.add(machine.cpu, ips=600, render=lambda: time.sleep(0.05))
+        runtime.run(duration=0.3)
+
+        self.assertLessEqual(instance.frames_rendered, 7, "Slow renderer must not be called for every frame")
+        self.assertGreater(instance.frames_dropped, 0, "Late frames must be dropped")
+        self.assertGreaterEqual(instance.instructions, 120, "Slow rendering must not slow the CPU down")
+
+    def test_runtime_fault_stops_one_instance(self):
+        runtime = Runtime()
+        broken = runtime.add(HeadlessMachine(bytes([0xff, 0xff])).cpu)
+        healthy = runtime.add(HeadlessMachine(self.COUNT).cpu, poll=lambda: None)
+        runtime.run(duration=0.1)
+
+        self.assertIsInstance(broken.fault, InvalidOpcode, "Fault must be kept by its instance")
+        self.assertTrue(healthy.running and healthy.instructions > 0, "Other instances must keep running")
+
+
+class TestCore(unittest.TestCase):
+    SHOW_KEY = bytes([
+        0xf1, 0x0a,  # 0x200: LD V1, K
+        0xf1, 0x29,  # 0x202: LD F, V1
+        0xd0, 0x05,  # 0x204: DRW V0, V0, 5
+        0x12, 0x06,  # 0x206: JP 0x206
+    ])
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            self.assertLess(time.perf_counter(), deadline, "Core did not respond in time")
+            time.sleep(0.01)
+
+    def test_command_ring_wraps(self):
+        ring = CommandRing(capacity=16)
+        try:
+            for n in range(20):
+                self.assertTrue(ring.put(n % 8, bytes([n]) * (n % 6)), "Message must fit in empty ring")
+                self.assertEqual(ring.get(), (n % 8, bytes([n]) * (n % 6)), "Message must survive wrapping")
+            self.assertIsNone(ring.get(), "Empty ring must return None")
+            self.assertTrue(ring.put(1, bytes(13)), "Message of exactly the capacity must fit")
+            self.assertFalse(ring.put(1), "Full ring must refuse messages")
+        finally:
+            ring.close()
+            ring.unlink()
+
+    def test_frame_exchange_latest(self):
+        frames = FrameExchange()
+        reader = FrameExchange(frames.name)
+        try:
+            self.assertEqual(reader.latest(), (0, None), "No frame before the first publish")
+            frames.publish([1] * 32)
+            frames.publish([2] * 32)
+            self.assertEqual(reader.latest(), (2, [2] * 32), "Reader must see the latest complete frame")
+        finally:
+            reader.close()
+            frames.close()
+            frames.unlink()
+
+    def test_core_thread_keys_and_frames(self):
+        core = EmulatorCore(self.SHOW_KEY, ips=6000, mode="thread")
+        try:
+            self.wait_for(lambda: core.latest_frame()[0] > 2)
+            self.assertFalse(any(core.latest_frame()[1]), "Core must wait for a key")
+            core.press(0x1)
+            self.wait_for(lambda: any(core.latest_frame()[1]))
+            self.assertEqual(core.latest_frame()[1][:5], [0x20 << 56, 0x60 << 56, 0x20 << 56, 0x20 << 56, 0x70 << 56],
+                             "Core must draw the pressed key")
+        finally:
+            core.stop()
+
+    def test_core_process_load_rom_fault(self):
+        core = EmulatorCore(self.SHOW_KEY, mode="process")
+        try:
+            core.load_rom(bytes([0xff, 0xff]))
+            self.wait_for(core.fault)
+            self.assertEqual(core.fault(), "Invalid opcode: 0xffff at 0x200", "Fault must reach the display side")
+            core.load_rom(self.SHOW_KEY)
+            self.wait_for(lambda: core.fault() is None)
+            sequence = core.latest_frame()[0]
+            self.wait_for(lambda: core.latest_frame()[0] > sequence + 1)
+        finally:
+            core.stop()
+        self.assertFalse(core.worker.is_alive(), "Worker must exit on stop")
+
+
+class TestHeadless(unittest.TestCase):
+    DRAW_FIVE = bytes([
+        0x60, 0x00,  # LD V0, 0x00
+        0x61, 0x00,  # LD V1, 0x00
+        0x62, 0x05,  # LD V2, 0x05
+        0xf2, 0x29,  # LD F, V2
+        0xd0, 0x15,  # DRW V0, V1, 5
+        0x12, 0x0a,  # JP 0x20a
+    ])
+
+    def test_headless_run_ends_without_progress(self):
+        with self.assertRaises(ValueError, msg="Less than one instruction per frame must be rejected"):
+            HeadlessMachine(self.DRAW_FIVE, ips=30)
+        machine = HeadlessMachine(self.DRAW_FIVE)
+        machine.cpu.set_breakpoint(0x208)
+        machine.run(cycles=1000)
+        self.assertEqual(machine.cpu.pc, 0x208, "Run must end when stopped at a breakpoint")
+
+    def test_headless_run_returns_framebuffer(self):
+        machine = HeadlessMachine(self.DRAW_FIVE)
+        state = machine.run(cycles=100)
+        self.assertEqual(machine.cpu.cycles, 100, "Machine must execute exactly the given cycles")
+        self.assertEqual(state[0][:5], [True] * 4 + [False], "Top row of digit 5 must be drawn")
+        self.assertEqual(state[1][:5], [True] + [False] * 4, "Second row of digit 5 must be drawn")
+        self.assertFalse(any(state[5]), "Nothing is drawn below the sprite")
+
+    def test_headless_screen_rows_independent(self):
+        screen = HeadlessScreen()
+        screen.toggle_pixel(3, 2)
+        screen.toggle_pixel(70, 40)
+        self.assertTrue(screen.get_state()[2][3], "Pixel must be toggled on")
+        self.assertEqual(sum(map(sum, screen.get_state())), 1, "Only one pixel is on, outside is clipped")
+
+    def test_headless_keyboard_events(self):
+        keyboard = HeadlessKeyboard()
+        keyboard.set_keymap({"x": 0x0, "v": 0xf})
+        keyboard.set_event(Mock(type=KEYDOWN, key="v"))
+        self.assertTrue(keyboard.is_down(0xf), "Mapped key must be down")
+        self.assertEqual(keyboard.get_key_value(), 0xf, "Last event key value must be mapped")
+        keyboard.release(0xf)
+        self.assertFalse(keyboard.is_down(0xf), "Released key must be up")
+
+    def test_headless_backend_loaded_by_name(self):
+        backend = backends.load("headless")
+        self.assertIs(backend.screen, HeadlessScreen, "Backend must resolve its screen class")
+        self.assertIs(backend.keyboard, HeadlessKeyboard, "Backend must resolve its keyboard class")
+        self.assertTrue(backend.poll_events(backend.keyboard()), "Headless polling never quits")
+        with self.assertRaises(ValueError):
+            backends.load("missing")
+
+    def test_headless_startup_does_not_import_pygame(self):
+        code = "import sys, c8, headless, batch; print('pygame' in sys.modules)"
+        child = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(child.stdout.strip(), "False", "Frontend must be imported only when loaded")
+
+
+class TestKeypad(unittest.TestCase):
+    WAIT_KEY = bytes([
+        0xf1, 0x0a,  # 0x200: LD V1, K
+        0x72, 0x01,  # 0x202: ADD V2, 0x01
+        0x12, 0x04,  # 0x204: JP 0x204
+    ])
+
+    def test_keypad_mask(self):
+        keyboard = HeadlessKeyboard()
+        keyboard.press(0x3)
+        keyboard.set_event(Mock(type=KEYDOWN, key=0xa))
+        self.assertEqual(keyboard.mask, (1 << 0x3) | (1 << 0xa), "Pressed keys must be set in the mask")
+        keyboard.set_event(Mock(type=KEYUP, key=0x3))
+        keyboard.set_event(Mock(type=KEYDOWN, key="unmapped"))
+        self.assertEqual(keyboard.mask, 1 << 0xa, "Released key must be cleared, unmapped key ignored")
+        self.assertFalse(keyboard.is_down(0x3), "Released key must be up")
+
+    def test_keyboard_layout(self):
+        try:
+            import pygame
+            from keyboard import Keyboard
+        except ImportError:
+            self.skipTest("pygame is not installed")
+
+        keymap = Keyboard().KEYBOARD_MAP
+        self.assertEqual(sorted(keymap.values()), list(range(0x10)), "Every CHIP-8 key must be mapped once")
+        self.assertEqual((keymap[pygame.K_4], keymap[pygame.K_q], keymap[pygame.K_c]), (0xc, 0x4, 0xb),
+                         "Host keys must follow the CHIP-8 keypad layout")
+
+    def test_wait_key_blocks(self):
+        machine = HeadlessMachine(self.WAIT_KEY)
+        machine.run(frames=2)
+        self.assertEqual((machine.cpu.pc, machine.cpu.v[0x2]), (0x200, 0), "CPU must block on Fx0A")
+        self.assertEqual(machine.cpu.cycles, machine.scheduler.instructions, "Blocked CPU must use its budget")
+        machine.keyboard.press(0x5)
+        machine.run(frames=1)
+        self.assertEqual((machine.cpu.v[0x1], machine.cpu.v[0x2]), (0x5, 1), "Key press must end the wait")
+
+    def test_wait_key_needs_new_press(self):
+        machine = HeadlessMachine(self.WAIT_KEY, engine="block")
+        machine.keyboard.press(0x3)
+        machine.run(frames=2)
+        self.assertEqual(machine.cpu.pc, 0x200, "Key held before the wait must not count")
+        machine.keyboard.release(0x3)
+        machine.keyboard.press(0x3)
+        machine.run(frames=1)
+        self.assertEqual(machine.cpu.v[0x1], 0x3, "Key pressed again must end the wait")
+
+
+class TestSaveState(unittest.TestCase):
+    COUNTER = bytes([
+        0x70, 0x01,  # 0x200: ADD V0, 0x01
+        0xa3, 0x00,  # 0x202: LD I, 0x300
+        0xf0, 0x55,  # 0x204: LD [I], V0
+        0xd0, 0x01,  # 0x206: DRW V0, V0, 1
+        0x22, 0x0c,  # 0x208: CALL 0x20c
+        0x12, 0x00,  # 0x20a: JP 0x200
+        0x00, 0xee,  # 0x20c: RET
+    ])
+
+    def test_snapshot_restore_roundtrip(self):
+        machine = HeadlessMachine(self.COUNTER)
+        machine.run(cycles=45)
+        state = snapshot(machine.cpu)
+        expected = (list(machine.cpu.v), machine.cpu.pc, list(machine.screen.rows), bytes(machine.ram.data))
+
+        machine.run(cycles=30)
+        restore(machine.cpu, state)
+        self.assertEqual((list(machine.cpu.v), machine.cpu.pc, list(machine.screen.rows), bytes(machine.ram.data)),
+                         expected, "Restored machine must equal snapshot")
+        self.assertEqual(snapshot(machine.cpu), state, "Snapshot of restored machine must be identical")
+
+    def test_restore_replays_random_numbers(self):
+        machine = HeadlessMachine(bytes([
+            0xc0, 0xff,  # 0x200: RND V0, 0xff
+            0xc1, 0xff,  # 0x202: RND V1, 0xff
+            0x82, 0x04,  # 0x204: ADD V2, V0
+            0x12, 0x00,  # 0x206: JP 0x200
+        ]), seed=3)
+        machine.run(cycles=10)
+        state = snapshot(machine.cpu)
+        machine.run(cycles=1000)
+        expected = list(machine.cpu.v)
+
+        restore(machine.cpu, state)
+        machine.run(cycles=1000)
+        self.assertEqual(machine.cpu.v, expected, "Random numbers after restore must repeat the first run")
+
+    def test_restore_restarts_key_wait(self):
+        machine = HeadlessMachine(bytes([0xf0, 0x0a, 0x12, 0x02]))  # LD V0, K; JP 0x202
+        machine.run(cycles=10)
+        state = snapshot(machine.cpu)
+        machine.keyboard.press(0x7)
+        restore(machine.cpu, state)
+        self.assertTrue(machine.cpu.waiting_key, "Restored CPU must still be waiting")
+        machine.run(cycles=10)
+        self.assertEqual(machine.cpu.pc, 0x200, "Press made before the restore must not end the wait")
+
+    def test_restore_rejects_foreign_data(self):
+        machine = HeadlessMachine()
+        state = bytearray(snapshot(machine.cpu))
+        state[0:4] = b"XXXX"
+        with self.assertRaises(SaveStateError, msg="Unknown magic must be rejected"):
+            restore(machine.cpu, state)
+
+    def test_rewind_buffer_pops_in_reverse(self):
+        machine = HeadlessMachine(self.COUNTER)
+        rewind = RewindBuffer(keyframe_interval=4)
+        states = []
+        for _ in range(10):
+            machine.run(frames=1)
+            states.append(snapshot(machine.cpu))
+            rewind.push(states[-1])
+
+        self.assertEqual(len(rewind), 10, "Every pushed frame must be kept")
+        self.assertEqual([rewind.pop() for _ in range(10)], states[::-1], "Frames must rewind in reverse order")
+        self.assertIsNone(rewind.pop(), "Empty rewind buffer must return None")
+
+    def test_rewind_buffer_memory_cap(self):
+        machine = HeadlessMachine(self.COUNTER)
+        state = snapshot(machine.cpu)
+        rewind = RewindBuffer(keyframe_interval=2, max_bytes=len(state) * 3)
+        for _ in range(20):
+            machine.run(frames=1)
+            rewind.push(snapshot(machine.cpu))
+
+        self.assertLessEqual(rewind.size, rewind.max_bytes, "Buffer must stay under its memory cap")
+        self.assertLess(len(rewind), 20, "Oldest frames must be evicted")
+
+
+class TestBatch(unittest.TestCase):
+    def test_batch_reports_per_rom(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "five.ch8"), 'wb') as f:
+                f.write(TestHeadless.DRAW_FIVE)
+            with open(os.path.join(directory, "broken.ch8"), 'wb') as f:
+                f.write(bytes([0x60, 0x01, 0x80, 0x0f]))  # LD V0, 0x01; invalid
+            with open(os.path.join(directory, "notes.txt"), 'w') as f:
+                f.write("not a ROM")
+
+            paths = list_roms(directory)
+            self.assertEqual([os.path.basename(path) for path in paths], ["broken.ch8", "five.ch8"],
+                             "Only ROM files must be found")
+            broken, five = run_batch(paths, cycles=50, workers=2)
+
+        self.assertEqual((broken["instructions"], broken["invalid_opcode_faults"]), (1, 1),
+                         "Invalid opcode must end the run and be counted")
+        self.assertEqual((five["instructions"], five["invalid_opcode_faults"], five["fault"]), (50, 0, None),
+                         "Healthy ROM must run every cycle")
+        self.assertNotEqual(five["framebuffer_hash"], broken["framebuffer_hash"], "Framebuffers must differ")
+
+        output = io.StringIO()
+        write_report([five], output)
+        self.assertEqual(json.loads(output.getvalue())[0]["rom"], "five.ch8", "Report must be JSON")
+
+        output = io.StringIO()
+        write_report([five], output, "csv")
+        self.assertTrue(output.getvalue().startswith("rom,instructions,wall_time,ips"), "Report must be CSV")
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_benchmark_compare_detects_regressions(self):
+        baseline = {
+            "cpu.fetch": {"value": 100.0, "unit": "ns/op"},
+            "rom arithmetic ips": {"value": 1000.0, "unit": "ips"},
+            "ram read": {"value": 50.0, "unit": "ns/op"},
+        }
+        results = {
+            "cpu.fetch": {"value": 115.0, "unit": "ns/op"},
+            "rom arithmetic ips": {"value": 850.0, "unit": "ips"},
+            "ram read": {"value": 54.0, "unit": "ns/op"},
+            "ram write": {"value": 500.0, "unit": "ns/op"},
+        }
+        self.assertEqual(compare(results, baseline, threshold=0.10),
+                         [("cpu.fetch", 100.0, 115.0), ("rom arithmetic ips", 1000.0, 850.0)],
+                         "Only slowdowns past threshold must be reported, new benchmarks ignored")
+
+
+class TestProfiler(unittest.TestCase):
+    def test_profiler_counts(self):
+        machine = HeadlessMachine(TestSaveState.COUNTER)
+        profiler = Profiler(sample_every=2)
+        profiler.attach(machine.cpu)
+        machine.run(cycles=70)
+
+        self.assertEqual(sum(profiler.opcode_counts().values()), 70, "Every instruction must be counted")
+        self.assertEqual(profiler.family_counts()[0x7], 10, "ADD Vx, nn family must run 10 times")
+        self.assertEqual(profiler.pc_counts()[0x20c], 10, "RET address must run 10 times")
+        self.assertEqual(profiler.call_targets(), {0x20c: 10}, "Call targets must be counted")
+        self.assertGreater(profiler.handler_stats()["op_dxyn"]["samples"], 0, "Handler time must be sampled")
+
+        folded = io.StringIO()
+        profiler.write_folded(folded)
+        self.assertIn("frame;cpu;op_dxyn;206 ", folded.getvalue(), "Folded stacks must name handler and address")
+
+    def test_profiler_names_idle_loop_handlers(self):
+        machine = HeadlessMachine(bytes([
+            0x60, 0x01,  # 0x200: LD V0, 0x01
+            0x30, 0x00,  # 0x202: SE V0, 0x00
+            0x12, 0x02,  # 0x204: JP 0x202
+        ]))
+        profiler = Profiler()
+        profiler.attach(machine.cpu)
+        machine.run(frames=2)
+
+        self.assertIn(0x204, machine.cpu.idle_loops, "Loop must be fast-forwarded")
+        self.assertEqual(set(profiler.handler_stats()), {"op_6xnn", "op_3xnn", "op_1nnn"},
+                         "Idle loop sites must be named after their instructions")
+
+    def test_profiler_detached_leaves_plain_handlers(self):
+        machine = HeadlessMachine(TestSaveState.COUNTER)
+        profiler = Profiler()
+        profiler.attach(machine.cpu)
+        machine.run(cycles=7)
+        profiler.detach(machine.cpu)
+        machine.run(cycles=7)
+
+        self.assertEqual(sum(profiler.opcode_counts().values()), 7, "Detached profiler must not count")
+        self.assertEqual(machine.cpu.code_cache[0x200].func.__name__, "op_7xnn",
+                         "Dispatch must run plain handlers without profiler")
+
+
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+        self.rom_path = os.path.join(self.directory, "five.ch8")
+        with open(self.rom_path, 'wb') as f:
+            f.write(TestHeadless.DRAW_FIVE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_load_rom_bulk(self):
+        ram = RAM()
+        load_rom(ram, self.rom_path, cache=None)
+        self.assertEqual(bytes(ram.view(0x200, len(TestHeadless.DRAW_FIVE))), TestHeadless.DRAW_FIVE,
+                         "ROM must be copied to 0x200")
+
+    def test_load_rom_too_large(self):
+        path = os.path.join(self.directory, "huge.ch8")
+        with open(path, 'wb') as f:
+            f.write(bytes(0xe01))
+        with self.assertRaises(RomError, msg="ROM larger than 0x200-0xfff must be rejected"):
+            read_rom(path)
+
+    def test_rom_cache_reads_disk_once(self):
+        cache = RomCache()
+        image = cache.read(self.rom_path)
+        os.remove(self.rom_path)
+        self.assertIs(cache.read(self.rom_path), image, "Cached ROM must be reloaded without disk access")
+        self.assertEqual(len(cache.images), 1, "Images must be keyed by content hash")
+
+    def test_zip_archive(self):
+        archive_path = os.path.join(self.directory, "games.zip")
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.write(self.rom_path, "five.ch8")
+            archive.writestr("readme.txt", "not a ROM")
+
+        self.assertEqual(list_roms(archive_path), [archive_path + ":five.ch8"], "Archive ROMs must be listed")
+        self.assertEqual(read_rom(archive_path + ":five.ch8"), TestHeadless.DRAW_FIVE, "Member must be read")
+        self.assertEqual(read_rom(archive_path), TestHeadless.DRAW_FIVE, "Single ROM archive must load directly")
+
+        for name in ("games.ZIP", "games.bin", "games"):
+            renamed = os.path.join(self.directory, name)
+            os.replace(archive_path, renamed)
+            archive_path = renamed
+            members = list_roms(renamed)
+            self.assertEqual(members, [renamed + ":five.ch8"], "Archives are found by content, not name")
+            self.assertEqual(read_rom(members[0]), TestHeadless.DRAW_FIVE, f"Member of {name} must be read")
+            self.assertEqual(read_rom(renamed), TestHeadless.DRAW_FIVE, f"{name} must load directly")
+        with self.assertRaises(RomError, msg="Missing member must be a ROM error"):
+            read_rom(archive_path + ":six.ch8")
+
+
+class TestAnalyzer(unittest.TestCase):
+    TABLE = bytes([
+        0x60, 0x02,  # 0x200: LD V0, 0x02
+        0xb2, 0x06,  # 0x202: JP V0, 0x206
+        0x00, 0x00,
+        0x12, 0x0c,  # 0x206: JP 0x20c
+        0x12, 0x0e,  # 0x208: JP 0x20e
+        0x12, 0x0a,  # 0x20a: JP 0x20a
+        0x12, 0x00,  # 0x20c: JP 0x200
+        0xa2, 0x14,  # 0x20e: LD I, 0x214
+        0xd0, 0x02,  # 0x210: DRW V0, V0, 2
+        0x12, 0x00,  # 0x212: JP 0x200
+        0xff, 0x81,  # 0x214: sprite
+    ])
+
+    def test_mnemonics(self):
+        self.assertEqual([mnemonic(op) for op in (0x00e0, 0x8ab4, 0xd125, 0xf065, 0xa2f0, 0x0123)],
+                         ["CLS", "ADD VA, VB", "DRW V1, V2, 5", "LD V0, [I]", "LD I, 0x2f0", "DW 0x0123"],
+                         "Mnemonics must follow decoded operands")
+
+    def test_analyze_self_modifying_program(self):
+        analysis = analyze(bytes(TestBlockEngine.PROGRAM))
+        self.assertEqual(analysis["self_modifying"], [[0x202, 0x204]], "Stored over code must be found")
+        self.assertEqual([sub["entry"] for sub in analysis["subroutines"]], [0x218], "CALL target is a subroutine")
+        self.assertEqual([(loop["header"], loop["latch"]) for loop in analysis["loops"]],
+                         [(0x202, 0x212), (0x216, 0x216)], "Back edges must form loops")
+
+    def test_analyze_jump_table_and_sprites(self):
+        analysis = analyze(self.TABLE)
+        self.assertEqual(analysis["jump_tables"], [{"address": 0x202, "base": 0x206, "targets": [0x206, 0x208, 0x20a, 0x20c]}],
+                         "Jumps behind Bnnn base must be table entries")
+        self.assertEqual(analysis["sprites"], [[0x214, 2]], "Annn followed by Dxyn must mark a sprite")
+        self.assertEqual(analysis["data"], [[0x214, 0x216]], "Sprite bytes must be data")
+        self.assertEqual(analysis["unreached"], [[0x204, 0x206]], "Bytes never reached must be reported")
+        self.assertNotIn(0x214, [line[0] for line in disassemble(self.TABLE, analysis) if not line[2].startswith("DB")],
+                         "Data must not be disassembled as code")
+
+    def test_analysis_cache_and_warm(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = AnalysisCache(directory)
+            analysis = cache.load(bytes(TestBlockEngine.PROGRAM))
+            with open(cache.path(analysis["sha256"])) as f:
+                self.assertEqual(json.load(f), analysis, "Analysis must be stored by ROM hash")
+            self.assertEqual(cache.load(bytes(TestBlockEngine.PROGRAM)), analysis, "Stored analysis must be reused")
+
+        machine = HeadlessMachine(bytes(TestBlockEngine.PROGRAM))
+        warm(machine.cpu, analysis)
+        self.assertEqual(sorted(machine.cpu.code_cache), [a for a in analysis["code"] if a != 0x202],
+                         "Every instruction but rewritten code must be predecoded")
+
+
+class TestIdleLoop(unittest.TestCase):
+    DELAY_POLL = bytes([
+        0x60, 0x05,  # 0x200: LD V0, 0x05
+        0xf0, 0x15,  # 0x202: LD DT, V0
+        0xf1, 0x07,  # 0x204: LD V1, DT
+        0x31, 0x00,  # 0x206: SE V1, 0x00
+        0x12, 0x04,  # 0x208: JP 0x204
+        0x72, 0x01,  # 0x20a: ADD V2, 0x01
+        0x12, 0x02,  # 0x20c: JP 0x202
+    ])
+
+    def trace_frames(self, rom, idle_detection, engine="interpreter", frames=20):
+        machine = HeadlessMachine(rom, ips=700, engine=engine)
+        machine.cpu.idle_detection = idle_detection
+        states = []
+        for _ in range(frames):
+            machine.run(frames=1)
+            cpu = machine.cpu
+            states.append((cpu.pc, cpu.i, list(cpu.v), cpu.delay_timer, cpu.cycles))
+        return states
+
+    def test_idle_loop_same_results(self):
+        expected = self.trace_frames(self.DELAY_POLL, idle_detection=False)
+        self.assertEqual(self.trace_frames(self.DELAY_POLL, idle_detection=True), expected,
+                         "Fast-forwarded delay polling must match instruction by instruction run")
+        self.assertEqual(self.trace_frames(self.DELAY_POLL, idle_detection=True, engine="block"), expected,
+                         "Block engine must fast-forward with the same results")
+
+    def test_loop_exit_not_skipped(self):
+        rom = bytes([
+            0xa0, 0x50,  # 0x200: LD I, 0x050
+            0x70, 0x01,  # 0x202: ADD V0, 0x01
+            0x30, 0x02,  # 0x204: SE V0, 0x02
+            0x12, 0x02,  # 0x206: JP 0x202
+            0xd1, 0x15,  # 0x208: DRW V1, V1, 5
+            0x60, 0x00,  # 0x20a: LD V0, 0x00
+            0x12, 0x02,  # 0x20c: JP 0x202
+        ])
+        for ips in range(60, 3000, 60):
+            results = []
+            for idle_detection in (True, False):
+                machine = HeadlessMachine(rom, ips=ips)
+                machine.cpu.idle_detection = idle_detection
+                screen = machine.run(frames=3)
+                results.append((screen, list(machine.cpu.v), machine.cpu.cycles))
+            self.assertEqual(results[0], results[1],
+                             f"Code run after a skip leaves the loop must not be fast-forwarded ({ips} IPS)")
+
+    def test_idle_loop_jump_to_self(self):
+        machine = HeadlessMachine(bytes([0x60, 0x05, 0x12, 0x02]))  # LD V0, 0x05; JP 0x202
+        machine.cpu.run_for(10 ** 9)
+        self.assertEqual((machine.cpu.pc, machine.cpu.cycles), (0x202, 10 ** 9),
+                         "Jump to self must consume the budget without looping")
+
+    def test_idle_loop_waits_for_key(self):
+        machine = HeadlessMachine(bytes([
+            0xe0, 0x9e,  # 0x200: SKP V0
+            0x12, 0x00,  # 0x202: JP 0x200
+            0x71, 0x01,  # 0x204: ADD V1, 0x01
+            0x12, 0x06,  # 0x206: JP 0x206
+        ]))
+        machine.run(frames=3)
+        self.assertEqual(machine.cpu.v[0x1], 0, "CPU must keep waiting while key is up")
+        machine.keyboard.press(0x0)
+        machine.run(frames=1)
+        self.assertEqual(machine.cpu.v[0x1], 1, "Key press must end the wait")
+
+    def test_changing_loop_not_skipped(self):
+        machine = HeadlessMachine(bytes([0x70, 0x01, 0x12, 0x00]))  # ADD V0, 0x01; JP 0x200
+        machine.cpu.run_for(301)
+        self.assertEqual(machine.cpu.v[0x0], 151 & 0xff, "Loop changing registers must run every iteration")
+        self.assertIn(0x202, machine.cpu.busy_loops, "Loop changing registers must be demoted")
+        self.assertEqual(machine.cpu.code_cache[0x202].func.__name__, "op_1nnn", "Demoted loop must use plain jump")
+
+    def test_rewritten_idle_loop_rechecked(self):
+        machine = HeadlessMachine(bytes([0x60, 0x00, 0x12, 0x00]))  # LD V0, 0x00; JP 0x200
+        machine.cpu.run_for(10)
+        self.assertIn(0x202, machine.cpu.idle_loops, "Loop must be detected as idle")
+        machine.ram[0x200] = 0x70  # ADD V0, 0x00
+        self.assertNotIn(0x202, machine.cpu.code_cache, "Rewriting loop body must drop the closing jump")
+
+
+
+class TestReplay(unittest.TestCase):
+    PROGRAM = bytes([
+        0xc0, 0x3f,  # 0x200: RND V0, 0x3f
+        0xc1, 0x1f,  # 0x202: RND V1, 0x1f
+        0xf3, 0x0a,  # 0x204: LD V3, K
+        0xf3, 0x29,  # 0x206: LD F, V3
+        0xd0, 0x15,  # 0x208: DRW V0, V1, 5
+        0x12, 0x00,  # 0x20a: JP 0x200
+    ])
+
+    def test_seed_makes_random_numbers_reproducible(self):
+        runs = [HeadlessMachine(self.PROGRAM, seed=42, engine=engine) for engine in ("interpreter", "block")]
+        for machine in runs:
+            machine.run(cycles=2)
+        self.assertEqual(runs[0].cpu.v[:2], runs[1].cpu.v[:2], "Same seed must give same numbers on every engine")
+
+    def test_recorded_session_replays_identically(self):
+        machine = HeadlessMachine(self.PROGRAM, ips=600, seed=7)
+        recording = Recording(7, 600, rom_hash(self.PROGRAM))
+        InputRecorder(machine.keyboard, recording).attach(machine.scheduler)
+        keyboard = machine.keyboard
+        script = {3: [(keyboard.press, 0x5)],
+                  4: [(keyboard.release, 0x5), (keyboard.press, 0x5)],  # Taken press tapped again
+                  5: [(keyboard.release, 0x5)],
+                  8: [(keyboard.press, 0xa)], 9: [(keyboard.release, 0xa)],
+                  12: [(keyboard.press, 0x1)]}
+        for frame in range(20):
+            for action, key in script.get(frame, ()):
+                action(key)
+            machine.scheduler.run_frame()
+
+        data = recording.to_bytes()
+        self.assertEqual(len(data), 45 + 7 * 7, "Header and one 7 byte event per change, taken presses included")
+        for engine in ("interpreter", "block"):
+            replayed = replay(self.PROGRAM, parse(data), engine=engine)
+            self.assertEqual(replayed.screen.rows, machine.screen.rows, "Replay must end with the same framebuffer")
+            self.assertEqual(replayed.cpu.cycles, machine.cpu.cycles, "Replay must run the same instructions")
+
+    def test_replay_rejects_bad_recordings(self):
+        data = Recording(1, 700, rom_hash(self.PROGRAM), 10, [(2, 0x20, 5)]).to_bytes()
+        with self.assertRaises(ReplayError):
+            parse(data[:-1])
+        with self.assertRaises(ReplayError):
+            parse(b"C8ST" + data[4:])
+        with self.assertRaises(ReplayError):
+            replay(self.PROGRAM[:-2], parse(data))
+
+
+
+class TestTracer(unittest.TestCase):
+    PROGRAM = bytes([
+        0x60, 0x05,  # 0x200: LD V0, 0x05
+        0xa3, 0x00,  # 0x202: LD I, 0x300
+        0x70, 0x01,  # 0x204: ADD V0, 0x01
+        0x12, 0x04,  # 0x206: JP 0x204
+    ])
+
+    def test_trace_keeps_last_entries_in_order(self):
+        machine = HeadlessMachine(self.PROGRAM)
+        trace = Trace(capacity=4)
+        trace.attach(machine.cpu)
+        machine.cpu.run_for(9)
+        self.assertEqual(len(trace), 4, "Trace must not grow past its capacity")
+        self.assertEqual(trace.records(), [(5, 0x206, 0x1204, 0x300, 0), (6, 0x204, 0x7001, 0x300, 0),
+                                           (7, 0x206, 0x1204, 0x300, 0), (8, 0x204, 0x7001, 0x300, 0)],
+                         "Oldest entries must be overwritten, records come oldest first")
+
+    @unittest.skipUnless(numpy, "Reading the saved trace requires numpy")
+    def test_trace_saved_on_fault(self):
+        machine = HeadlessMachine(self.PROGRAM[:6] + bytes([0xff, 0xff]))
+        trace = Trace()
+        trace.attach(machine.cpu)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "fault.npy")
+            with self.assertRaises(InvalidOpcode), dump_on_fault(trace, path):
+                machine.cpu.run_for(10)
+
+            saved = numpy.load(path, mmap_mode="r")
+            self.assertEqual(saved.dtype.names, ("cycle", "pc", "opcode", "i", "vf"), "Trace columns must be fields")
+            self.assertEqual(saved[-1].tolist(), (3, 0x206, 0xffff, 0x300, 0), "Faulting instruction must be last")
+            self.assertTrue((saved == trace.to_numpy()).all(), "Saved file must match exported array")
+            del saved
+
+
+
+class TestDebugger(unittest.TestCase):
+    PROGRAM = bytes([
+        0x60, 0x00,  # 0x200: LD V0, 0x00
+        0xa3, 0x00,  # 0x202: LD I, 0x300
+        0x70, 0x01,  # 0x204: ADD V0, 0x01
+        0xf0, 0x55,  # 0x206: LD [I], V0
+        0x30, 0x10,  # 0x208: SE V0, 0x10
+        0x12, 0x04,  # 0x20a: JP 0x204
+        0x61, 0x07,  # 0x20c: LD V1, 0x07
+        0x12, 0x0e,  # 0x20e: JP 0x20e
+    ])
+
+    def test_step_and_run_until(self):
+        cpu = HeadlessMachine(self.PROGRAM).cpu
+        self.assertEqual(cpu.step(3), ("cycles", None), "Step must run the given instructions")
+        self.assertEqual((cpu.cycles, cpu.pc, cpu.v[0]), (3, 0x206, 1), "Three instructions executed")
+        self.assertEqual(cpu.run_until(pc=0x20c), ("pc", 0x20c), "Run must stop before the target")
+        self.assertEqual((cpu.pc, cpu.v[0], cpu.v[1]), (0x20c, 0x10, 0), "Target instruction not executed")
+        self.assertEqual(cpu.run_until(predicate=lambda cpu: cpu.v[1]), ("predicate", 0x20c),
+                         "Predicate must stop after the instruction making it true")
+        self.assertEqual(cpu.instruments, [], "Debug checks must be removed after the run")
+
+    def test_breakpoints_and_watchpoints(self):
+        cpu = HeadlessMachine(self.PROGRAM).cpu
+        cpu.set_breakpoint(0x208, lambda cpu: cpu.v[0] == 3)
+        self.assertEqual(cpu.run_until(), ("breakpoint", 0x208), "Conditional breakpoint must stop")
+        self.assertEqual(cpu.v[0], 3, "Breakpoint must stop only when condition holds")
+        cpu.clear_breakpoint(0x208)
+
+        cpu.watch_memory(0x300)
+        self.assertEqual(cpu.run_until(), ("memory", 0x300), "Store into watched address must stop")
+        self.assertEqual((cpu.pc, cpu.ram[0x300]), (0x208, 4), "Storing instruction must be executed")
+        cpu.unwatch_memory(0x300)
+
+        cpu.watch_register(0x1)
+        self.assertEqual(cpu.run_until(), ("register", 0x1), "Change of watched register must stop")
+        self.assertEqual(cpu.pc, 0x20e, "Run must stop after LD V1")
+        cpu.unwatch_register(0x1)
+        self.assertNotIn(cpu.memory_written, cpu.ram.write_hooks, "Unused write hook must be removed")
+        self.assertEqual(cpu.run_until(cycles=1000), ("cycles", None), "Nothing set, run must not stop")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+''' Execution tracer: last instructions executed, kept in a fixed size ring buffer '''
+
+__author__  = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+
+from array import array
+from contextlib import contextmanager
+import struct
+
+from errors import EmulatorFault
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+''' Columns of a trace entry: name, array typecode, NumPy type '''
+COLUMNS = (
+    ("cycle", "Q", "<u8"),
+    ("pc", "H", "<u2"),
+    ("opcode", "H", "<u2"),
+    ("i", "H", "<u2"),
+    ("vf", "B", "u1"),
+)
+
+''' One packed entry of a saved trace, matches DTYPE '''
+RECORD = struct.Struct("<" + "".join(typecode for _, typecode, _ in COLUMNS))
+DTYPE = [(name, numpy_type) for name, _, numpy_type in COLUMNS]
+
+
+class Trace:
+    def __init__(self, capacity=65536):
+        '''
+        Instrument attached to CPU with attach(). Every executed instruction
+        stores cycle, pc, opcode, I and VF as seen before it runs into
+        preallocated column arrays, the oldest entries are overwritten.
+        Cycle counts instructions executed since the CPU started, iterations
+        skipped by idle loop fast-forward are not executed and not counted
+        '''
+        self.capacity = capacity
+        self.columns = [array(typecode, bytes(struct.calcsize(typecode) * capacity))
+                        for _, typecode, _ in COLUMNS]
+
+        ''' Entries written so far, the next one goes to count % capacity '''
+        self.count = 0
+        self.start_cycle = 0
+        self.cpu = None
+
+
+    def attach(self, cpu):
+        self.cpu = cpu
+        self.start_cycle = cpu.cycles - self.count
+        cpu.add_instrument(self.wrap)
+
+
+    def detach(self, cpu):
+        cpu.remove_instrument(self.wrap)
+
+
+    def wrap(self, address, opcode, handler):
+        cycles, pcs, opcodes, indexes, vfs = self.columns
+        capacity = self.capacity
+        cpu = self.cpu
+
+        def traced():
+            count = self.count
+            slot = count % capacity
+            cycles[slot] = self.start_cycle + count
+            pcs[slot] = address
+            opcodes[slot] = opcode
+            indexes[slot] = cpu.i
+            vfs[slot] = cpu.v[0xf]
+            self.count = count + 1
+            handler()
+
+        return traced
+
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+
+    def order(self):
+        ''' Slots from oldest to newest entry '''
+        first = self.count % self.capacity if self.count > self.capacity else 0
+        return [(first + n) % self.capacity for n in range(len(self))]
+
+
+    def records(self):
+        ''' Entries from oldest to newest as (cycle, pc, opcode, i, vf) '''
+        columns = self.columns
+        return [tuple(column[slot] for column in columns) for slot in self.order()]
+
+
+    def to_bytes(self):
+        return b"".join(RECORD.pack(*record) for record in self.records())
+
+
+    def to_numpy(self):
+        ''' Entries from oldest to newest as NumPy structured array '''
+        if np is None:
+            raise ImportError("Trace.to_numpy requires numpy")
+
+        return np.frombuffer(self.to_bytes(), dtype=DTYPE)
+
+
+    def save(self, path):
+        '''
+        Write entries as a .npy file, written without NumPy. Open it for
+        offline analysis with numpy.load(path, mmap_mode="r")
+        '''
+        header = f"{{'descr': {DTYPE!r}, 'fortran_order': False, 'shape': ({len(self)},), }}"
+
+        ''' Magic, version 1.0 and header length, data starts 64 byte aligned '''
+        header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+        with open(path, 'wb') as f:
+            f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+            f.write(self.to_bytes())
+
+
+    def format(self, last=16):
+        ''' Last entries as text, one instruction per line '''
+        return "\n".join(f"{cycle:>10} {pc:#05x} {opcode:04x} I={i:#05x} VF={vf:#04x}"
+                         for cycle, pc, opcode, i, vf in self.records()[-last:])
+
+
+@contextmanager
+def dump_on_fault(trace, path):
+    ''' Save trace to path when the machine faults, the fault is raised again '''
+    try:
+        yield trace
+    except EmulatorFault:
+        trace.save(path)
+        raise
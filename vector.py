@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+""" Lockstep engine running many CHIP-8 machines at once as NumPy arrays """
+
+__author__ = "Rosyid Haryadi"
+__license__ = "GPLv3"
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cpu import CPU, decode_opcode
+from framebuffer import FrameBuffer
+from loader import PROGRAM_START
+from ram import RAM
+
+
+class VectorCPU:
+    """ Same font and layout as the scalar CPU """
+    FONT_ADDR = CPU.FONT_ADDR
+    STACK_DEPTH = 16
+
+    def __init__(self, instances, rom=b"", seed=None):
+        """
+        State of every instance lives in one array per register, first axis
+        is the instance. Every step fetches one instruction per instance,
+        instances at the same opcode run together as one array operation.
+        Handlers are named after CPU handlers and follow the same semantics.
+        A faulting instance stops, the others keep running.
+        Works with Scheduler like CPU does (run_for and tick_timers).
+        """
+        if np is None:
+            raise ImportError("VectorCPU requires numpy")
+
+        self.instances = instances
+        self.index = np.arange(instances)
+
+        self.pc = np.full(instances, PROGRAM_START, dtype=np.int32)
+        self.i = np.zeros(instances, dtype=np.int32)
+        self.v = np.zeros((instances, 16), dtype=np.uint8)
+        self.delay_timer = np.zeros(instances, dtype=np.uint8)
+        self.sound_timer = np.zeros(instances, dtype=np.uint8)
+
+        """ Return addresses, sp is the number of entries in use """
+        self.stack = np.zeros((instances, self.STACK_DEPTH), dtype=np.int32)
+        self.sp = np.zeros(instances, dtype=np.int32)
+
+        self.ram = np.zeros((instances, RAM.SIZE), dtype=np.uint8)
+
+        """ Packed framebuffer rows, pixel x is bit (63 - x) as in FrameBuffer """
+        self.rows = np.zeros((instances, FrameBuffer.HEIGHT), dtype=np.uint64)
+
+        """ Keypad of every instance as a 16-bit mask, presses pending for Fx0A (-1 none) """
+        self.keys = np.zeros(instances, dtype=np.uint16)
+        self.pending = np.full(instances, -1, dtype=np.int8)
+        self.waiting_key = np.zeros(instances, dtype=bool)
+
+        """ Stopped instances and their fault messages """
+        self.faulted = np.zeros(instances, dtype=bool)
+        self.faults = {}
+
+        """ Instructions executed by every instance """
+        self.cycles = np.zeros(instances, dtype=np.int64)
+
+        self.rng = np.random.default_rng(seed)
+
+        """ opcode -> (vector handler, operands) """
+        self.decode_cache = {}
+
+        """ Offsets for multi-byte memory accesses """
+        self.offsets = np.arange(16)
+
+        self.load_font()
+        if rom:
+            self.load_rom(rom)
+
+    def load_font(self):
+        scalar = RAM()
+        CPU(ram=scalar).load_font()
+        self.ram[:, :PROGRAM_START] = np.frombuffer(scalar.view(0, PROGRAM_START), dtype=np.uint8)
+
+    def load_rom(self, rom, instances=None):
+        """ Copy ROM to program start of the given instances (all by default) """
+        target = self.index if instances is None else instances
+        RAM().check_range(PROGRAM_START, len(rom))
+        self.ram[target, PROGRAM_START:PROGRAM_START + len(rom)] = np.frombuffer(bytes(rom), dtype=np.uint8)
+
+    def press(self, instances, value):
+        """ Key value goes down on instances (index or index array) """
+        instances = np.atleast_1d(instances)
+        bit = 1 << value
+        fresh = instances[(self.keys[instances] & bit) == 0]
+        self.keys[fresh] |= bit
+        self.pending[fresh] = value
+
+    def release(self, instances, value):
+        self.keys[instances] &= ~np.uint16(1 << value)
+
+    def tick_timers(self):
+        """ Decrement delay and sound timers of every instance, must be called at 60 Hz """
+        self.delay_timer[self.delay_timer > 0] -= 1
+        self.sound_timer[self.sound_timer > 0] -= 1
+
+    def run_for(self, cycles):
+        """ Step every running instance cycles times, return number of steps """
+        for _ in range(cycles):
+            self.step()
+
+        return cycles
+
+    def step(self):
+        """ Execute one instruction on every running instance, return how many ran """
+        index = np.flatnonzero(~self.faulted) if self.faults else self.index
+        if not len(index):
+            return 0
+
+        pc = self.pc[index]
+        self.pc[index] = pc + 2
+        self.cycles[index] += 1
+
+        outside = pc > RAM.SIZE - 2
+        if outside.any():
+            self.fault(index[outside], lambda k: f"Invalid memory range: {hex(self.pc[k])} + 2")
+            index = index[~outside]
+            pc = pc[~outside]
+
+        ram = self.ram
+        opcodes = (ram[index, pc].astype(np.uint16) << 8) | ram[index, pc + 1]
+
+        if not len(opcodes):
+            return 0
+
+        first = opcodes[0]
+        if (opcodes == first).all():
+            self.execute(int(first), index)
+            return len(index)
+
+        """ Sort instances by opcode, then run every group """
+        values, inverse = np.unique(opcodes, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        groups = np.split(index[order], np.cumsum(np.bincount(inverse))[:-1])
+        for opcode, group in zip(values, groups):
+            self.execute(int(opcode), group)
+
+        return len(index)
+
+    def execute(self, opcode, index):
+        try:
+            handler, operands = self.decode_cache[opcode]
+        except KeyError:
+            decoded = decode_opcode(opcode)
+            if decoded is None:
+                handler, operands = self.invalid_opcode, (opcode,)
+            else:
+                handler, operands = getattr(self, decoded[0]), decoded[1]
+            self.decode_cache[opcode] = (handler, operands)
+
+        handler(index, *operands)
+
+    def fault(self, index, message):
+        """ Stop instances at the faulting instruction, message(instance) describes the fault """
+        self.faulted[index] = True
+        self.pc[index] -= 2
+        self.cycles[index] -= 1
+        for k in index.tolist():
+            self.faults[k] = message(k)
+
+    def checked_range(self, index, start, length):
+        """ Instances of index whose memory access from start is inside RAM, others fault """
+        outside = start + length > RAM.SIZE
+        if outside.any():
+            self.fault(index[outside], lambda k: f"Invalid memory range: {hex(self.i[k])} + {length}")
+            return index[~outside], start[~outside]
+
+        return index, start
+
+    def invalid_opcode(self, index, opcode):
+        self.fault(index, lambda k: f"Invalid opcode: {opcode:#06x} at {self.pc[k]:#05x}")
+
+    """ Instruction handlers, index holds the instances running the opcode """
+
+    def op_00e0(self, index):
+        self.rows[index] = 0
+
+    def op_00ee(self, index):
+        empty = self.sp[index] == 0
+        if empty.any():
+            self.fault(index[empty], lambda k: f"Stack underflow at {self.pc[k]:#05x}")
+            index = index[~empty]
+
+        self.sp[index] -= 1
+        self.pc[index] = self.stack[index, self.sp[index]]
+
+    def op_1nnn(self, index, nnn):
+        self.pc[index] = nnn
+
+    def op_2nnn(self, index, nnn):
+        full = self.sp[index] >= self.STACK_DEPTH
+        if full.any():
+            self.fault(index[full], lambda k: f"Stack overflow at {self.pc[k]:#05x}")
+            index = index[~full]
+
+        self.stack[index, self.sp[index]] = self.pc[index]
+        self.sp[index] += 1
+        self.pc[index] = nnn
+
+    def op_3xnn(self, index, x, nn):
+        self.pc[index[self.v[index, x] == nn]] += 2
+
+    def op_4xnn(self, index, x, nn):
+        self.pc[index[self.v[index, x] != nn]] += 2
+
+    def op_5xy0(self, index, x, y):
+        self.pc[index[self.v[index, x] == self.v[index, y]]] += 2
+
+    def op_6xnn(self, index, x, nn):
+        self.v[index, x] = nn
+
+    def op_7xnn(self, index, x, nn):
+        self.v[index, x] += np.uint8(nn)
+
+    def op_8xy0(self, index, x, y):
+        self.v[index, x] = self.v[index, y]
+
+    def op_8xy1(self, index, x, y):
+        self.v[index, x] |= self.v[index, y]
+
+    def op_8xy2(self, index, x, y):
+        self.v[index, x] &= self.v[index, y]
+
+    def op_8xy3(self, index, x, y):
+        self.v[index, x] ^= self.v[index, y]
+
+    """ Flag and result are written in the same order as CPU, so x or y being F behaves the same """
+
+    def op_8xy4(self, index, x, y):
+        res = self.v[index, x].astype(np.uint16) + self.v[index, y]
+        self.v[index, 0xf] = res > 0xff
+        self.v[index, x] = res & 0xff
+
+    def op_8xy5(self, index, x, y):
+        self.v[index, 0xf] = self.v[index, x] > self.v[index, y]
+        self.v[index, x] = self.v[index, x] - self.v[index, y]
+
+    def op_8xy6(self, index, x, y):
+        self.v[index, 0xf] = self.v[index, x] & 0x01
+        self.v[index, x] >>= 1
+
+    def op_8xy7(self, index, x, y):
+        self.v[index, 0xf] = self.v[index, y] > self.v[index, x]
+        self.v[index, x] = self.v[index, y] - self.v[index, x]
+
+    def op_8xye(self, index, x, y):
+        self.v[index, 0xf] = self.v[index, x] >> 7
+        self.v[index, x] <<= 1
+
+    def op_9xy0(self, index, x, y):
+        self.pc[index[self.v[index, x] != self.v[index, y]]] += 2
+
+    def op_annn(self, index, nnn):
+        self.i[index] = nnn
+
+    def op_bnnn(self, index, nnn):
+        self.pc[index] = nnn + self.v[index, 0].astype(np.int32)
+
+    def op_cxnn(self, index, x, nn):
+        self.v[index, x] = self.rng.integers(0x00, 0x100, len(index), dtype=np.uint8) & nn
+
+    def op_dxyn(self, index, x, y, n):
+        """ Same wrapping and clipping as FrameBuffer.draw_sprite, one sprite row at a time """
+        index, start = self.checked_range(index, self.i[index], n)
+        px = self.v[index, x].astype(np.int64) % FrameBuffer.WIDTH
+        py = self.v[index, y].astype(np.intp) % FrameBuffer.HEIGHT
+
+        shift = FrameBuffer.WIDTH - 8 - px
+        left = np.maximum(shift, 0).astype(np.uint64)
+        right = np.maximum(-shift, 0).astype(np.uint64)
+
+        collision = np.zeros(len(index), dtype=bool)
+        for offset in range(n):
+            row_y = py + offset
+            visible = row_y < FrameBuffer.HEIGHT
+            if not visible.any():
+                break
+
+            instances = index[visible]
+            row_y = row_y[visible]
+            sprite = self.ram[instances, start[visible] + offset].astype(np.uint64)
+            bits = (sprite << left[visible]) >> right[visible]
+
+            row = self.rows[instances, row_y]
+            collision[visible] |= (row & bits) != 0
+            self.rows[instances, row_y] = row ^ bits
+
+        self.v[index, 0xf] = collision
+
+    def op_ex9e(self, index, x):
+        down = (self.keys[index] >> (self.v[index, x] & 0xf)) & 0x1
+        self.pc[index[down == 1]] += 2
+
+    def op_exa1(self, index, x):
+        down = (self.keys[index] >> (self.v[index, x] & 0xf)) & 0x1
+        self.pc[index[down == 0]] += 2
+
+    def op_fx07(self, index, x):
+        self.v[index, x] = self.delay_timer[index]
+
+    def op_fx0a(self, index, x):
+        """ Like CPU, only a key going down after waiting began counts """
+        self.pending[index[~self.waiting_key[index]]] = -1
+        self.waiting_key[index] = True
+
+        key = self.pending[index]
+        pressed = key >= 0
+        done = index[pressed]
+        self.v[done, x] = key[pressed]
+        self.pending[done] = -1
+        self.waiting_key[done] = False
+        self.pc[index[~pressed]] -= 2
+
+    def op_fx15(self, index, x):
+        self.delay_timer[index] = self.v[index, x]
+
+    def op_fx18(self, index, x):
+        self.sound_timer[index] = self.v[index, x]
+
+    def op_fx1e(self, index, x):
+        self.i[index] = (self.i[index] + self.v[index, x]) & 0xfff
+
+    def op_fx29(self, index, x):
+        self.i[index] = self.FONT_ADDR + 5 * (self.v[index, x] & 0xf).astype(np.int32)
+
+    def op_fx33(self, index, x):
+        index, start = self.checked_range(index, self.i[index], 3)
+        val = self.v[index, x]
+        digits = np.stack((val // 100, (val // 10) % 10, val % 10), axis=1)
+        self.ram[index[:, None], start[:, None] + self.offsets[:3]] = digits
+
+    def op_fx55(self, index, x):
+        index, start = self.checked_range(index, self.i[index], x + 1)
+        self.ram[index[:, None], start[:, None] + self.offsets[:x + 1]] = self.v[index, :x + 1]
+
+    def op_fx65(self, index, x):
+        index, start = self.checked_range(index, self.i[index], x + 1)
+        self.v[index, :x + 1] = self.ram[index[:, None], start[:, None] + self.offsets[:x + 1]]